@@ -41,6 +41,10 @@ REGION_NAME="us-east-1"
 #   The path of the reads we wish to place into the Kinesis stream.
 TAB5_READS=${BASE_DIR}"/shards/paired-reads.txt"
 
+#   Reads packed into each Kinesis record, and the target rate (0 for as fast as the stream allows).
+READS_PER_RECORD=500
+READS_PER_SECOND=0
+
 #   Location of the 'flint_kinesis_producer.py' script.
 SCRIPT_PATH="/path/to/flint/source"
 
@@ -50,7 +54,10 @@ SCRIPT_PATH="/path/to/flint/source"
 #
 ${SCRIPT_PATH}/flint_kinesis_producer.py    --stream_name ${STREAM_NAME} \
                                             --region ${REGION_NAME} \
-                                            --tab5_reads ${TAB5_READS}
+                                            --tab5_reads ${TAB5_READS} \
+                                            --reads_per_record ${READS_PER_RECORD} \
+                                            --reads_per_second ${READS_PER_SECOND} \
+                                            --compress
 
 
 echo "[" `date '+%m/%d/%y %H:%M:%S'` "]"
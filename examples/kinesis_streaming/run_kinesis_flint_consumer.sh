@@ -66,6 +66,7 @@ spark-submit    --jars ${KINESIS_LIB_PATH} \
 					                    --output_local \
 					                    --report_all \
 					                    --coalesce_output \
+					                    --end_of_stream \
 					                    --stream_kinesis
 
 
@@ -54,6 +54,7 @@ import json
 import csv
 import boto3
 import pandas as pd
+import numpy as np
 from datetime import timedelta
 import operator
 
@@ -62,6 +63,117 @@ sys.path.append(os.path.join(os.path.dirname(__file__), 'modules'))
 import flint_utilities as utils
 import spark_jobs as sj
 import flint_bowtie2_mapping as bowtieUtils
+import flint_index_shards as shards
+import flint_strain_table as strainTable
+import flint_stage_profiler as stageProfiler
+import flint_metrics as metricsUtils
+import flint_fastq as fastqUtils
+import flint_kinesis as kinesisUtils
+
+
+# ------------------------------------------------ Coalesced Output Reports -------------------------------------------
+#
+#   Reports are written out to either an S3 bucket specified in the initial JSON config file, or to a local path in
+#   the local filesystem. Note that we map the abundances so that we get a nice tab-delimited file, and not multiple
+#   ones for each partition.
+#
+def write_coalesced_report(sampleID, output_file, s3_output_bucket, strain_table, annotations_dictionary, report_all,
+                           save_to_local, save_to_s3, verbose_output, client):
+    """
+    Writes the coalesced abundance report of a sample.
+    Args:
+        sampleID:               The unique id of the sample.
+        output_file:            The path to the output file.
+        s3_output_bucket:       The S3 bucket to write files into.
+        strain_table:           The strain table, for restoring the strain names.
+        annotations_dictionary: Dictionary of Annotations for reporting organism names.
+        report_all:             Report all the strains in the annotations, including those with 0 count.
+        save_to_local:          Flag for storing output to the local filesystem.
+        save_to_s3:             Flag for storing output to AWS S3.
+        verbose_output:         Flag for wordy terminal print statements.
+        client:                 The boto3 S3 client.
+
+    Returns:
+        Nothing.
+    """
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
+          "] Writing Coalesced Output Reports...")
+
+    #
+    #   Sort the overall abundances so that we can report descending values, or most prominent Strains at top.
+    #   The accumulator holds a vector indexed by strain ID, so we restore the strain names ('gca_id') here,
+    #   and get a sorted list of tuples, i.e., 'gca_id = sorted_tuple[0]'.
+    #
+    overall_abundances = sj.get_coalesced_profile(sampleID)
+    seen_strain_ids    = np.flatnonzero(overall_abundances)
+    sorted_strain_ids  = seen_strain_ids[np.argsort(-overall_abundances[seen_strain_ids], kind='mergesort')]
+
+    sorted_overall_abundances = [(strain_table.get_strain_name(strain_id), overall_abundances[strain_id])
+                                 for strain_id in sorted_strain_ids]
+
+    seen_strains = {}   #   Maps a strain's GCA_ID (KEY) to a flag of whether we saw it in the sample.
+    output_list  = []   #   Contains the data that we'll be writing out.
+
+    for sorted_tuple in sorted_overall_abundances:
+        gca_id = sorted_tuple[0]
+        if gca_id in annotations_dictionary:
+            taxa_id       = annotations_dictionary[gca_id]['taxa_id']
+            organism_name = annotations_dictionary[gca_id]['organism_name']
+            output_list.append([str(taxa_id),
+                                str(gca_id),
+                                str(organism_name),
+                                "{0:.4f}".format(sorted_tuple[1])])
+            seen_strains[gca_id] = 1
+        else:
+            output_list.append([gca_id, sorted_tuple[1]])
+
+    if report_all:
+        for gca_id in annotations_dictionary:
+            if gca_id in seen_strains:
+                continue
+            else:
+                taxa_id = annotations_dictionary[gca_id]['taxa_id']
+                organism_name = annotations_dictionary[gca_id]['organism_name']
+                output_list.append([str(taxa_id),
+                                    str(gca_id),
+                                    str(organism_name),
+                                    "0.000000"])
+
+
+    # ------------------------------------------ Local Output ---------------------------------------------------------
+    #
+    #   Save a coalesced 'abundances.txt' output file to the 'local' filesystem of the Master Node.
+    #
+    if save_to_local:
+        if verbose_output:
+            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
+                  "] Saving to local filesystem...")
+
+        writer = csv.writer(open(output_file, "wb"), delimiter='\t', lineterminator="\n", quotechar='',
+                            quoting=csv.QUOTE_NONE)
+
+        for a_line in output_list:
+            writer.writerow(a_line)
+
+    # -------------------------------------------- S3 Output ----------------------------------------------------------
+    #
+    #   Save a coalesced 'abundances.txt' output file to the S3 bucket specified.
+    #
+    if save_to_s3:
+        if verbose_output:
+            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
+                  "] Saving to S3 bucket...")
+
+        output_df  = pd.DataFrame(output_list)
+        csv_buffer = io.BytesIO()
+        output_df.to_csv(csv_buffer, header=False, sep="\t", index=False)
+
+        response = client.put_object(
+            Bucket=s3_output_bucket,
+            Body=csv_buffer.getvalue(),
+            Key=output_file
+        )
+
 
 
 # -------------------------------------------------------- Main -------------------------------------------------------
@@ -90,9 +202,34 @@ def main(args):
                         help="Retain individual shard profiles, and store them in S3 or the local filesystem.")
     parser.add_argument("--coalesce_output", action="store_true", required=False,
                         help="Output will be merged into a single file for abundance reports.")
-    parser.add_argument("--debug", action="store_true", required=False, help="Debug mode. VERY SLOW.")
+    parser.add_argument("--debug", action="store_true", required=False, help="Debug mode. Wordier diagnostics.")
+    parser.add_argument("--stage_profile", type=str, required=False,
+                        help="Tab-delimited file in which to record the Spark stage metrics (wall time, task time, " +
+                        "shuffle bytes, and records) of each shard. Does not run any extra Spark jobs.")
+    parser.add_argument("--metrics_dir", type=str, required=False,
+                        help="Directory in which to export the metrics of each shard, as JSON lines and as a " +
+                        "Prometheus textfile for the node exporter.")
+    parser.add_argument("--align_service", action="store_true", required=False,
+                        help="Keep a resident Bowtie2 aligner in each worker node, so that the index is loaded once.")
+    parser.add_argument("--distributed_reads", action="store_true", required=False,
+                        help="Keep the reads of a shard in the Executors instead of broadcasting them from the driver.")
+    parser.add_argument("--shard_placement", action="store_true", required=False,
+                        help="Align each index shard exactly once, on the worker node that holds it. Requires an " +
+                        "index provisioned with 'provision_index.py'.")
+    parser.add_argument("--abundance_model", type=str, default="fractional", choices=["fractional", "em"],
+                        help="How reads that align to multiple strains are counted: split evenly among them " +
+                        "('fractional'), or re-assigned with Expectation-Maximization ('em'). The 'em' model " +
+                        "requires SciPy in the driver.")
+    parser.add_argument("--concurrent_samples", type=int, default=1,
+                        help="Number of samples to stream at the same time. Their batches share the cluster through " +
+                        "Spark's fair scheduler, so that small samples don't leave the executors idle. The fair " +
+                        "scheduler pools require PySpark's pinned-thread mode (PYSPARK_PIN_THREAD=true, Spark 3.0+).")
     parser.add_argument("--timeout", type=int, default=3,
                         help="Elapsed time at which streaming will stop after not retrieving any data.")
+    parser.add_argument("--end_of_stream", action="store_true", required=False,
+                        help="Stream each sample until its producer marks the end of it (a '" +
+                        sj.END_OF_STREAM_FILE + "' file in the stream directory, or the end-of-stream records of " +
+                        "'flint_kinesis_producer.py'), instead of stopping on the timeout or the number of shards.")
     output_group = parser.add_mutually_exclusive_group()
     output_group.add_argument('--output_s3', action='store_true', help="Save output to AWS S3 bucket.")
     output_group.add_argument('--output_local', action='store_true', help="Save output to local filesystem.")
@@ -115,6 +252,7 @@ def main(args):
     verbose_output          = args.verbose
     use_streaming_dir       = args.stream_dir
     use_streaming_kinesis   = args.stream_kinesis
+    use_streaming           = use_streaming_dir or use_streaming_kinesis
     save_to_s3              = args.output_s3
     save_to_local           = args.output_local
     sensitive_align         = args.sensitive
@@ -123,6 +261,14 @@ def main(args):
     coalesce_output         = args.coalesce_output
     debug_mode              = args.debug
     streaming_timeout       = args.timeout
+    wait_for_end_of_stream  = args.end_of_stream
+    use_align_service       = args.align_service
+    distributed_reads       = args.distributed_reads
+    shard_placement         = args.shard_placement
+    abundance_model         = args.abundance_model
+    stage_profile_file      = args.stage_profile
+    metrics_dir             = args.metrics_dir
+    concurrent_samples      = max(args.concurrent_samples, 1)
 
     # ----------------------------------------------- Run Configuration -----------------------------------------------
     #
@@ -135,8 +281,11 @@ def main(args):
         print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] DEBUG MODE: [0N] ⚠️")
 
     print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Loading Run parameters...")
-    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Streaming Timeout: " +
-          str(streaming_timeout) + " seconds.")
+    if wait_for_end_of_stream:
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Streaming Until: End of Stream Marker.")
+    else:
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Streaming Timeout: " +
+              str(streaming_timeout) + " seconds.")
 
     try:
         arrayOfSamples      = sampleData["samples"]
@@ -166,6 +315,10 @@ def main(args):
     sj.set_bowtie2_index_path(bowtie2_index_path)
     sj.set_bowtie2_index_name(bowtie2_index_name)
     sj.set_bowtie2_number_threads(bowtie2_threads)
+    sj.set_use_align_service(use_align_service)
+    sj.set_distributed_reads(distributed_reads)
+    sj.set_abundance_model(abundance_model)
+    sj.set_wait_for_end_of_stream(wait_for_end_of_stream)
 
 
     # --------------------------------------------- Annotations Parsing -----------------------------------------------
@@ -206,12 +359,108 @@ def main(args):
           '{:0,.0f}'.format(number_of_strains_in_annotations))
 
 
+    # --------------------------------------------- Strain Table Parsing ----------------------------------------------
+    #
+    #   The strain table maps each contig in the index to an integer strain ID, so that alignments can be handled as
+    #   integers. It is built along with the index, and it is required: the annotations only list the annotated
+    #   strains, so a table built from them would fold every other strain of the index into the 'unknown' strain.
+    #
+    if "strain_table" not in sampleData:
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
+              "] [ERROR] ⚠️ Strain Table Key Error. Missing: 'strain_table'. Build it along with the index, see " +
+              "'genome_preprocessing/6-indexing/build_strain_table.py'.")
+        exit(1)
+
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Loading Strain Table...")
+
+    s3_obj = client.get_object(Bucket=sampleData["strain_table"]["bucket"], Key=sampleData["strain_table"]["path"])
+    strain_table = strainTable.load_strain_table(s3_obj['Body'].iter_lines())
+
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] " + "Strains in Strain Table: " +
+          '{:0,.0f}'.format(strain_table.get_number_of_strains() - 1))
+
+
+    # ---------------------------------------------------- Spark ------------------------------------------------------
+    #
+    #   The following sets the final, and trivial, configurations for the Spark run. Do not set any other flags
+    #   here, as they are ignored in EMR. To set anything, do so with "--conf" in the "spark-submit" call.
+    #
+
+    #   Name for label that appears in EMR and Spark dashboard output. A single Spark context processes all the samples
+    #   in the run, so that the executors, the strain table, and the index shard placement are set up only once.
+    APP_NAME = "Flint - " + os.path.basename(filePathForInputJSONFile)
+
+    #   Configuration parameters for a Spark run in an EMR cluster.
+    conf = (SparkConf().setAppName(APP_NAME))
+    conf.set("spark.default.parallelism", partition_size)
+    conf.set("spark.executor.memoryOverhead", "1G")
+    conf.set("spark.locality.wait", "3s")
+    conf.set("spark.network.timeout", "10000000")
+    conf.set("spark.executor.heartbeatInterval", "10000000")
+
+    #   Shuffled partitions have no preferred location, so that the read blocks of '--distributed_reads' (and of
+    #   sample files) don't pull the alignment tasks to the nodes that wrote them. See 'spark_jobs.profile_sample()'.
+    conf.set("spark.shuffle.reduceLocality.enabled", "false")
+
+    #   Each sample gets its own fair-scheduler pool, and the jobs of the samples in a batch run side by side.
+    if concurrent_samples > 1:
+        conf.set("spark.scheduler.mode", "FAIR")
+        conf.set("spark.streaming.concurrentJobs", str(concurrent_samples))
+
+        #   Pools and job groups are set per thread, and without pinned threads PySpark may submit the jobs of a
+        #   sample from a JVM thread that carries the pool of another sample. See 'spark_jobs.profile_sample()'.
+        if os.environ.get("PYSPARK_PIN_THREAD", "").lower() != "true":
+            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] WARNING! PYSPARK_PIN_THREAD is " +
+                  "not set to 'true'. The fair-scheduler pools of the samples that are streamed together will not " +
+                  "be reliably applied, and stage profiles will leave out the jobs that have no job group.")
+
+
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Configuring Spark...")
+
+    #   Initialize the Spark context for this run.
+    sc = SparkContext(conf=conf)
+
+    sc.addPyFile(os.path.join(os.path.dirname(__file__), 'modules/spark_jobs.py'))
+    sc.addPyFile(os.path.join(os.path.dirname(__file__), 'modules/flint_sample_downloads.py'))
+    sc.addPyFile(os.path.join(os.path.dirname(__file__), 'modules/flint_utilities.py'))
+    sc.addPyFile(os.path.join(os.path.dirname(__file__), 'modules/flint_bowtie2_mapping.py'))
+    sc.addPyFile(os.path.join(os.path.dirname(__file__), 'modules/flint_index_shards.py'))
+    sc.addPyFile(os.path.join(os.path.dirname(__file__), 'modules/flint_abundances.py'))
+    sc.addPyFile(os.path.join(os.path.dirname(__file__), 'modules/flint_strain_table.py'))
+    sc.addPyFile(os.path.join(os.path.dirname(__file__), 'modules/flint_metrics.py'))
+    sc.addPyFile(os.path.join(os.path.dirname(__file__), 'modules/flint_fastq.py'))
+    sc.addPyFile(os.path.join(os.path.dirname(__file__), 'modules/flint_kinesis.py'))
+    sc.addPyFile(os.path.join(os.path.dirname(__file__), 'modules/flint_batch_control.py'))
+
+    #   The strain table is shipped to the worker nodes once.
+    sj.set_strain_table(sc.broadcast(strain_table))
+
+    #   Add the DNA mapping resources
+    sc.addFile(os.path.join(os.path.dirname(__file__), 'services/align_service.py'))
+
+    #   Find out which worker node holds which index shard, so that alignment tasks can be placed accordingly.
+    if shard_placement:
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Locating Index Shards...")
+
+        index_shard_registry = shards.discover_index_shards(sc, bowtie2_index_path,
+                                                            number_of_probes=partition_size * 4)
+        shards.print_registry_summary(index_shard_registry, partition_size)
+
+        sj.set_index_shard_registry(index_shard_registry)
+
+
     # --------------------------------------------- Sample Processing -------------------------------------------------
     #
     #
     print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Getting Sample Particulars...")
 
-    for aSample in arrayOfSamples:
+    #   The samples that will be streamed together, see '--concurrent_samples'.
+    sample_group = []
+
+    #   Checkpoint directories of the samples so far, as each holds the ledger of a single sample.
+    checkpoint_dirs = {}
+
+    for sample_index, aSample in enumerate(arrayOfSamples):
 
         #   At a minimum, for each sample we need an ID and a sample type. The other properties are base on whether
         #   this is a streaming job or not.
@@ -225,11 +474,16 @@ def main(args):
                   "] [ERROR] ⚠️ Sample Requirements Error." + str(sample_requirements_key_error))
             exit(1)
 
+        #   FASTQ samples are parsed in the Executors, which needs whole files, so they can't be streamed.
         try:
-            if sample_format.lower() != "tab5":
+            sample_format = sample_format.lower()
+            if sample_format != fastqUtils.FORMAT_TAB5 and \
+                    (use_streaming or sample_format not in fastqUtils.FASTQ_FORMATS):
                 raise ValueError()
         except (ValueError, IndexError):
-            print("] [ERROR] ⚠️ Read Format Error. Only TAB5-formatted read files are supported.")
+            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
+                  "] [ERROR] ⚠️ Read Format Error. Only TAB5-formatted read files can be streamed. Sample files " +
+                  "can also be in FASTQ or interleaved FASTQ format.")
             exit(1)
 
 
@@ -256,6 +510,19 @@ def main(args):
                       "] [ERROR] ⚠️ Stream Directory Key Error. Missing: " + str(stream_dir_key_error))
                 exit(1)
 
+            #   Optional limits on the size of each batch, so that a burst of shard files is spread over several
+            #   batches. See 'modules/flint_batch_control.py'.
+            max_files_per_batch     = aSample.get("max_files_per_batch")
+            max_reads_per_batch     = aSample.get("max_reads_per_batch")
+            target_batch_seconds    = aSample.get("target_batch_seconds")
+
+            if max_files_per_batch is not None:
+                max_files_per_batch = int(max_files_per_batch)
+            if max_reads_per_batch is not None:
+                max_reads_per_batch = int(max_reads_per_batch)
+            if target_batch_seconds is not None:
+                target_batch_seconds = float(target_batch_seconds)
+
         # ----------------------------------- Properties for Streaming from Kinesis -----------------------------------
         elif use_streaming_kinesis:
             try:
@@ -272,12 +539,36 @@ def main(args):
                       "] [ERROR] ⚠️ Stream Kinesis Key Error. Missing: " + str(stream_kinesis_key_error))
                 exit(1)
 
+            #   One receiver per Kinesis shard, unless the configuration says otherwise.
+            kinesis_receivers = aSample.get("kinesis_receivers")
+
+            if kinesis_receivers is None:
+                try:
+                    kinesis_client      = boto3.client('kinesis', region_name=region_name)
+                    kinesis_receivers   = kinesisUtils.get_open_shard_count(kinesis_client, stream_name)
+
+                except Exception as kinesis_error:
+                    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
+                          "] WARNING! Could not look up the shards of the Kinesis stream, using one receiver: " +
+                          str(kinesis_error))
+                    kinesis_receivers = 1
+
 
         # ------------------------------ Properties for local processing (non-streaming) ------------------------------
         else:
             try:
-                mate_1 = aSample["mate_1"]
-                mate_2 = aSample["mate_2"]
+                output_directory    = aSample["output_dir"]
+
+                #   Local, HDFS, or S3 ('s3a://') paths. Paired-end FASTQ samples can come in two mate files instead.
+                sample_file         = aSample.get("sample_file")
+                mate_1              = aSample.get("mate_1")
+                mate_2              = aSample.get("mate_2")
+
+                if sample_file is None and (sample_format != fastqUtils.FORMAT_FASTQ or mate_1 is None):
+                    raise KeyError("sample_file")
+                if sample_file is None and mate_2 is None:
+                    raise KeyError("mate_2")
+
             except KeyError as non_stream_key_error:
                 print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
                       "] [ERROR] ⚠️ Non-Streaming Key Error. Missing: " +
@@ -285,6 +576,33 @@ def main(args):
                 exit(1)
 
 
+        # --------------------------------------------- Streaming State -----------------------------------------------
+        #
+        #   Optional. With a checkpoint directory (HDFS or S3), the rolling profile and the shard files that were read
+        #   are saved after every batch, and a sample that is started again picks up where it left off. The directory
+        #   belongs to the sample, samples that are streamed together share the Streaming context but not their
+        #   checkpoints.
+        #
+        sj.start_sample_state(sampleID)
+
+        if use_streaming:
+            sj.set_checkpoint_dir(aSample.get("checkpoint_dir"))
+
+        if sj.get_checkpoint_dir() is not None:
+            checkpoint_dir = sj.get_checkpoint_dir().rstrip("/")
+
+            if checkpoint_dir in checkpoint_dirs:
+                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
+                      "] [ERROR] ⚠️ Samples " + checkpoint_dirs[checkpoint_dir] + " and " + sampleID +
+                      " have the same checkpoint directory: " + checkpoint_dir)
+                exit(1)
+
+            checkpoint_dirs[checkpoint_dir] = sampleID
+
+            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Checkpoint Directory: " +
+                  sj.get_checkpoint_dir())
+
+
         # ---------------------------------------------- Output Files -------------------------------------------------
         #
         # If we are not saving to AWS S3, then we'll check if the output directory exists — either the default
@@ -323,198 +641,159 @@ def main(args):
             output_file = local_output_directory + "/" + output_file_name
 
 
-        # -------------------------------------------------- Spark ----------------------------------------------------
+        # ----------------------------------------------- Sample Spark ------------------------------------------------
         #
-        #   The following sets the final, and trivial, configurations for the Spark run. Do not set any other flags
-        #   here, as they are ignored in EMR. To set anything, do so with "--conf" in the "spark-submit" call.
+        #   Samples are streamed in groups of '--concurrent_samples'. The samples of a group share a Streaming
+        #   context, with one DStream per sample, and their batches are scheduled in the sample's own fair-scheduler
+        #   pool, so that small samples don't leave the executors idle.
         #
+        if use_streaming:
+            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Batch Duration: " +
+                  str(batch_duration))
+
+        #   Stage metrics are read from Spark's status tracker, so profiling doesn't slow down the run.
+        if stage_profile_file:
+            sj.set_stage_profiler(stageProfiler.StageProfiler(sc, sampleID, stage_profile_file,
+                                                              concurrent_samples=concurrent_samples > 1))
+
+        if metrics_dir:
+            sj.set_metrics_recorder(metricsUtils.MetricsRecorder(sampleID, metrics_dir))
+
+        sample_run = {"sampleID": sampleID,
+                      "output_file": output_file,
+                      "s3_output_bucket": s3_output_bucket,
+                      "dispatch_args": {"sampleID": sampleID,
+                                        "sample_format": sample_format,
+                                        "sample_type": sample_type,
+                                        "output_file": output_file,
+                                        "save_to_s3": save_to_s3,
+                                        "save_to_local": save_to_local,
+                                        "partition_size": partition_size,
+                                        "sensitive_align": sensitive_align,
+                                        "annotations_dictionary": annotations_dictionary,
+                                        "s3_output_bucket": s3_output_bucket,
+                                        "verbose_output": verbose_output,
+                                        "keep_shard_profiles": keep_shard_profiles,
+                                        "coalesce_output": coalesce_output,
+                                        "debug_mode": debug_mode}}
+
+        if use_streaming:
+            sample_run["batch_duration"] = batch_duration
+            sample_run["dispatch_args"].update({"number_of_shards": number_of_shards,
+                                                "streaming_timeout": streaming_timeout})
+        else:
+            sample_run["dispatch_args"].update({"sample_file": sample_file,
+                                                "mate_1": mate_1,
+                                                "mate_2": mate_2})
 
-        #   Name for label that appears in EMR and Spark dashboard output.
-        APP_NAME = "Flint - " + str(sampleID)
-
-        #   Configuration parameters for a Spark run in an EMR cluster.
-        conf = (SparkConf().setAppName(APP_NAME))
-        conf.set("spark.default.parallelism", partition_size)
-        conf.set("spark.executor.memoryOverhead", "1G")
-        conf.set("conf spark.locality.wait", "3s")
-        conf.set("spark.network.timeout", "10000000")
-        conf.set("spark.executor.heartbeatInterval", "10000000")
-
-
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Batch Duration: " +
-              str(batch_duration))
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Configuring Spark...")
-
-        #   Initialize the Spark context for this run.
-        sc = SparkContext(conf=conf)
-
-        sc.addPyFile(os.path.join(os.path.dirname(__file__), 'modules/spark_jobs.py'))
-        sc.addPyFile(os.path.join(os.path.dirname(__file__), 'modules/flint_sample_downloads.py'))
-        sc.addPyFile(os.path.join(os.path.dirname(__file__), 'modules/flint_utilities.py'))
-        sc.addPyFile(os.path.join(os.path.dirname(__file__), 'modules/flint_bowtie2_mapping.py'))
-
-        #   Add the DNA mapping resources
-        sc.addFile(os.path.join(os.path.dirname(__file__), 'services/align_service.py'))
-
-        #   Initialize the Spark Streaming context, this is the main entry point of all Spark Streaming
-        #   functionality.
-        ssc = StreamingContext(sc, batch_duration)
-
-        # -------------------------------------- Stream from a Directory ----------------------------------------------
         if use_streaming_dir:
-            try:
-                sj.dispatch_stream_from_dir(stream_source_dir=stream_source_dir,
-                                            sampleID=sampleID,
-                                            sample_format=sample_format,
-                                            output_file=output_file,
-                                            save_to_s3=save_to_s3,
-                                            save_to_local=save_to_local,
-                                            partition_size=partition_size,
-                                            ssc=ssc,
-                                            sensitive_align=sensitive_align,
-                                            annotations_dictionary=annotations_dictionary,
-                                            s3_output_bucket=s3_output_bucket,
-                                            verbose_output=verbose_output,
-                                            number_of_shards=number_of_shards,
-                                            streaming_timeout=streaming_timeout,
-                                            keep_shard_profiles=keep_shard_profiles,
-                                            coalesce_output=coalesce_output,
-                                            sample_type=sample_type,
-                                            debug_mode=debug_mode
-                                            )
-            except ValueError, e:
-                print(str(e))
-
-
-        # ---------------------------------- Stream from a Kinesis source ---------------------------------------------
+            sample_run["dispatch_args"].update({"stream_source_dir": stream_source_dir,
+                                                "max_files_per_batch": max_files_per_batch,
+                                                "max_reads_per_batch": max_reads_per_batch,
+                                                "target_batch_seconds": target_batch_seconds})
+
         if use_streaming_kinesis:
-            try:
-                sj.dispatch_stream_from_kinesis(sampleID=sampleID,
-                                                sample_format=sample_format,
-                                                output_file=output_file,
-                                                save_to_s3=save_to_s3,
-                                                save_to_local=save_to_local,
-                                                partition_size=partition_size,
-                                                ssc=ssc,
-                                                app_name=app_name,
-                                                stream_name=stream_name,
-                                                endpoint_url=endpoint_url,
-                                                region_name=region_name,
-                                                number_of_shards=number_of_shards,
-                                                streaming_timeout=streaming_timeout,
-                                                sensitive_align=sensitive_align,
-                                                annotations_dictionary=annotations_dictionary,
-                                                s3_output_bucket=s3_output_bucket,
-                                                verbose_output=verbose_output,
-                                                keep_shard_profiles=keep_shard_profiles,
-                                                coalesce_output=coalesce_output,
-                                                sample_type=sample_type,
-                                                debug_mode=debug_mode
-                                                )
-            except ValueError, e:
-                print(str(e))
-
-
-        # -------------------------------------- Coalesced Output Reports ---------------------------------------------
+            sample_run["dispatch_args"].update({"app_name": app_name,
+                                                "stream_name": stream_name,
+                                                "endpoint_url": endpoint_url,
+                                                "region_name": region_name,
+                                                "number_of_receivers": int(kinesis_receivers)})
+
+        sample_group.append(sample_run)
+
+        #   Keep collecting samples until the group is full, or we run out of samples.
+        if len(sample_group) < concurrent_samples and sample_index < len(arrayOfSamples) - 1:
+            continue
+
+        if use_streaming:
+            #   The Streaming context ticks at the shortest batch duration in the group.
+            group_batch_duration = min(sample_run["batch_duration"] for sample_run in sample_group)
+
+            if len(sample_group) > 1:
+                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Streaming " +
+                      str(len(sample_group)) + " Samples Concurrently: " +
+                      ", ".join(sample_run["sampleID"] for sample_run in sample_group) + " (Batch Duration: " +
+                      str(group_batch_duration) + ")")
+
+            #   Initialize the Spark Streaming context, this is the main entry point of all Spark Streaming
+            #   functionality.
+            ssc = StreamingContext(sc, group_batch_duration)
+
+            for sample_run in sample_group:
+
+                # ---------------------------------- Stream from a Directory ------------------------------------------
+                if use_streaming_dir:
+                    try:
+                        sj.dispatch_stream_from_dir(ssc=ssc, **sample_run["dispatch_args"])
+                    except ValueError, e:
+                        print(str(e))
+
+                # ------------------------------ Stream from a Kinesis source -----------------------------------------
+                if use_streaming_kinesis:
+                    try:
+                        sj.dispatch_stream_from_kinesis(ssc=ssc, **sample_run["dispatch_args"])
+                    except ValueError, e:
+                        print(str(e))
+
+            #   Returns once every sample in the group has finished streaming.
+            sj.run_streaming(ssc)
+
+        # ------------------------------------------ Batch Processing -------------------------------------------------
         #
-        #   Reports are written out to either an S3 bucket specified in the initial JSON config file, or to a
-        #   local path in the local filesystem. Note that we map the abundances so that we get a nice
-        #   tab-delimited file, then repartition it so that we only get a single file, and not multiple ones for
-        #   each partition.
+        #   Without a stream, each sample file is profiled in turn, and each uses the whole cluster.
         #
-        if coalesce_output:
-            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                  "] Writing Coalesced Output Reports...")
-
-            #
-            #   Sort the overall abundances so that we can report descending values, or most prominent Strains at top.
-            #   The call to 'sorted()' will return a sorted list of tuples, so if we want the key ('gca_id'), we'll
-            #   need to address the first value in the object, i.e., 'gca_id = sorted_tuple[0]'.
-            #
-            overall_abundances = sj.get_overall_abundaces()
-            sorted_overall_abundances = sorted(overall_abundances.value.items(),
-                                               key=operator.itemgetter(1),
-                                               reverse=True)
-
-            seen_strains = {}   #   Maps a strain's GCA_ID (KEY) to a flag of whether we saw it in the sample.
-            output_list  = []   #   Contains the data that we'll be writing out.
-
-            for sorted_tuple in sorted_overall_abundances:
-                gca_id = sorted_tuple[0]
-                if gca_id in annotations_dictionary:
-                    taxa_id       = annotations_dictionary[gca_id]['taxa_id']
-                    organism_name = annotations_dictionary[gca_id]['organism_name']
-                    output_list.append([str(taxa_id),
-                                        str(gca_id),
-                                        str(organism_name),
-                                        "{0:.4f}".format(sj.OVERALL_ABUNDANCES.value[gca_id])])
-                    seen_strains[gca_id] = 1
-                else:
-                    output_list.append([gca_id, sj.OVERALL_ABUNDANCES.value[gca_id]])
-
-            if report_all:
-                for gca_id in annotations_dictionary:
-                    if gca_id in seen_strains:
-                        continue
-                    else:
-                        taxa_id = annotations_dictionary[gca_id]['taxa_id']
-                        organism_name = annotations_dictionary[gca_id]['organism_name']
-                        output_list.append([str(taxa_id),
-                                            str(gca_id),
-                                            str(organism_name),
-                                            "0.000000"])
-
-
-            # ------------------------------------------ Local Output -------------------------------------------------
-            #
-            #   Save a coalesced 'abundances.txt' output file to the 'local' filesystem of the Master Node.
-            #
-            if save_to_local:
-                if verbose_output:
+        else:
+            for sample_run in sample_group:
+                try:
+                    sj.dispatch_local_job(sc=sc, **sample_run["dispatch_args"])
+                except Exception as sample_error:
                     print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                          "] Saving to local filesystem...")
+                          "] [ERROR] ⚠️ Sample " + sample_run["sampleID"] + " Failed: " + str(sample_error))
+                    sc.stop()
+                    exit(1)
 
-                writer = csv.writer(open(output_file, "wb"), delimiter='\t', lineterminator="\n", quotechar='',
-                                    quoting=csv.QUOTE_NONE)
+        for sample_run in sample_group:
+            sampleID = sample_run["sampleID"]
 
-                for a_line in output_list:
-                    writer.writerow(a_line)
+            # ---------------------------------- Coalesced Output Reports ---------------------------------------------
+            if coalesce_output:
+                write_coalesced_report(sampleID=sampleID,
+                                       output_file=sample_run["output_file"],
+                                       s3_output_bucket=sample_run["s3_output_bucket"],
+                                       strain_table=strain_table,
+                                       annotations_dictionary=annotations_dictionary,
+                                       report_all=report_all,
+                                       save_to_local=save_to_local,
+                                       save_to_s3=save_to_s3,
+                                       verbose_output=verbose_output,
+                                       client=client)
 
-            # -------------------------------------------- S3 Output --------------------------------------------------
-            #
-            #   Save a coalesced 'abundances.txt' output file to the S3 bucket specified.
-            #
-            if save_to_s3:
-                if verbose_output:
-                    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                          "] Saving to S3 bucket...")
+            # -------------------------------------------- Wrap-Up ----------------------------------------------------
+            if sj.get_stage_profiler(sampleID) is not None:
+                sj.get_stage_profiler(sampleID).close()
+                sj.set_stage_profiler(None, sampleID)
 
-                output_df  = pd.DataFrame(output_list)
-                csv_buffer = io.BytesIO()
-                output_df.to_csv(csv_buffer, header=False, sep="\t", index=False)
+            if sj.get_metrics_recorder(sampleID) is not None:
+                sj.get_metrics_recorder(sampleID).close()
+                sj.set_metrics_recorder(None, sampleID)
 
-                response = client.put_object(
-                    Bucket=s3_output_bucket,
-                    Body=csv_buffer.getvalue(),
-                    Key=output_file
-                )
+            run_time = sj.get_analysis_run_time(sampleID)
 
+            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] " + sampleID +
+                  " Analysis Run Time: " + str(timedelta(seconds=run_time)))
+            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Complete.")
+            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "]")
 
-        # ------------------------------------------------ Wrap-Up ----------------------------------------------------
-        start_time  = sj.ANALYSIS_START_TIME
-        end_time    = sj.ANALYSIS_END_TIME
-        run_time    = end_time - start_time
+            #   Nothing of 'this' sample is needed by the next one.
+            sj.finish_sample_state(sampleID)
 
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Analysis Run Time: " +
-                str(timedelta(seconds=run_time)))
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Complete.")
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "]")
+        sample_group = []
 
 
-        # ----------------------------------------------- Spark Stop --------------------------------------------------
-        #
-        #   Shut down the cluster once everything completes.
-        sc.stop()
+    # ------------------------------------------------- Spark Stop ----------------------------------------------------
+    #
+    #   Shut down the cluster once all the samples complete.
+    sc.stop()
 
 
 
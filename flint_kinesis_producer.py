@@ -0,0 +1,451 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# ---------------------------------------------------------------------------------------------------------------------
+#
+#                                       Florida International University
+#
+#   This software is a "Camilo Valdes Work" under the terms of the United States Copyright Act.
+#   Please cite the author(s) in any work or product based on this material.
+#
+#   OBJECTIVE:
+#	    The purpose of this program is to push the tab5 reads of a sample into a Kinesis stream, so that they can be
+#       profiled by Flint as they arrive (see 'flint.py --stream_kinesis').
+#
+#
+#   NOTES:
+#   Please see the dependencies section below for the required libraries (if any).
+#
+#   Many reads are packed into each Kinesis record (see 'flint_kinesis.encode_reads()'), optionally compressed, and
+#   records are sent in batches with 'PutRecords'. Every record gets its own partition key, so records are spread
+#   evenly over the shards of the stream. Records that Kinesis rejects, e.g., because a shard is over its write
+#   limits, are sent again with an exponential backoff.
+#
+#   Once all the reads are in the stream, an end-of-stream control record is sent to every open shard (see
+#   'flint_kinesis.encode_end_of_stream()'), so that Flint can stop as soon as the last reads are profiled. The
+#   '--keep_open' flag leaves the stream open, e.g., when more reads of the sample will be sent later.
+#
+#   The '--reads_per_second' flag caps the rate at which reads are sent. Batches are sent by several threads, with at
+#   most two batches per thread in flight, so the reads file is streamed through in bounded memory.
+#
+#   Any object with the boto3 Kinesis 'put_records()' call can be used as the client. The '--endpoint_url' flag points
+#   the boto3 client at a Kinesis-compatible endpoint (e.g., a local mock), and the '--local_shards' flag sends the
+#   reads to an in-process 'FakeKinesisClient' instead, for load testing the producer itself.
+#
+#   DEPENDENCIES:
+#       • Python
+#       • Boto3
+#
+#   You can check the python modules currently installed in your system by running: python -c "help('modules')"
+#
+#   USAGE:
+#       Run the program with the "--help" flag to see usage instructions, e.g.,
+#
+#       flint_kinesis_producer.py --stream_name flint_tab5_stream --region us-east-1 --tab5_reads reads.tab5
+#
+#	AUTHOR:
+#           Camilo Valdes (camilo@castflyer.com)
+#			Florida International University (FIU)
+#
+#
+# ---------------------------------------------------------------------------------------------------------------------
+
+# 	Python Modules
+import os, sys
+import io
+import argparse
+import time
+import gzip
+import random
+import threading
+import uuid
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
+#   Flint Modules
+sys.path.append(os.path.join(os.path.dirname(__file__), 'modules'))
+import flint_kinesis as kinesisUtils
+
+
+#   Limits of a single 'PutRecords' request.
+MAX_RECORDS_PER_REQUEST = 500
+MAX_BYTES_PER_REQUEST   = 5 * 1024 * 1024
+
+#   Error codes of records (or requests) that can be sent again.
+RETRYABLE_ERRORS = ["ProvisionedThroughputExceededException", "InternalFailure", "ServiceUnavailable",
+                    "ThrottlingException"]
+
+#   Backoff (in sec) before the first retry, and the longest backoff.
+RETRY_BACKOFF       = 0.1
+MAX_RETRY_BACKOFF   = 5.0
+
+
+# ------------------------------------------------- Record Functions --------------------------------------------------
+#
+#
+def open_tab5(file_path):
+    """
+    Opens a tab5 file for reading, decompressing it if it's gzipped.
+    """
+    if file_path.endswith(".gz"):
+        gzip_file = gzip.open(file_path, "rb")
+        return gzip_file if sys.version_info[0] == 2 else io.TextIOWrapper(gzip_file)
+
+    return open(file_path)
+
+
+def read_tab5_files(file_paths):
+    """
+    Reads the tab5 reads of several files, in order.
+    Returns:
+        A generator of tab5-formatted reads, without line breaks.
+    """
+    for file_path in file_paths:
+        with open_tab5(file_path) as tab5_file:
+            for line in tab5_file:
+                read = line.rstrip("\r\n")
+                if read:
+                    yield read
+
+
+def pack_records(reads, reads_per_record, max_record_bytes, compress):
+    """
+    Packs reads into Kinesis record data. A record is closed when it has 'reads_per_record' reads, or when its
+    uncompressed size reaches 'max_record_bytes'.
+    Args:
+        reads:              Iterator over tab5-formatted reads.
+        reads_per_record:   Most reads per record.
+        max_record_bytes:   Most uncompressed bytes per record.
+        compress:           Compress the records with zlib.
+
+    Returns:
+        A generator of (record data, number of reads) tuples.
+    """
+    record_reads = []
+    record_bytes = 0
+
+    for read in reads:
+        read_bytes = len(read) + 1
+
+        if read_bytes > max_record_bytes:
+            raise ValueError("Read larger than " + str(max_record_bytes) + " bytes: " + read[:64])
+
+        if record_reads and (len(record_reads) >= reads_per_record or record_bytes + read_bytes > max_record_bytes):
+            yield kinesisUtils.encode_reads(record_reads, compress), len(record_reads)
+            record_reads = []
+            record_bytes = 0
+
+        record_reads.append(read)
+        record_bytes += read_bytes
+
+    if record_reads:
+        yield kinesisUtils.encode_reads(record_reads, compress), len(record_reads)
+
+
+def batch_records(records, partition_key_prefix):
+    """
+    Groups packed records into 'PutRecords' requests, and gives every record its own partition key, so that records
+    are spread over all the shards of the stream.
+    Args:
+        records:                Iterator over (record data, number of reads) tuples.
+        partition_key_prefix:   Prefix of the partition keys, unique to 'this' run.
+
+    Returns:
+        A generator of (list of records, number of reads) tuples.
+    """
+    batch           = []
+    batch_reads     = 0
+    batch_bytes     = 0
+
+    for record_index, (data, number_of_reads) in enumerate(records):
+        partition_key = partition_key_prefix + "-" + str(record_index)
+        record_bytes = len(data) + len(partition_key)
+
+        if batch and (len(batch) >= MAX_RECORDS_PER_REQUEST or batch_bytes + record_bytes > MAX_BYTES_PER_REQUEST):
+            yield batch, batch_reads
+            batch       = []
+            batch_reads = 0
+            batch_bytes = 0
+
+        batch.append({"Data": data, "PartitionKey": partition_key})
+        batch_reads += number_of_reads
+        batch_bytes += record_bytes
+
+    if batch:
+        yield batch, batch_reads
+
+
+# ------------------------------------------------- Kinesis Functions -------------------------------------------------
+#
+#
+class RateLimiter(object):
+    """
+    Holds back the sender so that, on average, no more than a given number of reads are sent per second.
+    """
+    def __init__(self, reads_per_second):
+        self.reads_per_second   = reads_per_second
+        self.start_time         = time.time()
+        self.reads_sent         = 0
+
+    def wait(self, number_of_reads):
+        if self.reads_per_second <= 0:
+            return
+
+        self.reads_sent += number_of_reads
+        delay = self.start_time + float(self.reads_sent) / self.reads_per_second - time.time()
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+def get_error_code(error):
+    """
+    Error code of a boto3 'ClientError', or None for other exceptions.
+    """
+    return getattr(error, "response", {}).get("Error", {}).get("Code")
+
+
+def put_records(kinesis_client, stream_name, records, max_retries):
+    """
+    Sends a batch of records with 'PutRecords', and sends the records that failed again, with an exponential backoff,
+    until all of them are in the stream.
+    Args:
+        kinesis_client: A boto3 Kinesis client, or a 'FakeKinesisClient'.
+        stream_name:    Kinesis stream name.
+        records:        A list of {"Data": ..., "PartitionKey": ...} records.
+        max_retries:    Most times a record is sent again.
+
+    Returns:
+        The number of retries.
+    """
+    retries = 0
+
+    while True:
+        failed_records = records
+
+        try:
+            response = kinesis_client.put_records(Records=records, StreamName=stream_name)
+
+            if response["FailedRecordCount"] == 0:
+                return retries
+
+            failed_records = [record for record, result in zip(records, response["Records"]) if "ErrorCode" in result]
+            error_codes = set(result["ErrorCode"] for result in response["Records"] if "ErrorCode" in result)
+
+            if not error_codes.issubset(RETRYABLE_ERRORS):
+                raise RuntimeError("Records rejected by Kinesis: " + ", ".join(sorted(error_codes)))
+
+        except Exception as put_error:
+            if get_error_code(put_error) not in RETRYABLE_ERRORS:
+                raise
+
+        if retries >= max_retries:
+            raise RuntimeError(str(len(failed_records)) + " records still failing after " + str(max_retries) +
+                               " retries.")
+
+        #   Full jitter, so that threads throttled by the same shard don't come back at the same time.
+        time.sleep(random.uniform(0, min(RETRY_BACKOFF * 2 ** retries, MAX_RETRY_BACKOFF)))
+
+        records = failed_records
+        retries += 1
+
+
+def send_end_of_stream(kinesis_client, stream_name, number_of_reads, max_retries):
+    """
+    Sends an end-of-stream control record to every open shard of the stream. Each record is sent with the first hash
+    key of its shard, so that it lands on that shard regardless of its partition key.
+    Args:
+        kinesis_client:     A boto3 Kinesis client, or a 'FakeKinesisClient'.
+        stream_name:        Kinesis stream name.
+        number_of_reads:    Number of reads sent to the stream.
+        max_retries:        Most times a record is sent again.
+
+    Returns:
+        The number of shards the control record was sent to.
+    """
+    open_shards = [shard for shard in kinesis_client.list_shards(StreamName=stream_name)["Shards"]
+                   if "EndingSequenceNumber" not in shard.get("SequenceNumberRange", {})]
+
+    records = [{"Data": kinesisUtils.encode_end_of_stream(shard_index, len(open_shards), number_of_reads),
+                "PartitionKey": "end-of-stream",
+                "ExplicitHashKey": shard["HashKeyRange"]["StartingHashKey"]}
+               for shard_index, shard in enumerate(open_shards)]
+
+    put_records(kinesis_client, stream_name, records, max_retries)
+
+    return len(open_shards)
+
+
+def create_kinesis_client(stream_name, region_name, endpoint_url=None, local_shards=0, throttle_local=False):
+    """
+    Creates the client the records are sent with.
+    Args:
+        stream_name:    Kinesis stream name.
+        region_name:    Amazon region name for the Kinesis stream.
+        endpoint_url:   URL of a Kinesis-compatible endpoint, instead of the region's.
+        local_shards:   Send the records to an in-process 'FakeKinesisClient' with this many shards.
+        throttle_local: Apply the Kinesis write limits to the 'FakeKinesisClient'.
+
+    Returns:
+        A boto3 Kinesis client, or a 'FakeKinesisClient'.
+    """
+    if local_shards > 0:
+        kinesis_client = kinesisUtils.FakeKinesisClient(throttle=throttle_local)
+        kinesis_client.create_stream(StreamName=stream_name, ShardCount=local_shards)
+        return kinesis_client
+
+    import boto3
+    return boto3.client('kinesis', region_name=region_name, endpoint_url=endpoint_url)
+
+
+def produce(kinesis_client, stream_name, reads, reads_per_record=500, max_record_bytes=1000000, compress=False,
+            reads_per_second=0, max_retries=8, number_of_threads=4):
+    """
+    Sends reads into a Kinesis stream.
+    Args:
+        kinesis_client:     A boto3 Kinesis client, or any object with its 'put_records()' call.
+        stream_name:        Kinesis stream name.
+        reads:              Iterator over tab5-formatted reads.
+        reads_per_record:   Most reads per record.
+        max_record_bytes:   Most uncompressed bytes per record.
+        compress:           Compress the records with zlib.
+        reads_per_second:   Target rate, 0 for as fast as possible.
+        max_retries:        Most times a record is sent again.
+        number_of_threads:  Number of sender threads.
+
+    Returns:
+        A dictionary with the number of reads, records, bytes, and retries that were sent.
+    """
+    stats       = {"reads": 0, "records": 0, "bytes": 0, "retries": 0}
+    errors      = []
+    stats_lock  = threading.Lock()
+
+    #   At most two batches per thread are in flight, so the reads are not all loaded into memory at once.
+    in_flight   = threading.BoundedSemaphore(2 * number_of_threads)
+    limiter     = RateLimiter(reads_per_second)
+    pool        = ThreadPool(number_of_threads)
+
+    def send_batch(batch, batch_reads):
+        try:
+            retries = put_records(kinesis_client, stream_name, batch, max_retries)
+
+            with stats_lock:
+                stats["reads"]      += batch_reads
+                stats["records"]    += len(batch)
+                stats["bytes"]      += sum(len(record["Data"]) for record in batch)
+                stats["retries"]    += retries
+
+        except Exception as send_error:
+            errors.append(send_error)
+
+        finally:
+            in_flight.release()
+
+    records = pack_records(reads, reads_per_record, max_record_bytes, compress)
+
+    try:
+        for batch, batch_reads in batch_records(records, uuid.uuid4().hex):
+            if errors:
+                break
+
+            limiter.wait(batch_reads)
+            in_flight.acquire()
+            pool.apply_async(send_batch, (batch, batch_reads))
+
+    finally:
+        pool.close()
+        pool.join()
+
+    if errors:
+        raise errors[0]
+
+    return stats
+
+
+# -------------------------------------------------------- Main -------------------------------------------------------
+#
+#
+def main(args):
+    """
+    Main function of the app.
+    Args:
+        args: command line arguments.
+
+    Returns:
+        Nothing.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stream_name", required=True, type=str, help="Kinesis stream name.")
+    parser.add_argument("--region", required=False, type=str, default="us-east-1", help="Amazon region name.")
+    parser.add_argument("--tab5_reads", required=True, type=str, nargs="+",
+                        help="Tab5 file(s) with the reads to send, plain or gzipped.")
+    parser.add_argument("--reads_per_record", required=False, type=int, default=500,
+                        help="Most reads packed into each Kinesis record.")
+    parser.add_argument("--max_record_bytes", required=False, type=int, default=1000000,
+                        help="Most uncompressed bytes per Kinesis record.")
+    parser.add_argument("--compress", action="store_true", required=False, help="Compress the records with zlib.")
+    parser.add_argument("--reads_per_second", required=False, type=float, default=0,
+                        help="Target rate of reads sent per second (0 for as fast as possible).")
+    parser.add_argument("--max_retries", required=False, type=int, default=8,
+                        help="Most times a throttled record is sent again.")
+    parser.add_argument("--threads", required=False, type=int, default=4, help="Number of sender threads.")
+    parser.add_argument("--keep_open", action="store_true", required=False,
+                        help="Don't send the end-of-stream control records after the reads.")
+    parser.add_argument("--endpoint_url", required=False, type=str, default=None,
+                        help="URL of a Kinesis-compatible endpoint to send to, instead of the region's.")
+    parser.add_argument("--local_shards", required=False, type=int, default=0,
+                        help="Send to an in-process fake Kinesis stream with this many shards (load tests).")
+    parser.add_argument("--throttle_local", action="store_true", required=False,
+                        help="Apply the Kinesis shard write limits to the in-process fake stream.")
+    args = parser.parse_args(args)
+
+    if args.max_record_bytes >= kinesisUtils.MAX_RECORD_SIZE:
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] [ERROR] Records must be smaller than " +
+              str(kinesisUtils.MAX_RECORD_SIZE) + " bytes.")
+        exit(1)
+
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] ")
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Stream Name: " + args.stream_name)
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Region: " +
+          (args.region if args.local_shards == 0 else "local (" + str(args.local_shards) + " shards)"))
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Reads per Record: " +
+          str(args.reads_per_record) + (", Compressed" if args.compress else ""))
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Sending reads...")
+
+    kinesis_client = create_kinesis_client(args.stream_name, args.region, args.endpoint_url, args.local_shards,
+                                           args.throttle_local)
+
+    start_time = time.time()
+
+    stats = produce(kinesis_client, args.stream_name, read_tab5_files(args.tab5_reads),
+                    reads_per_record=args.reads_per_record,
+                    max_record_bytes=args.max_record_bytes,
+                    compress=args.compress,
+                    reads_per_second=args.reads_per_second,
+                    max_retries=args.max_retries,
+                    number_of_threads=args.threads)
+
+    elapsed_time = max(time.time() - start_time, 1e-6)
+
+    if not args.keep_open:
+        number_of_shards = send_end_of_stream(kinesis_client, args.stream_name, stats["reads"], args.max_retries)
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] End of Stream sent to " +
+              str(number_of_shards) + " shards.")
+
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Reads: " +
+          '{:0,.0f}'.format(stats["reads"]) + ", Records: " + '{:0,.0f}'.format(stats["records"]) +
+          ", Data: " + '{:0,.1f}'.format(stats["bytes"] / (1024.0 * 1024.0)) + " MB, Retries: " +
+          '{:0,.0f}'.format(stats["retries"]))
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Time: " +
+          str(timedelta(seconds=elapsed_time)) + ", " + '{:0,.0f}'.format(stats["reads"] / elapsed_time) +
+          " Reads/sec")
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Done.")
+
+
+
+# ----------------------------------------------------------- Init ----------------------------------------------------
+#
+#   App Initializer.
+#
+if __name__ == "__main__":
+    main(sys.argv[1:])
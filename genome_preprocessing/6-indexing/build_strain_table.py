@@ -0,0 +1,82 @@
+#!/bin/python
+
+# ---------------------------------------------------------------------------------------------------------------------
+#
+#                                   	Bioinformatics Research Group
+#										   http://biorg.cis.fiu.edu/
+#                             		  Florida International University
+#
+#   This software is a "Camilo Valdes Work" under the terms of the United States Copyright Act.
+#   Please cite the author(s) in any work or product based on this material.
+#
+#   OBJECTIVE:
+#	The purpose of this script is to build the strain table of a Bowtie2 index: a tab-delimited file that maps every
+#	contig (FASTA record) in the index to an integer strain ID. Flint broadcasts the table once per run, and uses it
+#	to handle alignments as integers.
+#
+#   NOTES:
+#   Please see the dependencies and/or assertions section below for any requirements.
+#
+#	The FASTA records must have the headers written by '4-fasta_concatenation/concatenate.py'. The output format is
+#	described in 'modules/flint_strain_table.py'. Upload the table to S3 and add it to the run configuration as:
+#
+#		"strain_table": { "bucket": "bucket-name", "path": "path/to/strain_table.txt" }
+#
+#   DEPENDENCIES:
+#
+#		* Python
+#
+#
+#	AUTHORS:	Camilo Valdes (cvalde03@fiu.edu)
+#				Bioinformatics Research Group,
+#				School of Computing and Information Sciences,
+#				Florida International University (FIU)
+#
+# ---------------------------------------------------------------------------------------------------------------------
+
+import os, sys
+import argparse
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../modules'))
+import flint_strain_table as strainTable
+
+print("build_strain_table.py starting..")
+start = time.time()
+# ---------------------------------------------- Variables initialization ----------------------------------------------
+#
+# 	Pick up the command line arguments
+#
+#
+parser = argparse.ArgumentParser()
+parser.add_argument( "--fasta_files", required=True, nargs="+", type=str, help="FASTA files that were indexed" )
+parser.add_argument( "--output_file", required=True, type=str, help="Path of the strain table" )
+
+args = parser.parse_args()
+
+# ---------------------------------------------------- Functions --------------------------------------------------------
+
+def read_fasta_record_names(fasta_file):
+    with open(fasta_file) as fasta_handle:
+        for a_line in fasta_handle:
+            if a_line.startswith(">"):
+                #	Bowtie2 reports the record name up to the first whitespace as the RNAME.
+                yield a_line[1:].split()[0]
+# ---------------------------------------------------------------------------------------------------------------------
+
+# ------------------------------------------------------ Main ---------------------------------------------------------
+
+reference_names = []
+for fasta in args.fasta_files:
+    reference_names.extend(read_fasta_record_names(fasta))
+
+strain_table_rows = strainTable.build_strain_table(reference_names)
+
+with open(args.output_file, "w") as output_handle:
+    for contig_name, strain_id, strain_name in strain_table_rows:
+        output_handle.write(contig_name + "\t" + str(strain_id) + "\t" + strain_name + "\n")
+
+print("Contigs: {:,}, Strains: {:,}".format(len(strain_table_rows), len(set(row[1] for row in strain_table_rows))))
+print("Done building strain table. Computational time is {:,.2f} min.".format((time.time() - start)/60))
+
+# ---------------------------------------------------------------------------------------------------------------------
@@ -60,5 +60,11 @@ for PARTITION in ${PARTITIONS_ARRAY[@]}; do
 	FASTA_FILE=$OUTPUT_DIR"/"$INDEX_NAME".fasta"
 	bowtie2-build -f --threads $NUMBER_OF_THREADS $FASTA_FILE $OUTPUT_DIR"/"$INDEX_NAME
 done
+
+# The strain table maps every contig in the index to an integer strain ID (see 'build_strain_table.py').
+echo "	[" `date '+%m/%d/%y %H:%M:%S'` "] building strain table"
+python $SCRIPTS_DIR"/6-indexing/build_strain_table.py" \
+	--fasta_files $BASE_DIR"/partitions_"$NUMBER_OF_PARTITIONS/*/$INDEX_NAME".fasta" \
+	--output_file $BASE_DIR"/partitions_"$NUMBER_OF_PARTITIONS"/strain_table.txt"
 echo "[" `date '+%m/%d/%y %H:%M:%S'` "] Done." >> time_log.txt
 
@@ -0,0 +1,448 @@
+# coding: utf-8
+# ---------------------------------------------------------------------------------------------------------------------
+#
+#                                       Florida International University
+#
+#   This software is a "Camilo Valdes Work" under the terms of the United States Copyright Act.
+#   Please cite the author(s) in any work or product based on this material.
+#
+#   OBJECTIVE:
+#	The purpose of this file is to turn the read alignments of a shard into strain-level abundances.
+#
+#
+#   NOTES:
+#   Please see the dependencies section below for the required libraries (if any).
+#
+#   Each alignment of a read contributes '1 / (number of alignments of the read)' to the genomic assembly it aligned
+#   to, and assemblies are then folded up into their strain. Instead of computing this with a chain of 'reduceByKey()'
+#   and 'join()' calls, we hash-partition the alignments by read ID once, so that all the hits of a read end up in
+#   the same partition. Before the shuffle, the alignments of each partition are compressed into one record per read
+#   (read ID, strain IDs), and after it, reads that hit exactly the same strains are collapsed into an 'equivalence
+#   class' with a count. Only the (small) class dictionaries are brought back with a tree reduce, and the abundances
+#   are computed from them in the driver. Alignments arrive already encoded as (read ID, strain ID) integer pairs
+#   (see 'flint_strain_table.py').
+#
+#   The original chain is kept in 'legacy_strain_abundances()' for benchmarking
+#   (see 'utilities/benchmark_abundance_engine.py').
+#
+#   Alternatively, abundances can be estimated with Expectation-Maximization (EM), which re-assigns the reads that
+#   align to several strains according to how abundant each of those strains is. The EM iterations run on a sparse
+#   class x strain matrix built from the same equivalence classes, instead of on the reads.
+#
+#   DEPENDENCIES:
+#
+#       • Apache-Spark
+#       • NumPy
+#       • SciPy (only for the EM abundance model)
+#       • Python & the modules listed below
+#
+#   You can check the python modules currently installed in your system by running: python -c "help('modules')"
+#
+#   USAGE:
+#       Run the program with the "--help" flag to see usage instructions.
+#
+#	AUTHOR:
+#           Camilo Valdes (camilo@castflyer.com)
+#			Florida International University (FIU)
+#
+#
+# ---------------------------------------------------------------------------------------------------------------------
+
+# 	Python Modules
+import os, sys
+import time
+from datetime import timedelta
+import itertools
+import numpy as np
+
+#   Flint Modules
+from flint_strain_table import get_strain_key, UNKNOWN_STRAIN_ID
+
+
+
+# ------------------------------------------------ Partition Engine ---------------------------------------------------
+#
+
+def compress_alignments_by_read(iterator):
+    """
+    Function that runs on ALL worker nodes (Executors), BEFORE the shuffle. Collapses the alignments of a partition
+    into one record per read, with the IDs of all the strains the read hit in the partition, so that a read that
+    aligns to many assemblies is shuffled once instead of once per alignment.
+    Args:
+        iterator:   (read ID, strain ID) tuples of a partition, as they come out of the aligner.
+
+    Returns:
+        A generator of (read ID, tuple of strain IDs) records. Repeated strain IDs are kept, since each alignment of
+        a read counts in the fractional model.
+    """
+    read_to_strains = {}
+
+    for read_id, strain_id in iterator:
+        strains = read_to_strains.get(read_id)
+        if strains is None:
+            read_to_strains[read_id] = [strain_id]
+        else:
+            strains.append(strain_id)
+
+    for read_id, strains in read_to_strains.items():
+        yield read_id, tuple(strains)
+
+
+def partition_alignments_by_read(alignments_RDD, number_of_partitions):
+    """
+    Compresses the alignments of each partition by read, and hash-partitions the records by read ID, so that all the
+    hits of a read are in the same partition. This is the only shuffle of the abundance calculation.
+    Args:
+        alignments_RDD:         RDD of (read ID, strain ID) tuples.
+        number_of_partitions:   Number of partitions after the shuffle.
+
+    Returns:
+        RDD of (read ID, tuple of strain IDs) records, partitioned by read ID.
+    """
+    return alignments_RDD.mapPartitions(compress_alignments_by_read)\
+                         .partitionBy(number_of_partitions)
+
+
+def partial_equivalence_classes(iterator):
+    """
+    Function that runs on ALL worker nodes (Executors), AFTER the shuffle. Joins the hits of each read (a read may
+    have been aligned against several index shards), and collapses the reads of the partition into equivalence
+    classes, i.e., the distinct sets of strains that reads hit, with the number of reads in each.
+    Args:
+        iterator:   (read ID, tuple of strain IDs) records of a partition produced by 'partition_alignments_by_read()'.
+
+    Returns:
+        A list with a single (equivalence classes dictionary, number of reads aligned) tuple. The dictionary has a
+        sorted tuple of strain IDs as KEY, and the number of reads as VALUE.
+    """
+    read_to_strains = {}
+
+    for read_id, strains in iterator:
+        read_strains = read_to_strains.get(read_id)
+        if read_strains is None:
+            read_to_strains[read_id] = strains
+        else:
+            read_to_strains[read_id] = read_strains + strains
+
+    equivalence_classes = {}
+
+    for strains in read_to_strains.values():
+        hit_set = tuple(sorted(strains))
+        equivalence_classes[hit_set] = equivalence_classes.get(hit_set, 0) + 1
+
+    return [(equivalence_classes, len(read_to_strains))]
+
+
+def merge_equivalence_classes(partial_1, partial_2):
+    """
+    Adds up two partial results of 'partial_equivalence_classes()'. The larger dictionary is updated in place.
+    Args:
+        partial_1:  A (equivalence classes dictionary, number of reads aligned) tuple.
+        partial_2:  A (equivalence classes dictionary, number of reads aligned) tuple.
+
+    Returns:
+        The merged (equivalence classes dictionary, number of reads aligned) tuple.
+    """
+    classes_1, reads_1 = partial_1
+    classes_2, reads_2 = partial_2
+
+    if len(classes_1) < len(classes_2):
+        classes_1, classes_2 = classes_2, classes_1
+
+    for hit_set, count in classes_2.items():
+        classes_1[hit_set] = classes_1.get(hit_set, 0) + count
+
+    return classes_1, reads_1 + reads_2
+
+
+def compute_equivalence_classes(alignments_RDD, number_of_partitions, debug_mode=False):
+    """
+    Collapses the alignments of a shard into equivalence classes with a single shuffle and a tree reduce.
+    Args:
+        alignments_RDD:         RDD of (read ID, strain ID) tuples.
+        number_of_partitions:   Number of partitions to shuffle the alignments into.
+        debug_mode:             Flag for debug mode. Prints the equivalence class and EM diagnostics.
+
+    Returns:
+        A (equivalence classes dictionary, number of reads aligned) tuple, in the driver.
+    """
+    alignments_by_read = partition_alignments_by_read(alignments_RDD, number_of_partitions)
+
+    partial_classes = alignments_by_read.mapPartitions(partial_equivalence_classes)
+
+    equivalence_classes, number_of_reads_aligned = \
+        partial_classes.treeAggregate(({}, 0), merge_equivalence_classes, merge_equivalence_classes)
+
+    if debug_mode:
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] • " +
+              '{:0,.0f}'.format(number_of_reads_aligned) + " Reads in " +
+              '{:0,.0f}'.format(len(equivalence_classes)) + " Equivalence Classes")
+
+    return equivalence_classes, number_of_reads_aligned
+
+
+def strain_abundances_from_classes(equivalence_classes, number_of_strains):
+    """
+    Calculates the fractional strain abundances from equivalence classes. Each read of a class contributes
+    '1 / (number of alignments of the read)' to every strain it aligned to.
+    Args:
+        equivalence_classes:    Dictionary with a tuple of strain IDs as KEY, and the number of reads as VALUE.
+        number_of_strains:      Size of the abundance vector.
+
+    Returns:
+        A vector with the abundance of each strain ID.
+    """
+    if not equivalence_classes:
+        return np.zeros(number_of_strains, dtype=np.float64)
+
+    hit_sets    = list(equivalence_classes.keys())
+    class_sizes = np.array([len(hit_set) for hit_set in hit_sets], dtype=np.int64)
+
+    class_contributions = np.array([equivalence_classes[hit_set] for hit_set in hit_sets],
+                                   dtype=np.float64) / class_sizes
+
+    strain_ids = np.fromiter(itertools.chain.from_iterable(hit_sets), dtype=np.int64, count=class_sizes.sum())
+
+    return np.bincount(strain_ids, weights=np.repeat(class_contributions, class_sizes), minlength=number_of_strains)
+
+
+def count_multimapped_reads(equivalence_classes):
+    """
+    Counts the reads that aligned to more than one strain.
+    Args:
+        equivalence_classes:    Dictionary with a tuple of strain IDs as KEY, and the number of reads as VALUE.
+
+    Returns:
+        The number of multi-mapped reads.
+    """
+    return sum(count for hit_set, count in equivalence_classes.items() if len(set(hit_set)) > 1)
+
+
+def compute_strain_abundances(alignments_RDD, number_of_partitions, number_of_strains, debug_mode=False):
+    """
+    Calculates the strain-level abundances of a shard. See 'compute_equivalence_classes()'.
+    Args:
+        alignments_RDD:         RDD of (read ID, strain ID) tuples.
+        number_of_partitions:   Number of partitions to shuffle the alignments into.
+        number_of_strains:      Size of the abundance vector, see 'StrainTable.get_number_of_strains()'.
+        debug_mode:             Flag for debug mode. Prints the equivalence class and EM diagnostics.
+
+    Returns:
+        A (strain abundances vector indexed by strain ID, number of reads aligned, number of multi-mapped reads)
+        tuple, in the driver.
+    """
+    equivalence_classes, number_of_reads_aligned = compute_equivalence_classes(alignments_RDD, number_of_partitions,
+                                                                               debug_mode=debug_mode)
+
+    return strain_abundances_from_classes(equivalence_classes, number_of_strains), number_of_reads_aligned, \
+        count_multimapped_reads(equivalence_classes)
+
+
+
+# -------------------------------------------------- EM Estimation ----------------------------------------------------
+#
+
+ABUNDANCE_MODEL_FRACTIONAL  = "fractional"
+ABUNDANCE_MODEL_EM          = "em"
+
+EM_MAX_ITERATIONS   = 200
+EM_TOLERANCE        = 1e-6
+
+
+def collapse_repeated_hits(equivalence_classes):
+    """
+    Drops the repeated strain IDs of the equivalence classes, e.g., of a read that aligned to two assemblies of the
+    same strain. EM only cares about WHICH strains a read is compatible with.
+    Args:
+        equivalence_classes:    Dictionary with a sorted tuple of strain IDs as KEY, and the number of reads as VALUE.
+
+    Returns:
+        A dictionary with the same structure, whose keys have no repeated strain IDs.
+    """
+    collapsed_classes = {}
+
+    for hit_set, count in equivalence_classes.items():
+        strain_set = tuple(sorted(set(hit_set)))
+        collapsed_classes[strain_set] = collapsed_classes.get(strain_set, 0) + count
+
+    return collapsed_classes
+
+
+def estimate_abundances_em(equivalence_classes, number_of_strains, initial_abundances=None,
+                           max_iterations=EM_MAX_ITERATIONS, tolerance=EM_TOLERANCE):
+    """
+    Estimates strain abundances from equivalence classes with Expectation-Maximization. In each iteration, the reads
+    of a class are split among its strains in proportion to the current abundances of those strains (E-step), and the
+    abundances are then re-computed from the split reads (M-step).
+    Args:
+        equivalence_classes:    Dictionary with a tuple of strain IDs as KEY, and the number of reads as VALUE.
+        number_of_strains:      Size of the abundance vector.
+        initial_abundances:     Optional vector to warm-start from, e.g., the abundances of the previous batch.
+        max_iterations:         Maximum number of EM iterations.
+        tolerance:              The iterations stop once the abundances (as fractions) change less than this.
+
+    Returns:
+        A (vector with the estimated number of reads of each strain ID, number of iterations) tuple.
+    """
+    import scipy.sparse as sparse
+
+    abundances = np.zeros(number_of_strains, dtype=np.float64)
+
+    if not equivalence_classes:
+        return abundances, 0
+
+    hit_sets        = list(equivalence_classes.keys())
+    class_counts    = np.array([equivalence_classes[hit_set] for hit_set in hit_sets], dtype=np.float64)
+    class_sizes     = np.array([len(hit_set) for hit_set in hit_sets], dtype=np.int64)
+
+    class_rows      = np.repeat(np.arange(len(hit_sets)), class_sizes)
+    strain_columns  = np.fromiter(itertools.chain.from_iterable(hit_sets), dtype=np.int64, count=class_sizes.sum())
+
+    #   Class x Strain compatibility matrix, 1 where the reads of a class hit a strain.
+    compatibility   = sparse.csr_matrix((np.ones(len(strain_columns), dtype=np.float64), (class_rows, strain_columns)),
+                                        shape=(len(hit_sets), number_of_strains))
+    compatibility_t = compatibility.T.tocsr()
+
+    total_reads = class_counts.sum()
+
+    #   Start with every strain that was hit on equal footing. When warm-starting, we blend in the previous
+    #   abundances, but keep the uniform part so that strains that were not seen before can still be picked up.
+    hit_strains = np.zeros(number_of_strains, dtype=np.float64)
+    hit_strains[strain_columns] = 1.0
+    theta = hit_strains / hit_strains.sum()
+
+    if initial_abundances is not None and initial_abundances.sum() > 0:
+        theta = 0.5 * theta + 0.5 * (initial_abundances / initial_abundances.sum())
+
+    iteration = 0
+    for iteration in range(1, max_iterations + 1):
+        class_totals = compatibility.dot(theta)
+
+        #   Classes whose strains all dropped to zero can't be split, they are left out of 'this' iteration.
+        class_weights = np.divide(class_counts, class_totals, out=np.zeros_like(class_counts), where=class_totals > 0)
+
+        new_theta = theta * compatibility_t.dot(class_weights)
+        new_theta = new_theta / new_theta.sum()
+
+        change = np.abs(new_theta - theta).sum()
+        theta  = new_theta
+
+        if change < tolerance:
+            break
+
+    abundances = theta * total_reads
+
+    return abundances, iteration
+
+
+def compute_strain_abundances_em(alignments_RDD, number_of_partitions, number_of_strains, initial_abundances=None,
+                                 debug_mode=False):
+    """
+    Estimates the strain-level abundances of a shard with EM. The equivalence classes of the shard (see
+    'compute_equivalence_classes()') are handed to 'estimate_abundances_em()' in the driver.
+    Args:
+        alignments_RDD:         RDD of (read ID, strain ID) tuples.
+        number_of_partitions:   Number of partitions to shuffle the alignments into.
+        number_of_strains:      Size of the abundance vector, see 'StrainTable.get_number_of_strains()'.
+        initial_abundances:     Optional vector to warm-start the EM iterations from.
+        debug_mode:             Flag for debug mode. Prints the equivalence class and EM diagnostics.
+
+    Returns:
+        A (strain abundances vector indexed by strain ID, number of reads aligned, number of multi-mapped reads)
+        tuple, in the driver.
+    """
+    equivalence_classes, number_of_reads_aligned = compute_equivalence_classes(alignments_RDD, number_of_partitions,
+                                                                               debug_mode=debug_mode)
+
+    equivalence_classes = collapse_repeated_hits(equivalence_classes)
+
+    em_start_time = time.time()
+
+    strain_abundances, iterations = estimate_abundances_em(equivalence_classes, number_of_strains,
+                                                           initial_abundances=initial_abundances)
+
+    if debug_mode:
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] • EM: " +
+              '{:0,.0f}'.format(len(equivalence_classes)) + " Equivalence Classes, " + str(iterations) +
+              " Iterations")
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
+              "]   TIME: " + str(timedelta(seconds=(time.time() - em_start_time))))
+
+    return strain_abundances, number_of_reads_aligned, count_multimapped_reads(equivalence_classes)
+
+
+
+# ------------------------------------------------- Legacy Engine -----------------------------------------------------
+#
+
+def legacy_strain_abundances(alignments_RDD):
+    """
+    The original abundance calculation: three shuffles and a join on string keys. Kept for benchmarking, it works on
+    the un-encoded alignments.
+    Args:
+        alignments_RDD: RDD of (QNAME, RNAME) tuples.
+
+    Returns:
+        RDD of (strain, abundance) tuples.
+    """
+    map_reads_to_genomes = alignments_RDD.map(lambda alignment: (alignment[0], [alignment[1]]))
+
+    reads_to_genomes_list = map_reads_to_genomes.reduceByKey(lambda l1, l2: l1 + l2)
+
+    read_contributions = reads_to_genomes_list.mapValues(lambda l1: 1 / float(len(l1)))
+
+    read_contribution_to_genome = read_contributions.join(map_reads_to_genomes)\
+                                                    .map(lambda l: (l[1][0], "".join(l[1][1])))
+
+    genomes_to_read_contributions = read_contribution_to_genome.map(lambda x: (x[1], x[0]))
+
+    genomic_assembly_abundances = genomes_to_read_contributions.reduceByKey(lambda l1, l2: l1 + l2)
+
+    strain_map = genomic_assembly_abundances.map(lambda x: (get_strain_key(x[0]), x[1]))
+
+    return strain_map.reduceByKey(lambda l1, l2: l1 + l2)
+
+
+
+# ------------------------------------------------- Rolling Profile ---------------------------------------------------
+#
+
+def format_profile_snapshot(rolling_profile, strain_table):
+    """
+    Formats a rolling profile for saving. Strains are written by name, so that a snapshot stays valid if the strain
+    IDs change.
+    Args:
+        rolling_profile:    Vector with the rolling abundance of each strain ID.
+        strain_table:       The 'StrainTable' object of the run.
+
+    Returns:
+        A list of "strain name\\tabundance\\n" lines.
+    """
+    return [strain_table.get_strain_name(strain_id) + "\t" + repr(float(rolling_profile[strain_id])) + "\n"
+            for strain_id in np.flatnonzero(rolling_profile)]
+
+
+def parse_profile_snapshot(snapshot_lines, strain_table):
+    """
+    Parses a rolling profile saved by 'format_profile_snapshot()'. Strains that are no longer in the strain table are
+    added to the 'unknown' strain.
+    Args:
+        snapshot_lines:     An iterable of "strain name\\tabundance" lines.
+        strain_table:       The 'StrainTable' object of the run.
+
+    Returns:
+        Vector with the rolling abundance of each strain ID.
+    """
+    rolling_profile = np.zeros(strain_table.get_number_of_strains(), dtype=np.float64)
+
+    for a_line in snapshot_lines:
+        a_line = a_line.strip()
+        if not a_line:
+            continue
+
+        strain_name, abundance = a_line.split("\t")
+        strain_id = strain_table.strain_to_id.get(strain_name, UNKNOWN_STRAIN_ID)
+
+        rolling_profile[strain_id] += float(abundance)
+
+    return rolling_profile
@@ -0,0 +1,146 @@
+# coding: utf-8
+# ---------------------------------------------------------------------------------------------------------------------
+#
+#                                       Florida International University
+#
+#   This software is a "Camilo Valdes Work" under the terms of the United States Copyright Act.
+#   Please cite the author(s) in any work or product based on this material.
+#
+#   OBJECTIVE:
+#	The purpose of this file is to size the batches of a directory stream, so that a burst of shard files is spread
+#   over several batches instead of being aligned all at once.
+#
+#
+#   NOTES:
+#   Please see the dependencies section below for the required libraries (if any).
+#
+#   A batch takes the oldest files in the stream directory, up to the limits below. Files that don't fit wait in the
+#   directory for a later batch, and a batch always takes at least one file, as files are not split.
+#
+#       • 'max_files':      Most shard files in a batch.
+#       • 'max_reads':      Most reads in a batch. Reads are estimated from the size of the files, with the bytes per
+#                           read measured on the batches that were already aligned.
+#       • 'target_seconds': Alignment time to aim for. After every batch, the reads per second that the cluster
+#                           aligned are measured, and the read budget of the next batch is set so that it would take
+#                           about 'target_seconds'. The budget grows by at most 'MAX_BUDGET_GROWTH' times the reads of
+#                           the last batch, as small batches have a larger share of fixed costs.
+#
+#   Until the first batch has been measured, batches with a read limit take a single file.
+#
+#   DEPENDENCIES:
+#
+#       • Python & the modules listed below
+#
+#   You can check the python modules currently installed in your system by running: python -c "help('modules')"
+#
+#   USAGE:
+#       Run the program with the "--help" flag to see usage instructions.
+#
+#	AUTHOR:
+#           Camilo Valdes (camilo@castflyer.com)
+#			Florida International University (FIU)
+#
+#
+# ---------------------------------------------------------------------------------------------------------------------
+
+#   Weight of the newest measurement in the running averages.
+SMOOTHING           = 0.5
+
+#   Most the read budget can grow over the reads of the last batch.
+MAX_BUDGET_GROWTH   = 2.0
+
+
+def smooth(average, measurement):
+    """
+    Exponentially weighted moving average, that starts at the first measurement.
+    """
+    if average is None:
+        return measurement
+
+    return SMOOTHING * measurement + (1.0 - SMOOTHING) * average
+
+
+class BatchSizeController(object):
+    """
+    Picks the shard files of each batch of a directory stream, and adapts the read budget of the batches to the
+    measured alignment time.
+
+    """
+    def __init__(self, max_files=None, max_reads=None, target_seconds=None):
+        self.max_files          = max_files
+        self.max_reads          = max_reads
+        self.target_seconds     = target_seconds
+
+        self.bytes_per_read     = None
+        self.reads_per_second   = None
+        self.read_budget        = None
+
+    def get_read_budget(self):
+        """
+        Returns:
+            The most reads that the next batch should have, or None if there is no read limit.
+        """
+        read_budgets = [read_budget for read_budget in [self.max_reads, self.read_budget] if read_budget is not None]
+
+        if not read_budgets:
+            return None
+
+        return min(read_budgets)
+
+    def select_files(self, stream_files):
+        """
+        Picks the files of the next batch.
+        Args:
+            stream_files:   List of (path, size in bytes) tuples of the files that are waiting, oldest first.
+
+        Returns:
+            The (path, size in bytes) tuples of the files to read in the batch.
+        """
+        byte_budget = None
+
+        if self.max_reads is not None or self.target_seconds is not None:
+            byte_budget = 0
+
+            #   Nothing measured yet, so the batch takes a single file.
+            if self.bytes_per_read is not None and self.get_read_budget() is not None:
+                byte_budget = self.get_read_budget() * self.bytes_per_read
+
+        batch_files = []
+        batch_bytes = 0
+
+        for file_path, file_size in stream_files:
+            if self.max_files is not None and len(batch_files) >= self.max_files:
+                break
+
+            if batch_files and byte_budget is not None and batch_bytes + file_size > byte_budget:
+                break
+
+            batch_files.append((file_path, file_size))
+            batch_bytes += file_size
+
+        return batch_files
+
+    def update(self, batch_reads, batch_bytes, alignment_seconds):
+        """
+        Measures an aligned batch, and sets the read budget of the next one.
+        Args:
+            batch_reads:        Number of reads in the batch.
+            batch_bytes:        Size of the batch's files, in bytes. None if unknown.
+            alignment_seconds:  Time taken to align the batch and compute its abundances.
+
+        Returns:
+            Nothing.
+        """
+        if batch_reads <= 0:
+            return
+
+        if batch_bytes:
+            self.bytes_per_read = smooth(self.bytes_per_read, float(batch_bytes) / batch_reads)
+
+        if self.target_seconds is None or alignment_seconds <= 0:
+            return
+
+        self.reads_per_second = smooth(self.reads_per_second, float(batch_reads) / alignment_seconds)
+
+        self.read_budget = max(int(min(self.reads_per_second * self.target_seconds,
+                                       batch_reads * MAX_BUDGET_GROWTH)), 1)
@@ -36,6 +36,14 @@
 # 	Python Modules
 import os, sys
 import time
+import json
+import errno
+import fcntl
+import hashlib
+import socket
+import re
+import threading
+import subprocess as sp
 
 
 # -------------------------------------------- Bowtie2 Mapping Functions ----------------------------------------------
@@ -49,3 +57,485 @@ def mapSampleWithBowtie(sampleFASTQFile):
     """
 
     print("[ " + time.strftime('%d-%b-%Y %H:%M:%S',time.localtime()) + " ]  Mapping Sample...")
+
+
+
+# ------------------------------------------- Persistent Bowtie2 Service ----------------------------------------------
+#
+#   The functions below talk to the resident Bowtie2 aligner in 'services/align_service.py'. There is one service per
+#   index shard on each worker node, and it is shared by all the Executors (and tasks) running on that node.
+#
+
+ALIGN_SERVICE_STARTUP_TIMEOUT = 1800     # Seconds. Loading a large index shard can take a while.
+
+
+def get_align_service_socket(bowtie2_cmd):
+    """
+    Builds the path of the UNIX socket for the alignment service that runs a given Bowtie2 command. Executors that
+    share a node, an index shard, and Bowtie2 settings will share the same socket (and service).
+    Args:
+        bowtie2_cmd:    The Bowtie2 command (a list) that the service runs.
+
+    Returns:
+        A string with the path of the UNIX socket.
+    """
+    cmd_hash = hashlib.md5(" ".join(bowtie2_cmd).encode('utf-8')).hexdigest()[:12]
+
+    return "/tmp/flint-bowtie2-" + cmd_hash + ".sock"
+
+
+def get_align_service_command(bowtie2_cmd):
+    """
+    Adapts a regular Bowtie2 command so that it can be used by the alignment service. The service needs the output
+    in the same order as the input ('--reorder'), and it needs unaligned reads reported so it can see the sentinel
+    read at the end of each batch. Unaligned reads are filtered out by the service itself.
+    Args:
+        bowtie2_cmd:    A Bowtie2 command, as returned by 'getBowtie2Command()'.
+
+    Returns:
+        A list with the Bowtie2 command for the service.
+    """
+    service_cmd = [an_arg for an_arg in bowtie2_cmd if an_arg != "--no-unal"]
+    service_cmd.insert(1, "--reorder")
+
+    return service_cmd
+
+
+def connect_to_align_service(socket_path):
+    """
+    Opens a connection to a running alignment service.
+    Args:
+        socket_path:    Path of the service's UNIX socket.
+
+    Returns:
+        A connected socket, or None if no service is listening on 'socket_path'.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except socket.error as e:
+        client.close()
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return None
+        raise
+
+    return client
+
+
+def ensure_align_service(service_script, bowtie2_cmd):
+    """
+    Connects to the alignment service for 'bowtie2_cmd' on this node, starting it first if it is not running. A lock
+    file makes sure that concurrent tasks on the same node start a single service.
+    Args:
+        service_script: Path to 'align_service.py' in the Executor (from 'SparkFiles.get()').
+        bowtie2_cmd:    The Bowtie2 command (a list) for the service, see 'get_align_service_command()'.
+
+    Returns:
+        A socket connected to the service.
+    """
+    socket_path = get_align_service_socket(bowtie2_cmd)
+
+    client = connect_to_align_service(socket_path)
+    if client is not None:
+        return client
+
+    with open(socket_path + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        try:
+            #   Someone else might have started it while we waited for the lock.
+            client = connect_to_align_service(socket_path)
+
+            if client is None:
+                service_log = open(socket_path + ".log", "a")
+                sp.Popen([sys.executable, service_script,
+                          "--socket", socket_path,
+                          "--bowtie2_cmd", json.dumps(bowtie2_cmd)],
+                         stdin=open(os.devnull), stdout=service_log, stderr=service_log,
+                         preexec_fn=os.setsid, close_fds=True)
+
+                wait_start_time = time.time()
+                while client is None:
+                    if time.time() - wait_start_time > ALIGN_SERVICE_STARTUP_TIMEOUT:
+                        raise RuntimeError("Bowtie2 service did not start. See: " + socket_path + ".log")
+                    time.sleep(0.5)
+                    client = connect_to_align_service(socket_path)
+
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    return client
+
+
+def align_with_service(reads, service_script, bowtie2_cmd, strain_table=None, alignment_stats=None):
+    """
+    Aligns a batch of tab5 reads with the resident Bowtie2 service of this node. The reads are sent from a separate
+    thread, and the alignments are yielded as they come back from the service.
+    Args:
+        reads:          An iterable of tab5-formatted reads.
+        service_script: Path to 'align_service.py' in the Executor.
+        bowtie2_cmd:    The Bowtie2 command (a list) for the service, see 'get_align_service_command()'.
+        strain_table:   Optional 'StrainTable' for encoding the alignments, see 'parse_sam_alignments()'.
+        alignment_stats:    Optional stats record for the multi-mapped reads, see 'parse_sam_alignments()'.
+
+    Returns:
+        A generator of alignment tuples for the reads that aligned.
+    """
+    client = ensure_align_service(service_script, bowtie2_cmd)
+
+    service_in  = client.makefile('wb')
+    service_out = client.makefile('rb')
+
+    sender = start_tab5_writer(reads, service_in, end_of_batch=b"\n")
+
+    #   The service ends every batch with an empty line.
+    batch_status = {'complete': False}
+
+    def read_batch():
+        for a_line in iter(service_out.readline, b''):
+            if a_line == b"\n":
+                batch_status['complete'] = True
+                break
+            yield a_line
+
+    try:
+        for alignment in parse_sam_alignments(read_batch(), strain_table, alignment_stats):
+            yield alignment
+
+    finally:
+        #   Unblocks the sender if we stopped reading early.
+        try:
+            client.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        client.close()
+        sender.join()
+
+    if not batch_status['complete'] or sender.error is not None:
+        raise RuntimeError("Bowtie2 service closed the connection before the batch was complete.")
+
+
+# ----------------------------------------------- Streaming Bowtie2 I/O -----------------------------------------------
+#
+#   Reads are streamed into Bowtie2's STDIN by a writer thread, while the SAM output is parsed line by line as it
+#   comes out of STDOUT. Only a small buffer of reads and alignments is held in memory at any given time.
+#
+
+class Tab5Writer(threading.Thread):
+    """
+    Thread that writes tab5 reads, one per line, into a binary file object (a pipe or a socket) and closes it.
+    """
+    def __init__(self, reads, output_handle, end_of_batch=None):
+        threading.Thread.__init__(self)
+        self.daemon         = True
+        self.reads          = reads
+        self.output_handle  = output_handle
+        self.end_of_batch   = end_of_batch
+        self.error          = None
+
+    def run(self):
+        try:
+            for a_read in self.reads:
+                a_read = a_read.rstrip("\n")
+                if a_read:
+                    self.output_handle.write(to_bytes(a_read) + b"\n")
+
+            if self.end_of_batch is not None:
+                self.output_handle.write(self.end_of_batch)
+
+            self.output_handle.flush()
+
+        except (IOError, OSError, socket.error) as e:
+            #   The reader side went away (e.g., Bowtie2 died). The reader will report it.
+            self.error = e
+
+        finally:
+            if self.end_of_batch is None:
+                try:
+                    self.output_handle.close()
+                except (IOError, OSError):
+                    pass
+
+
+def start_tab5_writer(reads, output_handle, end_of_batch=None):
+    """
+    Starts a 'Tab5Writer' thread.
+    Args:
+        reads:          An iterable of tab5-formatted reads.
+        output_handle:  A binary file object to write the reads into.
+        end_of_batch:   Optional bytes to write after the last read. If None, the handle is closed instead.
+
+    Returns:
+        The running 'Tab5Writer' thread.
+    """
+    writer = Tab5Writer(reads, output_handle, end_of_batch)
+    writer.start()
+
+    return writer
+
+
+def parse_sam_alignments(sam_lines, strain_table=None, alignment_stats=None):
+    """
+    Parses SAM lines into alignment tuples, skipping header lines and unaligned reads.
+    Args:
+        sam_lines:          An iterable of SAM lines (bytes or strings).
+        strain_table:       Optional 'StrainTable' (see 'flint_strain_table.py'). If given, the read names must be
+                            integer read IDs (see 'number_reads()'), and alignments are encoded as (read ID, strain
+                            ID) integers.
+        alignment_stats:    Optional record from 'new_alignment_stats()'. Reads for which Bowtie2 found more than one
+                            alignment (an 'XS:i' tag) are counted into its 'reads_multimapped'.
+
+    Returns:
+        A generator of (QNAME, RNAME) tuples, or (read ID, strain ID) tuples if a strain table was given.
+    """
+    #   Both mates of a pair carry the tag, and they are reported one after the other.
+    last_multimapped_read = None
+
+    for a_line in sam_lines:
+        if isinstance(a_line, bytes):
+            a_line = a_line.decode('utf-8')
+
+        if not a_line or a_line[0] == "@":
+            continue
+
+        #   SAM format: [0] - QNAME (the read name)
+        #               [1] - FLAG
+        #               [2] - RNAME (the genome reference name that the read aligns to)
+        fields = a_line.split("\t", 3)
+
+        if len(fields) < 3 or int(fields[1]) & 4:
+            continue
+
+        #   Without '-k', Bowtie2 reports only the best alignment of a read, and the score of the second best in 'XS:i'.
+        if alignment_stats is not None and "\tXS:i:" in a_line and fields[0] != last_multimapped_read:
+            alignment_stats["reads_multimapped"] += 1
+            last_multimapped_read = fields[0]
+
+        if strain_table is None:
+            yield (fields[0], fields[2])
+        else:
+            yield (int(fields[0]), strain_table.get_strain_id(fields[2]))
+
+
+def new_alignment_stats():
+    """
+    Creates an empty alignment stats record, see 'count_alignments()'.
+    Returns:
+        A dictionary with the number of alignments, reads aligned, and multi-mapped reads, the wall time of the
+        alignment in seconds, and a list of Bowtie2 process records (see 'new_bowtie2_process_stats()').
+    """
+    return {"alignments": 0, "reads_aligned": 0, "reads_multimapped": 0, "alignment_seconds": 0.0, "bowtie2": []}
+
+
+def count_alignments(alignments, alignment_stats):
+    """
+    Passes alignments through while counting them into a stats record, so that the metrics of a run come as a side
+    output of the SAM parsing, and not from extra Spark jobs. Bowtie2 reports all the alignments of a read one after
+    the other, so a read is counted when its ID changes. Multi-mapped reads are counted from the SAM tags, see
+    'parse_sam_alignments()'.
+    Args:
+        alignments:         An iterable of alignment tuples, with the read as the first element.
+        alignment_stats:    A record from 'new_alignment_stats()', updated in place.
+
+    Returns:
+        A generator of the same alignment tuples.
+    """
+    last_read = None
+
+    alignment_start_time = time.time()
+
+    for alignment in alignments:
+        alignment_stats["alignments"] += 1
+
+        if alignment[0] != last_read:
+            alignment_stats["reads_aligned"] += 1
+            last_read = alignment[0]
+
+        yield alignment
+
+    #   Includes the time that Spark spent on the alignments downstream, as they are handed over one at a time.
+    alignment_stats["alignment_seconds"] += time.time() - alignment_start_time
+
+
+def number_reads(reads, first_read_id=0):
+    """
+    Replaces the name of each tab5 read with an integer read ID, so that Bowtie2 reports the read ID as the QNAME.
+    Read IDs are consecutive, starting at 'first_read_id'.
+    Args:
+        reads:          An iterable of tab5-formatted reads.
+        first_read_id:  The read ID of the first read.
+
+    Returns:
+        A generator of tab5-formatted reads.
+    """
+    for read_id, a_read in enumerate(reads, first_read_id):
+        name_end = a_read.find("\t")
+
+        if name_end != -1:
+            yield str(read_id) + a_read[name_end:]
+
+
+def stream_reads_to_bowtie2(reads, bowtie2_cmd, strain_table=None, process_stats=None, alignment_stats=None):
+    """
+    Aligns reads with a new Bowtie2 process. Reads are written to Bowtie2's STDIN by a writer thread, and the
+    alignments are yielded as Bowtie2 reports them.
+    Args:
+        reads:          An iterable of tab5-formatted reads.
+        bowtie2_cmd:    The Bowtie2 command, as a list.
+        strain_table:   Optional 'StrainTable' for encoding the alignments, see 'parse_sam_alignments()'.
+        process_stats:  Optional dictionary that is filled in with the Bowtie2 process record once all alignments
+                        have been yielded, see 'new_bowtie2_process_stats()'.
+        alignment_stats:    Optional stats record for the multi-mapped reads, see 'parse_sam_alignments()'.
+
+    Returns:
+        A generator of alignment tuples for the reads that aligned.
+    """
+    process_start_time = time.time()
+
+    align_subprocess = sp.Popen(bowtie2_cmd, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
+
+    #   Bowtie2 reports its alignment summary through STDERR. It has to be drained while we read STDOUT, otherwise a
+    #   full STDERR pipe would block Bowtie2.
+    stderr_chunks = []
+    stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(align_subprocess.stderr.read()))
+    stderr_reader.daemon = True
+    stderr_reader.start()
+
+    writer = start_tab5_writer(reads, align_subprocess.stdin)
+
+    stdout_finished = False
+
+    try:
+        for alignment in parse_sam_alignments(iter(align_subprocess.stdout.readline, b''), strain_table,
+                                              alignment_stats):
+            yield alignment
+
+        stdout_finished = True
+
+    finally:
+        if not stdout_finished and align_subprocess.poll() is None:
+            #   The consumer stopped early, or the SAM parsing failed. Nobody reads Bowtie2's STDOUT anymore, so it
+            #   would block on a full pipe, and never exit.
+            align_subprocess.kill()
+
+        writer.join()
+        stderr_reader.join()
+        align_subprocess.stdout.close()
+        peak_rss_bytes = wait_for_process(align_subprocess)
+
+    stderr_text = b"".join(stderr_chunks).decode('utf-8', 'replace')
+
+    if process_stats is not None:
+        process_stats["exit_code"]      = align_subprocess.returncode
+        process_stats["wall_seconds"]   = time.time() - process_start_time
+        process_stats["peak_rss_bytes"] = peak_rss_bytes
+        process_stats["summary"]        = parse_bowtie2_summary(stderr_text)
+
+    if align_subprocess.returncode != 0:
+        raise RuntimeError("Bowtie2 exited with code " + str(align_subprocess.returncode) + ": " + stderr_text)
+
+
+def wait_for_process(a_subprocess):
+    """
+    Waits for a subprocess to exit, and sets its return code.
+    Args:
+        a_subprocess:   A 'subprocess.Popen' object.
+
+    Returns:
+        The peak resident set size of the subprocess in bytes, or None if it's not available.
+    """
+    try:
+        #   'wait4()' gives us the resource usage of 'this' process only, and not of all the children.
+        pid, exit_status, resource_usage = os.wait4(a_subprocess.pid, 0)
+
+    except (AttributeError, OSError):
+        a_subprocess.wait()
+        return None
+
+    if os.WIFSIGNALED(exit_status):
+        a_subprocess.returncode = -os.WTERMSIG(exit_status)
+    else:
+        a_subprocess.returncode = os.WEXITSTATUS(exit_status)
+
+    #   'ru_maxrss' is in kilobytes in Linux.
+    return resource_usage.ru_maxrss * 1024
+
+
+# ----------------------------------------------- Bowtie2 Summaries ---------------------------------------------------
+#
+#   Bowtie2 writes an alignment summary to STDERR when it exits, e.g.,
+#
+#       10000 reads; of these:
+#         10000 (100.00%) were unpaired; of these:
+#           596 (5.96%) aligned 0 times
+#           9284 (92.84%) aligned exactly 1 time
+#           120 (1.20%) aligned >1 times
+#       94.04% overall alignment rate
+#
+#   For paired-end reads, the counts are of pairs that aligned concordantly.
+#
+
+BOWTIE2_SUMMARY_PATTERNS = [
+    ("reads",               re.compile(r"^(\d+) reads; of these:")),
+    ("pairs",               re.compile(r"^(\d+) \([\d.]+%\) were paired; of these:")),
+    ("unpaired",            re.compile(r"^(\d+) \([\d.]+%\) were unpaired; of these:")),
+    ("aligned_0",           re.compile(r"^(\d+) \([\d.]+%\) aligned (?:concordantly )?0 times")),
+    ("aligned_1",           re.compile(r"^(\d+) \([\d.]+%\) aligned (?:concordantly )?exactly 1 time")),
+    ("aligned_multi",       re.compile(r"^(\d+) \([\d.]+%\) aligned (?:concordantly )?>1 times")),
+    ("aligned_discordant",  re.compile(r"^(\d+) \([\d.]+%\) aligned discordantly 1 time")),
+]
+
+BOWTIE2_RATE_PATTERN = re.compile(r"^([\d.]+)% overall alignment rate")
+
+
+def new_bowtie2_process_stats():
+    """
+    Creates an empty Bowtie2 process record, see 'stream_reads_to_bowtie2()'.
+    Returns:
+        A dictionary with the exit code, wall time in seconds, peak resident set size in bytes, and the parsed
+        alignment summary of a Bowtie2 process.
+    """
+    return {"exit_code": None, "wall_seconds": None, "peak_rss_bytes": None, "summary": None}
+
+
+def parse_bowtie2_summary(stderr_text):
+    """
+    Parses the alignment summary that Bowtie2 writes to STDERR. For paired-end reads, only the counts of the pairs
+    are kept (the first match of each pattern), and not those of the mates that make up pairs that didn't align.
+    Args:
+        stderr_text:    Bowtie2's STDERR output.
+
+    Returns:
+        A dictionary with the counts in 'BOWTIE2_SUMMARY_PATTERNS', and the 'overall_rate' as a percentage. Counts
+        that are not in the summary are left out, and None is returned if there is no summary at all.
+    """
+    summary = {}
+
+    for a_line in stderr_text.splitlines():
+        a_line = a_line.strip()
+
+        rate_match = BOWTIE2_RATE_PATTERN.match(a_line)
+        if rate_match:
+            summary["overall_rate"] = float(rate_match.group(1))
+            continue
+
+        for summary_key, summary_pattern in BOWTIE2_SUMMARY_PATTERNS:
+            if summary_key in summary:
+                continue
+
+            summary_match = summary_pattern.match(a_line)
+            if summary_match:
+                summary[summary_key] = int(summary_match.group(1))
+                break
+
+    return summary or None
+
+
+def to_bytes(a_string):
+    """
+    Encodes a string as UTF-8 bytes, leaving it untouched if it is bytes already.
+    """
+    if isinstance(a_string, bytes):
+        return a_string
+
+    return a_string.encode('utf-8')
@@ -0,0 +1,265 @@
+# coding: utf-8
+# ---------------------------------------------------------------------------------------------------------------------
+#
+#                                       Florida International University
+#
+#   This software is a "Camilo Valdes Work" under the terms of the United States Copyright Act.
+#   Please cite the author(s) in any work or product based on this material.
+#
+#   OBJECTIVE:
+#	The purpose of this file is to parse FASTQ samples in the Executors, and turn them into the tab5 reads that
+#   Bowtie2 is fed with, so that samples don't need to be converted to tab5 in a single machine before a run.
+#
+#
+#   NOTES:
+#   Please see the dependencies section below for the required libraries (if any).
+#
+#   A FASTQ file is read as lines (see 'spark_jobs.loadFASTQFile()'), and Hadoop splits it at line boundaries, not at
+#   record boundaries, so the first lines of a split may belong to a record that started in the previous split. Each
+#   split is parsed from its first record start on, and the lines before it (its 'head fragment') are handed to the
+#   previous split, which needs them to complete its last record. Head fragments are a few lines long, and they are
+#   found in the driver from the first lines of every split, which are read by a small Spark job.
+#
+#   A record start is a '@' line, followed by a sequence, a '+' line, and a quality string as long as the sequence.
+#   Quality strings can start with '@' too, but a quality line is never followed by a sequence and a '+' line. In
+#   interleaved FASTQ files, both mates of a pair are next to each other, and a pair starts with two records of the
+#   same read name.
+#
+#   Gzipped files ('.fastq.gz') are not splittable, and they are read by a single task. The reads are spread over the
+#   cluster before they are aligned.
+#
+#   DEPENDENCIES:
+#
+#       • Python & the modules listed below
+#
+#   You can check the python modules currently installed in your system by running: python -c "help('modules')"
+#
+#   USAGE:
+#       Run the program with the "--help" flag to see usage instructions.
+#
+#	AUTHOR:
+#           Camilo Valdes (camilo@castflyer.com)
+#			Florida International University (FIU)
+#
+#
+# ---------------------------------------------------------------------------------------------------------------------
+
+# 	Python Modules
+import os, sys
+import itertools
+
+
+LINES_PER_RECORD = 4
+
+#   Lines read from the beginning of a split to find its first record (or pair) start.
+HEAD_LOOKAHEAD_LINES = 4 * LINES_PER_RECORD
+
+FORMAT_TAB5                 = "tab5"
+FORMAT_FASTQ                = "fastq"
+FORMAT_INTERLEAVED_FASTQ    = "interleaved_fastq"
+
+FASTQ_FORMATS = [FORMAT_FASTQ, FORMAT_INTERLEAVED_FASTQ]
+
+
+# ------------------------------------------------- Read Functions ----------------------------------------------------
+#
+#   These run in the Executors.
+#
+
+def clean_read_name(title):
+    """
+    Cleans up the title of a FASTQ record into the read name shared by both mates of a pair.
+    Args:
+        title:  The record's title, without the leading '@'.
+
+    Returns:
+        The read name, without any comments or mate suffix ('/1', '/2').
+    """
+    read_name = title.split(None, 1)[0] if title.strip() else ""
+
+    if read_name.endswith("/1") or read_name.endswith("/2"):
+        read_name = read_name[:-2]
+
+    return read_name
+
+
+def is_record_start(lines, line_index):
+    """
+    Checks whether a FASTQ record starts at a line.
+    Args:
+        lines:      A list of lines, without line breaks.
+        line_index: The index of the line to check.
+
+    Returns:
+        True if the record's four lines are in the list, and are well formed. False otherwise.
+    """
+    if line_index + LINES_PER_RECORD > len(lines):
+        return False
+
+    title, sequence, separator, quality = lines[line_index:line_index + LINES_PER_RECORD]
+
+    return title.startswith("@") and separator.startswith("+") and len(sequence) == len(quality)
+
+
+def is_pair_start(lines, line_index):
+    """
+    Checks whether a pair of an interleaved FASTQ file starts at a line.
+    """
+    if not (is_record_start(lines, line_index) and is_record_start(lines, line_index + LINES_PER_RECORD)):
+        return False
+
+    return clean_read_name(lines[line_index][1:]) == clean_read_name(lines[line_index + LINES_PER_RECORD][1:])
+
+
+def get_lookahead_lines(interleaved=False):
+    """
+    Number of lines read from the beginning of every split, see 'read_split_head()'.
+    """
+    return 2 * HEAD_LOOKAHEAD_LINES if interleaved else HEAD_LOOKAHEAD_LINES
+
+
+def read_split_head(lines_iterator, interleaved=False):
+    """
+    Reads the first lines of a split, which are enough to find its first record (or pair) start. A split that is
+    shorter than that is read as a whole.
+    Args:
+        lines_iterator: Iterator over the lines of the split.
+        interleaved:    The file is an interleaved FASTQ file, and whole pairs are kept together.
+
+    Returns:
+        A list of lines.
+    """
+    return [line.rstrip("\r\n") for line in itertools.islice(lines_iterator, get_lookahead_lines(interleaved))]
+
+
+def get_split_continuations(split_heads, interleaved=False):
+    """
+    Finds where the first record of every split starts, and pairs the split with the lines that complete its last
+    record: the head fragment of the next split, plus the lines of any splits after it that are too short to have a
+    record start of their own. Runs in the driver.
+    Args:
+        split_heads:    List of (split index, first lines of the split) tuples from 'read_split_head()'.
+        interleaved:    The file is an interleaved FASTQ file, and whole pairs are kept together.
+
+    Returns:
+        A dictionary that maps a split index to a (number of lines to skip, lines to append) tuple. The number of
+        lines to skip is None for splits without a record start.
+    """
+    lookahead    = get_lookahead_lines(interleaved)
+    record_start = is_pair_start if interleaved else is_record_start
+    unit_lines   = 2 * LINES_PER_RECORD if interleaved else LINES_PER_RECORD
+
+    split_continuations = {}
+
+    #   The known leading lines of the splits after 'this' one, and the lines that complete a record that ends in them.
+    next_lines          = []
+    next_continuation   = []
+
+    for split_index, head_lines in reversed(sorted(split_heads)):
+        whole_split = len(head_lines) < lookahead
+
+        #   The record that starts in a short split may end in the next one.
+        known_lines = head_lines + next_lines if whole_split else head_lines
+
+        first_record = None
+        for line_index in range(min(unit_lines, len(head_lines))):
+            if record_start(known_lines, line_index):
+                first_record = line_index
+                break
+
+        if first_record is None:
+            if not whole_split:
+                raise ValueError("No FASTQ record found in the first " + str(lookahead) + " lines of a split. Is " +
+                                 "the sample in FASTQ format?")
+
+            #   Nothing to parse in 'this' split, its lines continue the record of an earlier split.
+            split_continuations[split_index] = (None, [])
+            next_continuation = head_lines + next_continuation
+
+        else:
+            split_continuations[split_index] = (first_record, next_continuation)
+            next_continuation = head_lines[:first_record]
+
+        next_lines = known_lines
+
+    return split_continuations
+
+
+def parse_fastq_records(lines_iterator):
+    """
+    Parses FASTQ lines into records.
+    Args:
+        lines_iterator: Iterator over FASTQ lines, starting at a record start.
+
+    Returns:
+        A generator of (read name, sequence, quality) tuples.
+    """
+    lines_iterator = iter(lines_iterator)
+
+    while True:
+        record = list(itertools.islice(lines_iterator, LINES_PER_RECORD))
+
+        if not record or not record[0].strip():
+            return
+
+        if not is_record_start(record, 0):
+            raise ValueError("Malformed FASTQ record: " + record[0])
+
+        yield clean_read_name(record[0][1:]), record[1], record[3]
+
+
+def fastq_split_to_tab5(lines_iterator, skip_lines, continuation, interleaved=False):
+    """
+    Turns the FASTQ records of a split into tab5 reads.
+    Args:
+        lines_iterator: Iterator over the lines of the split.
+        skip_lines:     Number of lines in the split's head fragment, or None if the split has no record start.
+        continuation:   Lines that complete the split's last record.
+        interleaved:    The file is an interleaved FASTQ file, and consecutive records are mates of a pair.
+
+    Returns:
+        A generator of tab5-formatted reads.
+    """
+    if skip_lines is None:
+        return
+
+    lines = itertools.chain(itertools.islice(lines_iterator, skip_lines, None), continuation)
+    lines = (line.rstrip("\r\n") for line in lines)
+    records = parse_fastq_records(lines)
+
+    if not interleaved:
+        for read_name, sequence, quality in records:
+            yield read_name + "\t" + sequence + "\t" + quality
+        return
+
+    for mate_1 in records:
+        mate_2 = next(records, None)
+
+        if mate_2 is None or mate_1[0] != mate_2[0]:
+            raise ValueError("Mates out of order in interleaved FASTQ file: " + mate_1[0])
+
+        yield mate_1[0] + "\t" + mate_1[1] + "\t" + mate_1[2] + "\t" + mate_2[1] + "\t" + mate_2[2]
+
+
+def mates_to_tab5(read_name, mates):
+    """
+    Joins the two mates of a pair into a tab5 read.
+    Args:
+        read_name:  The read name.
+        mates:      A ((mate 1 sequence, mate 1 quality), (mate 2 sequence, mate 2 quality)) tuple.
+
+    Returns:
+        A tab5-formatted read.
+    """
+    (sequence_1, quality_1), (sequence_2, quality_2) = mates
+
+    return read_name + "\t" + sequence_1 + "\t" + quality_1 + "\t" + sequence_2 + "\t" + quality_2
+
+
+def tab5_to_mate(read):
+    """
+    Splits a single-end tab5 read into a (read name, (sequence, quality)) pair, so it can be joined with its mate.
+    """
+    read_name, sequence, quality = read.split("\t")[:3]
+
+    return read_name, (sequence, quality)
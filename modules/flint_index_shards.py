@@ -0,0 +1,319 @@
+# coding: utf-8
+# ---------------------------------------------------------------------------------------------------------------------
+#
+#                                       Florida International University
+#
+#   This software is a "Camilo Valdes Work" under the terms of the United States Copyright Act.
+#   Please cite the author(s) in any work or product based on this material.
+#
+#   OBJECTIVE:
+#	The purpose of this file is to keep track of which worker node holds which shard of the Bowtie2 index, so that
+#   every index shard is aligned against exactly once, and on the node that holds it.
+#
+#
+#   NOTES:
+#   Please see the dependencies section below for the required libraries (if any).
+#
+#   When 'provision_index.py' copies an index shard into a worker node, it leaves a small marker file in the shard's
+#   directory with the shard's number. Before streaming starts, the driver runs a short 'probe' job in which the
+#   Executors report the markers they can see. The resulting registry is used to build an RDD with one partition
+#   per index shard, and each partition prefers the node(s) that hold its shard.
+#
+#   DEPENDENCIES:
+#
+#       • Apache-Spark
+#       • Python & the modules listed below
+#
+#   You can check the python modules currently installed in your system by running: python -c "help('modules')"
+#
+#   USAGE:
+#       Run the program with the "--help" flag to see usage instructions.
+#
+#	AUTHOR:
+#           Camilo Valdes (camilo@castflyer.com)
+#			Florida International University (FIU)
+#
+#
+# ---------------------------------------------------------------------------------------------------------------------
+
+# 	Python Modules
+import os, sys
+import time
+import socket
+
+
+#   Name of the marker file that 'provision_index.py' writes into each index shard directory.
+SHARD_MARKER_FILE = "flint_shard.txt"
+
+#   How long the scheduler waits for a slot in the node of an index shard, before it runs an alignment task anywhere
+#   (where it would fail, see 'verify_local_shard()').
+PLACEMENT_LOCALITY_WAIT = "600s"
+
+
+# ------------------------------------------------- Worker Functions --------------------------------------------------
+#
+#   These run in the worker nodes.
+#
+
+def write_shard_marker(shard_dir, shard_id):
+    """
+    Writes the marker file that tells the shard registry which index shard lives in 'shard_dir'.
+    Args:
+        shard_dir:  The directory that holds the index shard's '.bt2' files.
+        shard_id:   The number of the index shard.
+
+    Returns:
+        Nothing.
+    """
+    with open(os.path.join(shard_dir, SHARD_MARKER_FILE), "w") as marker_file:
+        marker_file.write(str(shard_id) + "\n")
+
+
+def read_shard_marker(shard_dir):
+    """
+    Reads the shard number from the marker file in 'shard_dir'.
+    Args:
+        shard_dir:  A directory that might hold an index shard.
+
+    Returns:
+        The shard number (int), or None if the directory has no marker.
+    """
+    marker_path = os.path.join(shard_dir, SHARD_MARKER_FILE)
+
+    if not os.path.isfile(marker_path):
+        return None
+
+    with open(marker_path) as marker_file:
+        return int(marker_file.read().strip())
+
+
+def find_local_shards(index_path):
+    """
+    Finds the index shards in 'this' node. A shard can live directly in 'index_path', or in one of its
+    sub-directories (as laid out by 'provision_index.py --shard_dirs').
+    Args:
+        index_path: The local path of the Bowtie2 index, e.g., '/mnt/bio_data/index'.
+
+    Returns:
+        A list of (shard number, shard directory) tuples.
+    """
+    local_shards = []
+
+    if not os.path.isdir(index_path):
+        return local_shards
+
+    candidate_dirs = [index_path] + [os.path.join(index_path, a_dir) for a_dir in sorted(os.listdir(index_path))]
+
+    for shard_dir in candidate_dirs:
+        if not os.path.isdir(shard_dir):
+            continue
+
+        shard_id = read_shard_marker(shard_dir)
+        if shard_id is not None:
+            local_shards.append((shard_id, shard_dir))
+
+    return local_shards
+
+
+def get_host_names():
+    """
+    Names under which 'this' node might be known to Spark.
+    Returns:
+        A list with the node's fully qualified name, short host name, and IP address.
+    """
+    host_names = [socket.getfqdn(), socket.gethostname()]
+
+    try:
+        host_names.append(socket.gethostbyname(socket.gethostname()))
+    except socket.error:
+        pass
+
+    return host_names
+
+
+def verify_local_shard(shard_id, shard_dir):
+    """
+    Checks that the index shard 'shard_id' is really in 'shard_dir' on 'this' node. Alignment tasks call this before
+    running Bowtie2, so that a task that Spark placed on the wrong node fails (and is retried elsewhere) instead of
+    silently aligning against the wrong shard, or against nothing.
+    Args:
+        shard_id:   The number of the index shard the task was created for.
+        shard_dir:  The directory in which the shard should be.
+
+    Returns:
+        Nothing. Raises a RuntimeError if the shard is not here.
+    """
+    if read_shard_marker(shard_dir) != shard_id:
+        raise RuntimeError("Index shard " + str(shard_id) + " is not in " + shard_dir + " on host " +
+                           socket.getfqdn())
+
+
+
+# ------------------------------------------------- Driver Functions --------------------------------------------------
+#
+#   These run in the Spark driver.
+#
+
+def get_executor_hosts(sc):
+    """
+    Retrieves the hosts of the Executors (and driver) registered with the Spark context.
+    Args:
+        sc: Spark Context.
+
+    Returns:
+        A set with the host names, as Spark knows them.
+    """
+    executor_hosts = set()
+
+    memory_status = sc._jsc.sc().getExecutorMemoryStatus()
+    for host_and_port in sc._jvm.scala.collection.JavaConverters.setAsJavaSetConverter(memory_status.keySet())\
+                                                                .asJava():
+        executor_hosts.add(host_and_port.rsplit(":", 1)[0])
+
+    return executor_hosts
+
+
+def set_node_locality_wait(sc, locality_wait):
+    """
+    Changes 'spark.locality.wait.node' in the running Spark context. The scheduler reads it as it submits each stage,
+    so the new wait applies to the stages submitted until it is changed back.
+    Args:
+        sc:             Spark Context.
+        locality_wait:  A Spark time string (e.g., "600s"), or None for Spark's default.
+
+    Returns:
+        The previous wait, or None if it was not set.
+    """
+    spark_conf = sc._jsc.sc().conf()
+
+    previous_locality_wait = None
+    if spark_conf.contains("spark.locality.wait.node"):
+        previous_locality_wait = spark_conf.get("spark.locality.wait.node")
+
+    if locality_wait is None:
+        spark_conf.remove("spark.locality.wait.node")
+    else:
+        spark_conf.set("spark.locality.wait.node", locality_wait)
+
+    return previous_locality_wait
+
+
+def discover_index_shards(sc, index_path, number_of_probes):
+    """
+    Builds the shard registry by running a probe job in which every task reports the index shards in its node.
+    Args:
+        sc:                 Spark Context.
+        index_path:         The local path of the Bowtie2 index in the worker nodes.
+        number_of_probes:   Number of probe tasks. Should be a few times the number of Executors, so that every node
+                            gets at least one.
+
+    Returns:
+        A dictionary with the shard number as KEY, and a dictionary with the shard's 'path' and the 'hosts' that hold
+        it as VALUE.
+    """
+
+    def report_local_shards(iterator):
+        host_names = get_host_names()
+        return [(host_names, shard_id, shard_dir) for shard_id, shard_dir in find_local_shards(index_path)]
+
+    shard_reports = sc.parallelize(range(number_of_probes), number_of_probes)\
+                      .mapPartitions(report_local_shards)\
+                      .collect()
+
+    executor_hosts = get_executor_hosts(sc)
+
+    registry = {}
+
+    for host_names, shard_id, shard_dir in shard_reports:
+
+        #   Use the name that Spark knows the node by, so that the preferred locations are honored.
+        spark_host = host_names[0]
+        for a_name in host_names:
+            if a_name in executor_hosts:
+                spark_host = a_name
+                break
+
+        shard_entry = registry.setdefault(shard_id, {'path': shard_dir, 'hosts': []})
+        if spark_host not in shard_entry['hosts']:
+            shard_entry['hosts'].append(spark_host)
+
+    return registry
+
+
+def print_registry_summary(registry, expected_number_of_shards):
+    """
+    Prints the shard registry, along with the shards that were not found and the nodes that hold more than one shard.
+    Args:
+        registry:                   The shard registry from 'discover_index_shards()'.
+        expected_number_of_shards:  How many index shards there should be.
+
+    Returns:
+        A list with the numbers of the missing shards.
+    """
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Index Shards Found: " +
+          str(len(registry)) + " of " + str(expected_number_of_shards))
+
+    hosts_to_shards = {}
+    for shard_id in sorted(registry):
+        for a_host in registry[shard_id]['hosts']:
+            hosts_to_shards.setdefault(a_host, []).append(shard_id)
+
+    for a_host in sorted(hosts_to_shards):
+        if len(hosts_to_shards[a_host]) > 1:
+            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Host " + a_host +
+                  " holds shards: " + ", ".join([str(shard_id) for shard_id in hosts_to_shards[a_host]]))
+
+    missing_shards = [shard_id for shard_id in range(1, expected_number_of_shards + 1) if shard_id not in registry]
+
+    if missing_shards:
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] WARNING! Missing Index Shards: " +
+              ", ".join([str(shard_id) for shard_id in missing_shards]))
+
+    return missing_shards
+
+
+def make_index_shard_rdd(sc, registry):
+    """
+    Creates an RDD with one partition per index shard, where each partition prefers the node(s) that hold its shard.
+    PySpark does not expose 'makeRDD()' with location preferences, so the RDD is built in the JVM and wrapped.
+    Args:
+        sc:         Spark Context.
+        registry:   The shard registry from 'discover_index_shards()'.
+
+    Returns:
+        An RDD of "shard number\\tshard directory" strings, one per partition.
+    """
+    from pyspark.rdd import RDD
+    from pyspark.serializers import UTF8Deserializer
+
+    jvm = sc._jvm
+    converters = jvm.scala.collection.JavaConverters
+
+    shards_with_locations = jvm.java.util.ArrayList()
+
+    for shard_id in sorted(registry):
+        shard_hosts = jvm.java.util.ArrayList()
+        for a_host in registry[shard_id]['hosts']:
+            shard_hosts.add(a_host)
+
+        shard_element = str(shard_id) + "\t" + registry[shard_id]['path']
+        shards_with_locations.add(jvm.scala.Tuple2(shard_element,
+                                                   converters.asScalaBufferConverter(shard_hosts).asScala().toSeq()))
+
+    string_class_tag = jvm.scala.reflect.ClassManifestFactory.fromClass(jvm.java.lang.Class.forName("java.lang.String"))
+
+    shard_jrdd = sc._jsc.sc().makeRDD(converters.asScalaBufferConverter(shards_with_locations).asScala().toSeq(),
+                                      string_class_tag)
+
+    return RDD(shard_jrdd.toJavaRDD(), sc, UTF8Deserializer())
+
+
+def parse_index_shard_element(shard_element):
+    """
+    Splits an element of the RDD from 'make_index_shard_rdd()'.
+    Returns:
+        A (shard number, shard directory) tuple.
+    """
+    shard_id, shard_dir = shard_element.split("\t", 1)
+
+    return int(shard_id), shard_dir
@@ -0,0 +1,462 @@
+# coding: utf-8
+# ---------------------------------------------------------------------------------------------------------------------
+#
+#                                       Florida International University
+#
+#   This software is a "Camilo Valdes Work" under the terms of the United States Copyright Act.
+#   Please cite the author(s) in any work or product based on this material.
+#
+#   OBJECTIVE:
+#	The purpose of this file is to encode and decode the Kinesis records that carry tab5 reads into Flint, and to
+#   provide an in-process stand-in for a Kinesis stream, so that ingestion can be tested and benchmarked without AWS.
+#
+#
+#   NOTES:
+#   Please see the dependencies section below for the required libraries (if any).
+#
+#   A Kinesis record holds a batch of tab5 reads, one per line. The first byte of the record tells how the batch is
+#   stored: 'T' for plain text, and 'Z' for zlib-compressed text. Records written by older producers hold a
+#   JSON-encoded list of reads, or a single JSON-encoded read, and are still decoded.
+#
+#   Once a producer has sent all the reads of a sample, it sends an end-of-stream control record ('E', followed by a
+#   JSON object) to every shard of the stream. Records of a shard are read in order, so once the control records of
+#   all the shards have been received, every read of the sample has been received too.
+#
+#   Records written by the Kinesis Producer Library (KPL) can be aggregated, i.e., several user records are packed
+#   into a single Kinesis record. An aggregated record starts with the KPL magic number, followed by an
+#   'AggregatedRecord' protocol buffer message, and the MD5 digest of the message. The message is parsed by hand, as
+#   it only takes a few fields, and records are de-aggregated in the Executors before the reads are decoded.
+#
+#   'FakeKinesisClient' mimics the few calls of the boto3 Kinesis client that Flint uses, and keeps every stream in
+#   memory. Partition keys are hashed into shards the same way Kinesis does, and shards can be throttled, so that
+#   producers can be load tested against it.
+#
+#   DEPENDENCIES:
+#
+#       • Python & the modules listed below
+#       • boto3, for looking up the shards of a real Kinesis stream.
+#
+#   You can check the python modules currently installed in your system by running: python -c "help('modules')"
+#
+#   USAGE:
+#       Run the program with the "--help" flag to see usage instructions.
+#
+#	AUTHOR:
+#           Camilo Valdes (camilo@castflyer.com)
+#			Florida International University (FIU)
+#
+#
+# ---------------------------------------------------------------------------------------------------------------------
+
+# 	Python Modules
+import os, sys
+import time
+import json
+import zlib
+import hashlib
+import threading
+
+
+RECORD_FORMAT_TAB5  = b"T"
+RECORD_FORMAT_ZLIB  = b"Z"
+RECORD_FORMAT_END   = b"E"
+
+#   Magic number of the records aggregated by the Kinesis Producer Library.
+KPL_MAGIC           = b"\xf3\x89\x9a\xc2"
+KPL_DIGEST_SIZE     = 16
+
+#   Field numbers of the KPL 'AggregatedRecord' and 'Record' protocol buffer messages.
+KPL_RECORDS_FIELD   = 3
+KPL_DATA_FIELD      = 3
+
+#   Largest payload of a single Kinesis record.
+MAX_RECORD_SIZE     = 1024 * 1024
+
+#   Hash keys are 128-bit integers, split evenly among the shards of a stream.
+MAX_HASH_KEY        = 2 ** 128
+
+#   Write limits of a single Kinesis shard, per second.
+SHARD_RECORDS_PER_SECOND    = 1000
+SHARD_BYTES_PER_SECOND      = 1024 * 1024
+
+
+# ------------------------------------------------- Record Functions --------------------------------------------------
+#
+#   Decoding runs in the Executors.
+#
+
+def encode_reads(reads, compress=False):
+    """
+    Packs tab5 reads into the data of a single Kinesis record.
+    Args:
+        reads:      A list of tab5-formatted reads.
+        compress:   Compress the reads with zlib.
+
+    Returns:
+        The record's data, as bytes.
+    """
+    text = "\n".join(read.rstrip("\r\n") for read in reads).encode("utf-8")
+
+    if compress:
+        return RECORD_FORMAT_ZLIB + zlib.compress(text)
+
+    return RECORD_FORMAT_TAB5 + text
+
+
+def encode_end_of_stream(shard_index, number_of_shards, number_of_reads):
+    """
+    Builds the end-of-stream control record of a shard.
+    Args:
+        shard_index:        Index of the shard the record is sent to.
+        number_of_shards:   Number of open shards in the stream, i.e., the number of control records.
+        number_of_reads:    Number of reads sent to the stream.
+
+    Returns:
+        The record's data, as bytes.
+    """
+    marker = {"shard": shard_index, "shards": number_of_shards, "reads": number_of_reads}
+
+    return RECORD_FORMAT_END + json.dumps(marker, sort_keys=True).encode("utf-8")
+
+
+def is_end_of_stream(data):
+    """
+    Checks whether a record is an end-of-stream control record.
+    """
+    return bytes(data[:1]) == RECORD_FORMAT_END
+
+
+def decode_end_of_stream(data):
+    """
+    Decodes an end-of-stream control record.
+    Returns:
+        A dictionary with the 'shard', 'shards', and 'reads' of the marker.
+    """
+    return json.loads(bytes(data[1:]).decode("utf-8"))
+
+
+def read_varint(data, position):
+    """
+    Reads a protocol buffer varint.
+    Args:
+        data:       A bytearray.
+        position:   Where the varint starts.
+
+    Returns:
+        A (value, position after the varint) tuple.
+    """
+    value = 0
+    shift = 0
+
+    while True:
+        if position >= len(data):
+            raise ValueError("Truncated varint.")
+
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+
+        if not byte & 0x80:
+            return value, position
+
+
+def iterate_protobuf_fields(data):
+    """
+    Walks over the fields of a protocol buffer message.
+    Args:
+        data:   The serialized message, as a bytearray.
+
+    Returns:
+        A generator of (field number, wire type, value) tuples. Length-delimited values are bytearrays, the values of
+        other wire types are integers.
+    """
+    position = 0
+
+    while position < len(data):
+        key, position = read_varint(data, position)
+        field_number, wire_type = key >> 3, key & 0x07
+
+        if wire_type == 0:
+            value, position = read_varint(data, position)
+
+        elif wire_type == 1 or wire_type == 5:
+            size = 8 if wire_type == 1 else 4
+            value = 0
+            for byte_index in range(size):
+                value |= data[position + byte_index] << (8 * byte_index)
+            position += size
+
+        elif wire_type == 2:
+            size, position = read_varint(data, position)
+            value = data[position:position + size]
+            position += size
+
+        else:
+            raise ValueError("Unsupported protocol buffer wire type: " + str(wire_type))
+
+        if position > len(data):
+            raise ValueError("Truncated protocol buffer message.")
+
+        yield field_number, wire_type, value
+
+
+def deaggregate_record(data):
+    """
+    Unpacks the user records of a record aggregated by the Kinesis Producer Library. Records that are not aggregated
+    are returned as they are.
+    Args:
+        data:   The record's data, as bytes.
+
+    Returns:
+        A list of user record payloads, as bytes.
+    """
+    if not data.startswith(KPL_MAGIC) or len(data) < len(KPL_MAGIC) + KPL_DIGEST_SIZE:
+        return [data]
+
+    message = data[len(KPL_MAGIC):-KPL_DIGEST_SIZE]
+
+    #   A record that happens to start with the magic number, but isn't aggregated, won't match its digest.
+    if hashlib.md5(message).digest() != data[-KPL_DIGEST_SIZE:]:
+        return [data]
+
+    payloads = []
+
+    for field_number, wire_type, user_record in iterate_protobuf_fields(bytearray(message)):
+        if field_number != KPL_RECORDS_FIELD or wire_type != 2:
+            continue
+
+        for record_field, record_wire_type, value in iterate_protobuf_fields(user_record):
+            if record_field == KPL_DATA_FIELD and record_wire_type == 2:
+                payloads.append(bytes(value))
+
+    return payloads
+
+
+def decode_payload(payload):
+    """
+    Decodes the payload of a single (user) record into tab5 reads.
+    """
+    marker = payload[:1]
+
+    if marker == RECORD_FORMAT_TAB5:
+        text = payload[1:].decode("utf-8")
+
+    elif marker == RECORD_FORMAT_ZLIB:
+        text = zlib.decompress(payload[1:]).decode("utf-8")
+
+    elif marker == RECORD_FORMAT_END:
+        return []
+
+    else:
+        decoded_record = json.loads(payload.decode("utf-8"))
+
+        if isinstance(decoded_record, list):
+            return decoded_record
+
+        return [decoded_record]
+
+    return [read for read in text.split("\n") if read]
+
+
+def decode_record(data):
+    """
+    Decodes a Kinesis record into tab5 reads. Runs in the Executors.
+    Args:
+        data:   The record's data, as bytes.
+
+    Returns:
+        A list of tab5-formatted reads.
+    """
+    if isinstance(data, bytearray):
+        data = bytes(data)
+
+    reads = []
+
+    for payload in deaggregate_record(data):
+        reads.extend(decode_payload(payload))
+
+    return reads
+
+
+def raw_decoder(data):
+    """
+    Message decoder for 'KinesisUtils.createStream()' that keeps the record's data as bytes, so that it can be
+    de-aggregated and decoded in the Executors.
+    """
+    return data
+
+
+# ------------------------------------------------- Stream Functions --------------------------------------------------
+#
+#
+
+def get_shard_for_partition_key(partition_key, number_of_shards):
+    """
+    Finds the shard a partition key is written to, for a stream whose hash key space is split evenly.
+    Args:
+        partition_key:      The record's partition key.
+        number_of_shards:   Number of shards in the stream.
+
+    Returns:
+        The index of the shard.
+    """
+    hash_key = int(hashlib.md5(partition_key.encode("utf-8")).hexdigest(), 16)
+
+    return get_shard_for_hash_key(hash_key, number_of_shards)
+
+
+def get_shard_for_hash_key(hash_key, number_of_shards):
+    """
+    Finds the shard a hash key falls into, for a stream whose hash key space is split evenly (see
+    'FakeKinesisClient.list_shards()').
+    """
+    hash_key = int(hash_key)
+    shard_index = min(hash_key * number_of_shards // MAX_HASH_KEY, number_of_shards - 1)
+
+    #   Shards start at rounded-down hash keys, so the first key of a shard can fall just below the plain quotient.
+    while shard_index + 1 < number_of_shards and hash_key >= (shard_index + 1) * MAX_HASH_KEY // number_of_shards:
+        shard_index += 1
+
+    return shard_index
+
+
+def get_shard_id(shard_index):
+    """
+    Kinesis-style ID of a shard, e.g., 'shardId-000000000001'.
+    """
+    return "shardId-" + str(shard_index).zfill(12)
+
+
+def get_open_shard_count(kinesis_client, stream_name):
+    """
+    Looks up the number of open shards in a Kinesis stream.
+    Args:
+        kinesis_client: A boto3 Kinesis client, or a 'FakeKinesisClient'.
+        stream_name:    Kinesis stream name.
+
+    Returns:
+        The number of open shards.
+    """
+    response = kinesis_client.describe_stream_summary(StreamName=stream_name)
+
+    return int(response["StreamDescriptionSummary"]["OpenShardCount"])
+
+
+class FakeKinesisClient(object):
+    """
+    In-memory stand-in for the boto3 Kinesis client. Implements the calls that Flint uses (create_stream,
+    describe_stream_summary, list_shards, put_records, get_shard_iterator, and get_records), with the same arguments
+    and responses. Safe to use from several threads.
+    """
+    def __init__(self, throttle=False):
+        """
+        Args:
+            throttle:   Reject the records that go over the write limits of a shard, as Kinesis does.
+        """
+        self.throttle   = throttle
+        self.streams    = {}
+        self.lock       = threading.Lock()
+
+    def create_stream(self, StreamName, ShardCount):
+        with self.lock:
+            self.streams[StreamName] = {"shards": [[] for shard_index in range(ShardCount)],
+                                        "writes": [(0, 0, 0) for shard_index in range(ShardCount)]}
+        return {}
+
+    def get_stream(self, stream_name):
+        if stream_name not in self.streams:
+            raise ValueError("Stream " + stream_name + " not found.")
+        return self.streams[stream_name]
+
+    def describe_stream_summary(self, StreamName):
+        with self.lock:
+            stream = self.get_stream(StreamName)
+            return {"StreamDescriptionSummary": {"StreamName": StreamName,
+                                                 "StreamStatus": "ACTIVE",
+                                                 "OpenShardCount": len(stream["shards"])}}
+
+    def list_shards(self, StreamName):
+        with self.lock:
+            number_of_shards = len(self.get_stream(StreamName)["shards"])
+
+        shards = []
+        for shard_index in range(number_of_shards):
+            shards.append({"ShardId": get_shard_id(shard_index),
+                           "HashKeyRange": {"StartingHashKey": str(shard_index * MAX_HASH_KEY // number_of_shards),
+                                            "EndingHashKey": str((shard_index + 1) * MAX_HASH_KEY //
+                                                                 number_of_shards - 1)}})
+        return {"Shards": shards}
+
+    def accept_write(self, stream, shard_index, size):
+        """
+        Counts a write against the limits of a shard for the current second. Returns False if the shard is over its
+        limits.
+        """
+        second = int(time.time())
+        window, records, bytes_written = stream["writes"][shard_index]
+
+        if window != second:
+            records, bytes_written = 0, 0
+
+        if self.throttle and (records + 1 > SHARD_RECORDS_PER_SECOND or
+                              bytes_written + size > SHARD_BYTES_PER_SECOND):
+            stream["writes"][shard_index] = (second, records, bytes_written)
+            return False
+
+        stream["writes"][shard_index] = (second, records + 1, bytes_written + size)
+        return True
+
+    def put_records(self, Records, StreamName):
+        results         = []
+        failed_records  = 0
+
+        with self.lock:
+            stream = self.get_stream(StreamName)
+            number_of_shards = len(stream["shards"])
+
+            for record in Records:
+                data = record["Data"]
+                if len(data) > MAX_RECORD_SIZE:
+                    raise ValueError("Record larger than " + str(MAX_RECORD_SIZE) + " bytes.")
+
+                if "ExplicitHashKey" in record:
+                    shard_index = get_shard_for_hash_key(record["ExplicitHashKey"], number_of_shards)
+                else:
+                    shard_index = get_shard_for_partition_key(record["PartitionKey"], number_of_shards)
+
+                if not self.accept_write(stream, shard_index, len(data) + len(record["PartitionKey"])):
+                    failed_records += 1
+                    results.append({"ErrorCode": "ProvisionedThroughputExceededException",
+                                    "ErrorMessage": "Rate exceeded for shard " + get_shard_id(shard_index) + "."})
+                    continue
+
+                shard = stream["shards"][shard_index]
+                sequence_number = str(len(shard))
+                shard.append({"Data": data,
+                              "PartitionKey": record["PartitionKey"],
+                              "SequenceNumber": sequence_number})
+                results.append({"ShardId": get_shard_id(shard_index), "SequenceNumber": sequence_number})
+
+        return {"FailedRecordCount": failed_records, "Records": results}
+
+    def get_shard_iterator(self, StreamName, ShardId, ShardIteratorType="TRIM_HORIZON"):
+        with self.lock:
+            shard = self.get_stream(StreamName)["shards"][int(ShardId.rsplit("-", 1)[1])]
+            position = len(shard) if ShardIteratorType == "LATEST" else 0
+
+        return {"ShardIterator": StreamName + "|" + ShardId + "|" + str(position)}
+
+    def get_records(self, ShardIterator, Limit=10000):
+        stream_name, shard_id, position = ShardIterator.rsplit("|", 2)
+        position = int(position)
+
+        with self.lock:
+            shard = self.get_stream(stream_name)["shards"][int(shard_id.rsplit("-", 1)[1])]
+            records = shard[position:position + Limit]
+            next_position = position + len(records)
+            behind = len(shard) - next_position
+
+        return {"Records": records,
+                "NextShardIterator": stream_name + "|" + shard_id + "|" + str(next_position),
+                "MillisBehindLatest": 0 if behind == 0 else 1000}
@@ -0,0 +1,349 @@
+# coding: utf-8
+# ---------------------------------------------------------------------------------------------------------------------
+#
+#                                       Florida International University
+#
+#   This software is a "Camilo Valdes Work" under the terms of the United States Copyright Act.
+#   Please cite the author(s) in any work or product based on this material.
+#
+#   OBJECTIVE:
+#	The purpose of this file is to export the metrics of every streamed shard (micro-batch), so that throughput
+#   regressions and straggling index shards can be tracked over a run without scraping the terminal output.
+#
+#
+#   NOTES:
+#   Please see the dependencies section below for the required libraries (if any).
+#
+#   Each shard is written out in two formats:
+#
+#       • A JSON line in 'flint_metrics.jsonl', which is rotated once it reaches 'JSONL_MAX_BYTES'. Samples that are
+#         streamed together share the file, and each line carries its sample ID.
+#       • The Prometheus text format in 'flint_<sample ID>.prom', which is re-written after every shard. Point the
+#         textfile collector of the node exporter (--collector.textfile.directory) to the metrics directory to
+#         scrape it.
+#
+#   The metrics are side outputs of the run (see 'AlignmentStatsAccumulator' in 'spark_jobs.py'), so recording them
+#   does not start any Spark jobs.
+#
+#   DEPENDENCIES:
+#
+#       • Python & the modules listed below
+#
+#   You can check the python modules currently installed in your system by running: python -c "help('modules')"
+#
+#   USAGE:
+#       Run the program with the "--help" flag to see usage instructions.
+#
+#	AUTHOR:
+#           Camilo Valdes (camilo@castflyer.com)
+#			Florida International University (FIU)
+#
+#
+# ---------------------------------------------------------------------------------------------------------------------
+
+# 	Python Modules
+import os, sys
+import time
+import json
+import resource
+import logging
+import logging.handlers
+
+
+JSONL_FILE_NAME     = "flint_metrics.jsonl"
+TEXTFILE_PREFIX     = "flint_"
+TEXTFILE_SUFFIX     = ".prom"
+
+#   Rotation of the JSON lines file.
+JSONL_MAX_BYTES     = 64 * 1024 * 1024
+JSONL_BACKUP_COUNT  = 5
+
+#   One rotating handler per JSON lines file, shared by the recorders that write to it, as two handlers on the same
+#   file would rotate it from under each other. Maps the file path to a [handler, number of recorders] list.
+JSONL_HANDLERS = {}
+
+
+# ------------------------------------------------- Driver Functions --------------------------------------------------
+#
+#   These run in the Spark driver.
+#
+
+def get_driver_memory():
+    """
+    Retrieves the memory used by the Python side of the driver.
+    Returns:
+        A (resident set size in bytes, peak resident set size in bytes) tuple.
+    """
+    #   'ru_maxrss' is in kilobytes in Linux.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    current_rss = peak_rss
+
+    try:
+        with open("/proc/self/statm") as statm_file:
+            current_rss = int(statm_file.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+
+    return current_rss, max(current_rss, peak_rss)
+
+
+def get_driver_jvm_heap(sc):
+    """
+    Retrieves the heap used by the driver's JVM.
+    Args:
+        sc: Spark Context.
+
+    Returns:
+        The bytes of heap in use.
+    """
+    jvm_runtime = sc._jvm.java.lang.Runtime.getRuntime()
+
+    return jvm_runtime.totalMemory() - jvm_runtime.freeMemory()
+
+
+def get_storage_memory(sc):
+    """
+    Retrieves the storage memory (for cached RDDs and broadcast variables) of the Executors and the driver.
+    Args:
+        sc: Spark Context.
+
+    Returns:
+        A (bytes used, bytes available in total) tuple.
+    """
+    storage_memory_used = 0
+    storage_memory_max  = 0
+
+    memory_status = sc._jsc.sc().getExecutorMemoryStatus()
+    for memory_tuple in sc._jvm.scala.collection.JavaConverters.mapAsJavaMapConverter(memory_status).asJava()\
+                                                                .values():
+        #   (maximum memory for caching, remaining memory for caching)
+        storage_memory_max  += memory_tuple._1()
+        storage_memory_used += memory_tuple._1() - memory_tuple._2()
+
+    return storage_memory_used, storage_memory_max
+
+
+def get_textfile_name(sample_id):
+    """
+    Builds the name of the Prometheus textfile of a sample.
+    """
+    safe_sample_id = "".join(character if character.isalnum() or character in "-_." else "_"
+                             for character in str(sample_id))
+
+    return TEXTFILE_PREFIX + safe_sample_id + TEXTFILE_SUFFIX
+
+
+def open_jsonl_handler(jsonl_path):
+    """
+    Retrieves the rotating handler of a JSON lines file, and creates it if this is its first recorder.
+    """
+    if jsonl_path not in JSONL_HANDLERS:
+        jsonl_handler = logging.handlers.RotatingFileHandler(jsonl_path,
+                                                             maxBytes=JSONL_MAX_BYTES,
+                                                             backupCount=JSONL_BACKUP_COUNT)
+        jsonl_handler.setFormatter(logging.Formatter("%(message)s"))
+        JSONL_HANDLERS[jsonl_path] = [jsonl_handler, 0]
+
+    JSONL_HANDLERS[jsonl_path][1] += 1
+
+    return JSONL_HANDLERS[jsonl_path][0]
+
+
+def close_jsonl_handler(jsonl_path):
+    """
+    Closes the rotating handler of a JSON lines file once its last recorder is done with it.
+    """
+    JSONL_HANDLERS[jsonl_path][1] -= 1
+
+    if JSONL_HANDLERS[jsonl_path][1] == 0:
+        JSONL_HANDLERS.pop(jsonl_path)[0].close()
+
+
+def escape_label_value(label_value):
+    """
+    Escapes a label value for the Prometheus text format.
+    """
+    return str(label_value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_metric(metric_name, metric_value, labels):
+    """
+    Formats a single sample in the Prometheus text format.
+    Args:
+        metric_name:    The metric's name.
+        metric_value:   The metric's value.
+        labels:         A list of (label name, label value) tuples.
+
+    Returns:
+        A line of text, without the line break.
+    """
+    label_string = ",".join(label_name + "=\"" + escape_label_value(label_value) + "\""
+                            for label_name, label_value in labels)
+
+    return metric_name + "{" + label_string + "} " + repr(float(metric_value))
+
+
+class MetricsRecorder(object):
+    """
+    Records the metrics of every shard into a rotating JSON lines file, and a Prometheus textfile with the running
+    totals and the metrics of the last shard.
+
+    """
+    def __init__(self, sample_id, metrics_dir):
+        self.sample_id      = sample_id
+        self.textfile_path  = os.path.join(metrics_dir, get_textfile_name(sample_id))
+        self.jsonl_path     = os.path.join(metrics_dir, JSONL_FILE_NAME)
+
+        self.totals = {"shards": 0, "input_reads": 0, "alignments": 0, "reads_aligned": 0}
+        self.last_batch = None
+        self.last_checkpoint = None
+
+        if not os.path.exists(metrics_dir):
+            os.makedirs(metrics_dir)
+
+        #   The logging module takes care of the rotation.
+        self.jsonl_logger = logging.getLogger("flint.metrics." + str(sample_id))
+        self.jsonl_logger.setLevel(logging.INFO)
+        self.jsonl_logger.propagate = False
+
+        self.jsonl_handler = open_jsonl_handler(self.jsonl_path)
+        self.jsonl_logger.addHandler(self.jsonl_handler)
+
+    def record_batch(self, batch_metrics):
+        """
+        Records the metrics of a shard.
+        Args:
+            batch_metrics:  A dictionary with the shard's metrics. The 'index_shards' key holds a dictionary with the
+                            stats of each index shard (see 'flint_bowtie2_mapping.new_alignment_stats()').
+
+        Returns:
+            Nothing.
+        """
+        batch_metrics = dict(batch_metrics)
+        batch_metrics["sample_id"] = self.sample_id
+        batch_metrics["timestamp"] = time.time()
+
+        self.jsonl_logger.info(json.dumps(batch_metrics, sort_keys=True))
+
+        self.totals["shards"]           += 1
+        self.totals["input_reads"]      += batch_metrics.get("input_reads", 0)
+        self.totals["alignments"]       += batch_metrics.get("alignments", 0)
+        self.totals["reads_aligned"]    += batch_metrics.get("reads_aligned", 0)
+        self.last_batch = batch_metrics
+
+        self.write_textfile()
+
+    def record_checkpoint(self, checkpoint_metrics):
+        """
+        Records the cost of saving the checkpoint ledger of the sample.
+        Args:
+            checkpoint_metrics: A dictionary with the checkpoint's metrics ('checkpoint_seconds', 'checkpoint_bytes').
+
+        Returns:
+            Nothing.
+        """
+        checkpoint_metrics = dict(checkpoint_metrics)
+        checkpoint_metrics["event"] = "checkpoint"
+        checkpoint_metrics["sample_id"] = self.sample_id
+        checkpoint_metrics["timestamp"] = time.time()
+
+        self.jsonl_logger.info(json.dumps(checkpoint_metrics, sort_keys=True))
+
+        self.last_checkpoint = checkpoint_metrics
+
+        self.write_textfile()
+
+    def write_textfile(self):
+        """
+        Re-writes the Prometheus textfile. The file is written next to the final one and renamed into place, so the
+        node exporter never reads a partial file.
+        """
+        sample_labels = [("sample", self.sample_id)]
+        lines = []
+
+        def add_metric(metric_name, metric_type, metric_help, samples):
+            lines.append("# HELP " + metric_name + " " + metric_help)
+            lines.append("# TYPE " + metric_name + " " + metric_type)
+            for labels, metric_value in samples:
+                lines.append(format_metric(metric_name, metric_value, labels))
+
+        add_metric("flint_shards_processed_total", "counter", "Sample shards processed.",
+                   [(sample_labels, self.totals["shards"])])
+        add_metric("flint_input_reads_total", "counter", "Reads streamed in.",
+                   [(sample_labels, self.totals["input_reads"])])
+        add_metric("flint_alignments_total", "counter", "Alignments reported by Bowtie2.",
+                   [(sample_labels, self.totals["alignments"])])
+        add_metric("flint_reads_aligned_total", "counter", "Reads that aligned to at least one strain.",
+                   [(sample_labels, self.totals["reads_aligned"])])
+
+        last_batch = self.last_batch or {}
+
+        for metric_key, metric_help in [("input_reads", "Reads in the last shard."),
+                                        ("alignments", "Alignments in the last shard."),
+                                        ("abundance_seconds", "Wall time of the alignment and abundance job of " +
+                                                              "the last shard."),
+                                        ("aggregation_seconds", "Wall time of the last shard after its slowest " +
+                                                                "index shard finished aligning."),
+                                        ("latency_seconds", "Time from the batch that picked up the last shard, " +
+                                                            "to its profile update."),
+                                        ("driver_rss_bytes", "Resident memory of the Python driver."),
+                                        ("driver_peak_rss_bytes", "Peak resident memory of the Python driver."),
+                                        ("driver_jvm_heap_bytes", "Heap in use in the driver's JVM."),
+                                        ("storage_memory_used_bytes", "Storage memory used by cached RDDs and " +
+                                                                      "broadcast variables, cluster-wide."),
+                                        ("storage_memory_max_bytes", "Storage memory available, cluster-wide.")]:
+            if last_batch.get(metric_key) is not None:
+                add_metric("flint_last_shard_" + metric_key, "gauge", metric_help,
+                           [(sample_labels, last_batch[metric_key])])
+
+        index_shards = last_batch.get("index_shards", {})
+        if index_shards:
+            add_metric("flint_index_shard_alignment_seconds", "gauge",
+                       "Alignment wall time of each index shard in the last shard.",
+                       [(sample_labels + [("index_shard", shard_key)], shard_stats.get("alignment_seconds", 0.0))
+                        for shard_key, shard_stats in sorted(index_shards.items())])
+            add_metric("flint_index_shard_alignments", "gauge", "Alignments of each index shard in the last shard.",
+                       [(sample_labels + [("index_shard", shard_key)], shard_stats.get("alignments", 0))
+                        for shard_key, shard_stats in sorted(index_shards.items())])
+
+            #   From the Bowtie2 processes of each index shard, see 'flint_bowtie2_mapping.stream_reads_to_bowtie2()'.
+            bowtie2_shards = sorted((shard_key, shard_stats["bowtie2"]) for shard_key, shard_stats in
+                                    index_shards.items() if shard_stats.get("bowtie2"))
+            if bowtie2_shards:
+                add_metric("flint_index_shard_bowtie2_seconds", "gauge",
+                           "Wall time of the Bowtie2 processes of each index shard in the last shard.",
+                           [(sample_labels + [("index_shard", shard_key)],
+                             sum(process_stats["wall_seconds"] or 0.0 for process_stats in bowtie2_processes))
+                            for shard_key, bowtie2_processes in bowtie2_shards])
+                add_metric("flint_index_shard_bowtie2_peak_rss_bytes", "gauge",
+                           "Peak memory of the Bowtie2 processes of each index shard in the last shard.",
+                           [(sample_labels + [("index_shard", shard_key)],
+                             max(process_stats["peak_rss_bytes"] or 0 for process_stats in bowtie2_processes))
+                            for shard_key, bowtie2_processes in bowtie2_shards])
+                add_metric("flint_index_shard_bowtie2_reads_aligned_0", "gauge",
+                           "Reads that Bowtie2 did not align, per index shard, in the last shard.",
+                           [(sample_labels + [("index_shard", shard_key)],
+                             sum((process_stats["summary"] or {}).get("aligned_0", 0)
+                                 for process_stats in bowtie2_processes))
+                            for shard_key, bowtie2_processes in bowtie2_shards])
+
+        last_checkpoint = self.last_checkpoint or {}
+
+        for metric_key, metric_help in [("seconds", "Time taken to save the last checkpoint ledger."),
+                                        ("bytes", "Size of the last checkpoint ledger.")]:
+            if last_checkpoint.get("checkpoint_" + metric_key) is not None:
+                add_metric("flint_last_checkpoint_" + metric_key, "gauge", metric_help,
+                           [(sample_labels, last_checkpoint["checkpoint_" + metric_key])])
+
+        tmp_textfile_path = self.textfile_path + ".tmp"
+        with open(tmp_textfile_path, "w") as textfile:
+            textfile.write("\n".join(lines) + "\n")
+
+        os.rename(tmp_textfile_path, self.textfile_path)
+
+    def close(self):
+        """
+        Closes the JSON lines file.
+        """
+        self.jsonl_logger.removeHandler(self.jsonl_handler)
+        close_jsonl_handler(self.jsonl_path)
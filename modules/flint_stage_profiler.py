@@ -0,0 +1,323 @@
+# coding: utf-8
+# ---------------------------------------------------------------------------------------------------------------------
+#
+#                                       Florida International University
+#
+#   This software is a "Camilo Valdes Work" under the terms of the United States Copyright Act.
+#   Please cite the author(s) in any work or product based on this material.
+#
+#   OBJECTIVE:
+#	The purpose of this file is to profile the Spark stages of each streamed shard (micro-batch) without running any
+#   extra Spark jobs, so that a production-sized run can be profiled at production speed.
+#
+#
+#   NOTES:
+#   Please see the dependencies section below for the required libraries (if any).
+#
+#   The jobs of a shard are tagged with a Spark job group. Once the shard is done, the driver looks up the jobs of the
+#   group with the status tracker, and the metrics of their stages (wall time, task time, shuffle read/write bytes,
+#   and records in/out) in the monitoring REST API of the Spark UI. Spark's listener fills in the stage metrics
+#   asynchronously, so a shard whose stages are not complete yet is kept, and written out at the next shard.
+#
+#   Job groups are a thread-local property of the JVM thread that submits the jobs. PySpark only runs the calls of a
+#   Python thread on the same JVM thread in pinned-thread mode ('PYSPARK_PIN_THREAD', Spark 3.0+), so otherwise the
+#   jobs of a shard may show up without a group. When samples are streamed one at a time, those are the jobs started
+#   since the previous shard. When samples are streamed together they can't be told apart, and are left out.
+#
+#   The profile is a tab-delimited file with one row per shard, see 'STAGE_PROFILE_COLUMNS'.
+#
+#   DEPENDENCIES:
+#
+#       • Apache-Spark
+#       • Python & the modules listed below
+#
+#   You can check the python modules currently installed in your system by running: python -c "help('modules')"
+#
+#   USAGE:
+#       Run the program with the "--help" flag to see usage instructions.
+#
+#	AUTHOR:
+#           Camilo Valdes (camilo@castflyer.com)
+#			Florida International University (FIU)
+#
+#
+# ---------------------------------------------------------------------------------------------------------------------
+
+# 	Python Modules
+import os, sys
+import time
+import json
+import calendar
+from datetime import datetime
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+
+STAGE_PROFILE_COLUMNS = ["sample_id", "batch", "jobs", "stages", "skipped_stages", "tasks", "failed_tasks",
+                         "wall_time_s", "task_time_s", "cpu_time_s", "input_records", "output_records",
+                         "shuffle_read_bytes", "shuffle_write_bytes", "shuffle_read_records", "shuffle_write_records",
+                         "slowest_stage", "slowest_stage_s"]
+
+#   Stage statuses, as reported by the REST API.
+FINISHED_STAGE_STATUSES = ["COMPLETE", "FAILED", "SKIPPED"]
+
+#   Seconds to wait for Spark's listener to catch up when the profile is closed.
+CLOSE_TIMEOUT = 10
+
+
+# ------------------------------------------------- Driver Functions --------------------------------------------------
+#
+#   These run in the Spark driver.
+#
+
+def get_batch_job_group(sample_id, batch_label):
+    """
+    Builds the name of the Spark job group of a shard.
+    Args:
+        sample_id:      The sample's ID.
+        batch_label:    The label of the shard, e.g., its shard number.
+
+    Returns:
+        The job group name.
+    """
+    return "flint_" + str(sample_id) + "_" + str(batch_label)
+
+
+def parse_spark_time(spark_time):
+    """
+    Parses a timestamp from the Spark REST API, e.g., '2018-10-03T21:05:24.343GMT'.
+    Args:
+        spark_time: The timestamp string, or None.
+
+    Returns:
+        Seconds since the epoch, or None.
+    """
+    if not spark_time:
+        return None
+
+    parsed_time = datetime.strptime(spark_time.replace("GMT", ""), "%Y-%m-%dT%H:%M:%S.%f")
+
+    return calendar.timegm(parsed_time.timetuple()) + parsed_time.microsecond / 1e6
+
+
+def get_stage_attempts(ui_url, application_id, stage_id):
+    """
+    Retrieves the attempts of a stage from the monitoring REST API of the Spark UI.
+    Args:
+        ui_url:         The URL of the Spark UI, see 'SparkContext.uiWebUrl'.
+        application_id: The Spark application ID.
+        stage_id:       The stage ID.
+
+    Returns:
+        A list of dictionaries, one per stage attempt.
+    """
+    stage_url = ui_url + "/api/v1/applications/" + application_id + "/stages/" + str(stage_id)
+
+    response = urlopen(stage_url, timeout=5)
+    try:
+        return json.loads(response.read().decode('utf-8'))
+    finally:
+        response.close()
+
+
+def summarize_stages(stage_attempts):
+    """
+    Adds up the metrics of a shard's stages into a single profile row.
+    Args:
+        stage_attempts: A list with the attempts of every stage of the shard, from 'get_stage_attempts()'.
+
+    Returns:
+        A dictionary with the 'STAGE_PROFILE_COLUMNS' metrics (sample, batch, and jobs are left out).
+    """
+    row = {"stages": 0, "skipped_stages": 0, "tasks": 0, "failed_tasks": 0, "task_time_s": 0.0, "cpu_time_s": 0.0,
+           "input_records": 0, "output_records": 0, "shuffle_read_bytes": 0, "shuffle_write_bytes": 0,
+           "shuffle_read_records": 0, "shuffle_write_records": 0, "slowest_stage": "", "slowest_stage_s": 0.0}
+
+    first_submission    = None
+    last_completion     = None
+    stage_ids           = set()
+
+    for attempt in stage_attempts:
+        stage_ids.add(attempt.get("stageId"))
+
+        if attempt.get("status") == "SKIPPED":
+            row["skipped_stages"] += 1
+            continue
+
+        row["tasks"]                    += attempt.get("numCompleteTasks", 0)
+        row["failed_tasks"]             += attempt.get("numFailedTasks", 0)
+        row["task_time_s"]              += attempt.get("executorRunTime", 0) / 1000.0
+        row["cpu_time_s"]               += attempt.get("executorCpuTime", 0) / 1e9
+        row["input_records"]            += attempt.get("inputRecords", 0)
+        row["output_records"]           += attempt.get("outputRecords", 0)
+        row["shuffle_read_bytes"]       += attempt.get("shuffleReadBytes", 0)
+        row["shuffle_write_bytes"]      += attempt.get("shuffleWriteBytes", 0)
+        row["shuffle_read_records"]     += attempt.get("shuffleReadRecords", 0)
+        row["shuffle_write_records"]    += attempt.get("shuffleWriteRecords", 0)
+
+        submission_time = parse_spark_time(attempt.get("submissionTime"))
+        completion_time = parse_spark_time(attempt.get("completionTime"))
+
+        if submission_time is None or completion_time is None:
+            continue
+
+        if first_submission is None or submission_time < first_submission:
+            first_submission = submission_time
+        if last_completion is None or completion_time > last_completion:
+            last_completion = completion_time
+
+        if completion_time - submission_time > row["slowest_stage_s"]:
+            row["slowest_stage_s"]  = completion_time - submission_time
+            row["slowest_stage"]    = str(attempt.get("stageId")) + ":" + attempt.get("name", "").split(" ")[0]
+
+    row["stages"] = len(stage_ids)
+    row["wall_time_s"] = (last_completion - first_submission) if first_submission is not None else 0.0
+
+    return row
+
+
+class StageProfiler(object):
+    """
+    Records one profile row per shard from Spark's status tracker and REST API. Usage: call 'begin_batch()' before
+    the first Spark job of a shard, 'end_batch()' after its last one, and 'close()' at the end of the run.
+
+    """
+    def __init__(self, sc, sample_id, output_file, concurrent_samples=False):
+        """
+        Args:
+            sc:                 Spark Context.
+            sample_id:          The sample's ID.
+            output_file:        Path of the profile file.
+            concurrent_samples: True if other samples are streamed at the same time, in the same Spark context.
+        """
+        self.sc                 = sc
+        self.sample_id          = sample_id
+        self.output_file        = output_file
+        self.concurrent_samples = concurrent_samples
+        self.pending_batches    = []
+        self.last_job_id        = -1
+
+        output_dir = os.path.dirname(output_file)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        if not os.path.exists(output_file):
+            with open(output_file, "w") as profile_file:
+                profile_file.write("\t".join(STAGE_PROFILE_COLUMNS) + "\n")
+
+        if sc.uiWebUrl is None:
+            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] [WARNING] ⚠️ The Spark UI is " +
+                  "disabled. Stage profiles will only have job, stage, and task counts.")
+
+    def begin_batch(self, batch_label):
+        """
+        Tags the Spark jobs that follow with the shard's job group.
+        """
+        self.sc.setJobGroup(get_batch_job_group(self.sample_id, batch_label), "Flint Shard " + str(batch_label))
+
+    def end_batch(self, batch_label):
+        """
+        Looks up the jobs of the shard, and queues the shard for profiling. Profile rows are written for all the
+        queued shards whose stages are finished.
+        """
+        status_tracker = self.sc.statusTracker()
+
+        job_ids = list(status_tracker.getJobIdsForGroup(get_batch_job_group(self.sample_id, batch_label)))
+
+        #   Without pinned threads the job group may not reach the JVM thread that submitted the jobs, and the jobs
+        #   show up without a group (see the notes at the top of this file). We pick those started since the previous
+        #   shard, unless other samples could have started some of them.
+        if not job_ids and not self.concurrent_samples:
+            job_ids = [job_id for job_id in status_tracker.getJobIdsForGroup(None) if job_id > self.last_job_id]
+
+        if job_ids:
+            self.last_job_id = max(self.last_job_id, max(job_ids))
+
+        stage_ids = []
+        for job_id in sorted(job_ids):
+            job_info = status_tracker.getJobInfo(job_id)
+            if job_info is not None:
+                stage_ids.extend(job_info.stageIds)
+
+        self.pending_batches.append((batch_label, len(job_ids), sorted(set(stage_ids))))
+
+        self.sc._jsc.clearJobGroup()
+
+        self.flush()
+
+    def flush(self, wait_seconds=0):
+        """
+        Writes the profile rows of the queued shards whose stages are finished.
+        Args:
+            wait_seconds:   How long to wait for unfinished stages before giving up on them, and writing what we have.
+        """
+        deadline = time.time() + wait_seconds
+
+        while self.pending_batches:
+            batch_label, number_of_jobs, stage_ids = self.pending_batches[0]
+
+            row = self.profile_stages(stage_ids)
+
+            if row is None:
+                if time.time() < deadline:
+                    time.sleep(0.5)
+                    continue
+                if wait_seconds == 0:
+                    break
+
+                row = self.profile_stages(stage_ids, finished_only=False)
+
+            row["sample_id"]    = self.sample_id
+            row["batch"]        = batch_label
+            row["jobs"]         = number_of_jobs
+
+            with open(self.output_file, "a") as profile_file:
+                profile_file.write("\t".join(str(row.get(column, "")) for column in STAGE_PROFILE_COLUMNS) + "\n")
+
+            self.pending_batches.pop(0)
+
+    def profile_stages(self, stage_ids, finished_only=True):
+        """
+        Builds the profile row of a list of stages.
+        Args:
+            stage_ids:      The IDs of the stages of a shard.
+            finished_only:  Return None if some of the stages are still running.
+
+        Returns:
+            A dictionary with the profile row, or None.
+        """
+        if self.sc.uiWebUrl is None:
+            status_tracker = self.sc.statusTracker()
+            stage_infos = [status_tracker.getStageInfo(stage_id) for stage_id in stage_ids]
+            stage_infos = [stage_info for stage_info in stage_infos if stage_info is not None]
+
+            return {"stages": len(stage_ids),
+                    "tasks": sum(stage_info.numCompletedTasks for stage_info in stage_infos),
+                    "failed_tasks": sum(stage_info.numFailedTasks for stage_info in stage_infos)}
+
+        stage_attempts = []
+
+        for stage_id in stage_ids:
+            try:
+                attempts = get_stage_attempts(self.sc.uiWebUrl, self.sc.applicationId, stage_id)
+            except IOError:
+                #   The UI drops old stages (see 'spark.ui.retainedStages'), nothing to profile for them.
+                continue
+
+            if finished_only and any(attempt.get("status") not in FINISHED_STAGE_STATUSES for attempt in attempts):
+                return None
+
+            stage_attempts.extend(attempts)
+
+        return summarize_stages(stage_attempts)
+
+    def close(self):
+        """
+        Writes the profile rows of any shards that are still queued.
+        """
+        self.flush(wait_seconds=CLOSE_TIMEOUT)
+
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Stage Profile: " + self.output_file)
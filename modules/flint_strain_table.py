@@ -0,0 +1,167 @@
+# coding: utf-8
+# ---------------------------------------------------------------------------------------------------------------------
+#
+#                                       Florida International University
+#
+#   This software is a "Camilo Valdes Work" under the terms of the United States Copyright Act.
+#   Please cite the author(s) in any work or product based on this material.
+#
+#   OBJECTIVE:
+#	The purpose of this file is to map the genomic assemblies (contigs) in the Bowtie2 index to integer strain IDs,
+#   so that alignments travel through Spark as (read ID, strain ID) integer pairs instead of strings.
+#
+#
+#   NOTES:
+#   Please see the dependencies section below for the required libraries (if any).
+#
+#   The strain table is built when the index is built (see 'genome_preprocessing/6-indexing/build_strain_table.py'),
+#   and it is a tab-delimited file with one line per contig:
+#
+#       <contig name (RNAME)>   <strain ID>     <strain (GCA_ formatted ID)>
+#
+#   Strain ID 0 is reserved for contigs that are not in the table and can't be folded up into a known strain. Strain
+#   names are only restored when the reports are written.
+#
+#   DEPENDENCIES:
+#
+#       • Python & the modules listed below
+#
+#   You can check the python modules currently installed in your system by running: python -c "help('modules')"
+#
+#   USAGE:
+#       Run the program with the "--help" flag to see usage instructions.
+#
+#	AUTHOR:
+#           Camilo Valdes (camilo@castflyer.com)
+#			Florida International University (FIU)
+#
+#
+# ---------------------------------------------------------------------------------------------------------------------
+
+# 	Python Modules
+import os, sys
+
+
+UNKNOWN_STRAIN_ID   = 0
+UNKNOWN_STRAIN_NAME = "unknown"
+
+
+
+# ------------------------------------------------ Custom Classes -----------------------------------------------------
+#
+class StrainTable(object):
+    """
+    Maps contig names (RNAME) to integer strain IDs, and strain IDs back to strain names. It is broadcast once per
+    run, and used by the Executors to encode alignments as they are parsed.
+    """
+    def __init__(self, strain_names, contig_to_strain=None):
+        """
+        Args:
+            strain_names:       List of strain names ('GCA_' formatted IDs), indexed by strain ID. Index 0 is the
+                                'unknown' strain.
+            contig_to_strain:   Dictionary with a contig name as KEY, and its strain ID as VALUE. If None, contigs are
+                                folded up into their strain by name.
+        """
+        self.strain_names       = strain_names
+        self.contig_to_strain   = contig_to_strain
+        self.strain_to_id       = dict((strain_name, strain_id) for strain_id, strain_name in enumerate(strain_names))
+
+    def get_strain_id(self, reference_name):
+        """
+        Retrieves the strain ID of a contig.
+        Args:
+            reference_name: The RNAME of an alignment.
+
+        Returns:
+            The integer strain ID, or 'UNKNOWN_STRAIN_ID'.
+        """
+        if self.contig_to_strain is not None:
+            strain_id = self.contig_to_strain.get(reference_name)
+            if strain_id is not None:
+                return strain_id
+
+        return self.strain_to_id.get(get_strain_key(reference_name), UNKNOWN_STRAIN_ID)
+
+    def get_strain_name(self, strain_id):
+        """
+        Retrieves the name of a strain.
+        Args:
+            strain_id:  An integer strain ID.
+
+        Returns:
+            The 'GCA_' formatted ID of the strain.
+        """
+        return self.strain_names[strain_id]
+
+    def get_number_of_strains(self):
+        """
+        Returns:
+            The number of strain IDs, including the 'unknown' strain.
+        """
+        return len(self.strain_names)
+
+
+
+# ------------------------------------------------ Strain Functions ---------------------------------------------------
+#
+
+def get_strain_key(reference_name):
+    """
+    Folds a genomic assembly name (RNAME) into the strain it belongs to. The indexed FASTA records start with the
+    GCA number of the assembly, delimited by a period (see 'genome_preprocessing/4-fasta_concatenation').
+    Args:
+        reference_name: The RNAME of an alignment.
+
+    Returns:
+        The 'GCA_' formatted ID of the strain, as used in the annotations.
+    """
+    return "GCA_" + reference_name.split(".")[0]
+
+
+def load_strain_table(table_lines):
+    """
+    Parses the lines of a strain table file.
+    Args:
+        table_lines:    An iterable of tab-delimited lines, see the notes at the top of this file.
+
+    Returns:
+        A 'StrainTable' object.
+    """
+    contig_to_strain = {}
+    strain_names     = {UNKNOWN_STRAIN_ID: UNKNOWN_STRAIN_NAME}
+
+    for a_line in table_lines:
+        if isinstance(a_line, bytes):
+            a_line = a_line.decode('utf-8')
+
+        a_line = a_line.strip()
+        if not a_line:
+            continue
+
+        contig_name, strain_id, strain_name = a_line.split("\t")
+        strain_id = int(strain_id)
+
+        contig_to_strain[contig_name] = strain_id
+        strain_names[strain_id]       = strain_name
+
+    strain_names_list = [strain_names.get(strain_id, UNKNOWN_STRAIN_NAME)
+                         for strain_id in range(max(strain_names) + 1)]
+
+    return StrainTable(strain_names_list, contig_to_strain)
+
+
+def build_strain_table(reference_names):
+    """
+    Assigns strain IDs to the contigs of an index. Strains are numbered in sorted order, starting at 1.
+    Args:
+        reference_names:    An iterable of contig names, as they appear in the indexed FASTA records.
+
+    Returns:
+        A list of (contig name, strain ID, strain name) tuples.
+    """
+    reference_names = list(reference_names)
+    strain_keys     = sorted(set(get_strain_key(reference_name) for reference_name in reference_names))
+    strain_to_id    = dict((strain_key, strain_id) for strain_id, strain_key in enumerate(strain_keys, 1))
+
+    return [(reference_name, strain_to_id[get_strain_key(reference_name)], get_strain_key(reference_name))
+            for reference_name in reference_names]
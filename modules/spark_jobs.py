@@ -34,31 +34,68 @@ import os, sys
 import time
 from datetime import timedelta
 import csv
+import json
 import pprint as pp
 from pathlib2 import Path
 import shlex
-import pickle
-import json
 import subprocess as sp
+import itertools
+import socket
+import threading
+import numpy as np
+from pyspark import SparkFiles
+from pyspark.streaming import StreamingContext
 from pyspark.streaming.kinesis import KinesisUtils, InitialPositionInStream
 from pyspark.accumulators import AccumulatorParam
 
+#   Flint Modules
+import flint_bowtie2_mapping as bowtieUtils
+import flint_index_shards as shards
+import flint_abundances as abundanceUtils
+import flint_metrics as metricsUtils
+import flint_fastq as fastqUtils
+import flint_kinesis as kinesisUtils
+import flint_batch_control as batchControl
+
 
 
 # ------------------------------------------------ Custom Classes -----------------------------------------------------
 #
 class AbundanceAccumulator(AccumulatorParam):
     """
-    Custom class for stockpiling the rolling abundance counts for a given bacterial strain. Big thanks go to
+    Custom class for stockpiling the rolling abundance counts of all bacterial strains. The value is a NumPy float64
+    vector indexed by strain ID (see 'flint_strain_table.py'), so merges are vectorized adds. Big thanks go to
     StackOverflow and the following post:
     https://stackoverflow.com/questions/44640184/accumulator-in-pyspark-with-dict-as-global-variable
 
     """
-    def zero(self,  value = ""):
-        return dict()
+    def zero(self, value):
+        return np.zeros_like(value)
+
+    def addInPlace(self, value1, value2):
+        #   Either a full abundance vector, or a sparse (strain IDs, abundances) pair of arrays.
+        if isinstance(value2, tuple):
+            np.add.at(value1, value2[0], value2[1])
+        else:
+            value1 += value2
+        return value1
+
+
+class AlignmentStatsAccumulator(AccumulatorParam):
+    """
+    Custom class for collecting the alignment metrics of a shard as a side output of the SAM parsing (see
+    'flint_bowtie2_mapping.count_alignments()'). The value is a dictionary with the index shard (or the worker node
+    that holds it) as KEY, and a stats record as VALUE. Note that Spark may count a task twice if it is re-executed.
+
+    """
+    def zero(self, value):
+        return {}
 
     def addInPlace(self, value1, value2):
-        value1.update(value2)
+        for shard_key, alignment_stats in value2.items():
+            shard_stats = value1.setdefault(shard_key, bowtieUtils.new_alignment_stats())
+            for metric, count in alignment_stats.items():
+                shard_stats[metric] += count
         return value1
 
 
@@ -73,28 +110,138 @@ BOWTIE2_PATH = ""
 BOWTIE2_INDEX_PATH = ""
 BOWTIE2_INDEX_NAME = ""
 BOWTIE2_THREADS = 2
+USE_ALIGN_SERVICE = False
+DISTRIBUTED_READS = False
+INDEX_SHARD_REGISTRY = None
+STRAIN_TABLE = None
+ABUNDANCE_MODEL = abundanceUtils.ABUNDANCE_MODEL_FRACTIONAL
+WAIT_FOR_END_OF_STREAM = False
+
+#   Sentinel file that marks the end of a sample in its stream directory. Files that start with a '.' are not picked
+#   up by 'textFileStream()'.
+END_OF_STREAM_FILE = ".flint_end_of_stream"
+
+#   Seconds between the checks of the end-of-stream watcher, see 'watch_end_of_stream()'.
+END_OF_STREAM_POLL_INTERVAL = 0.5
+
+
+#
+#   Sample State.
+#   One Spark context processes all the samples of a run, so everything that belongs to a single sample (counters,
+#   timers, and the rolling profile) lives in a 'SampleState' object, and not in the globals above. The states are
+#   kept by sample ID in 'SAMPLE_STATES', and 'CURRENT_SAMPLE_ID' is the sample that the accessors below default to.
+#   Functions that Spark serializes, e.g., those of the stream operations, hold on to a sample ID, and never to the
+#   state itself.
+#
+class SampleState(object):
+    """
+    Run state of a single sample.
+    """
+    def __init__(self, sample_id):
+        self.sample_id                  = sample_id
+
+        self.rdd_counter                = 0
+        self.number_of_shards           = 0
+        self.analysis_start_time        = 0
+        self.analysis_end_time          = 0
+        self.time_of_last_rdd           = 0
+        self.streaming_timeout          = 0
+
+        self.checkpoint_dir             = None
+        self.overall_abundances         = None
+        self.rolling_profile            = None
+        self.streaming_finished         = False
+        self.previous_batch_abundances  = None
+
+        self.stream_start_time          = 0
+        self.end_of_stream_markers      = {}
+        self.end_of_stream_batch_time   = None
+        self.completed_batch_time       = 0
+
+        self.processed_files            = set()
+        self.pending_files              = {}
+        self.resumed_from_ledger        = False
+
+        self.batch_size_controller      = None
+        self.batch_bytes                = {}
+
+        self.stage_profiler             = None
+        self.metrics_recorder           = None
+
+
+SAMPLE_STATES = {}
+CURRENT_SAMPLE_ID = None
+
+def start_sample_state(sample_id):
+    """
+    Creates a fresh state for a sample, and makes it the current sample.
+    Args:
+        sample_id:  The unique id of the sample.
+
+    Returns:
+        The 'SampleState' object.
+    """
+    global CURRENT_SAMPLE_ID
+
+    SAMPLE_STATES[sample_id] = SampleState(sample_id)
+    CURRENT_SAMPLE_ID = sample_id
+
+    return SAMPLE_STATES[sample_id]
+
+def get_sample_state(sample_id=None):
+    """
+    Retrieves the state of a sample.
+    Args:
+        sample_id:  The unique id of the sample. Defaults to the current sample.
+
+    Returns:
+        The 'SampleState' object.
+    """
+    if sample_id is None:
+        sample_id = CURRENT_SAMPLE_ID
+
+    return SAMPLE_STATES[sample_id]
+
+def finish_sample_state(sample_id):
+    """
+    Drops the state of a sample once its reports have been written, so that its rolling profile can be collected.
+    Args:
+        sample_id:  The unique id of the sample.
+
+    Returns:
+        Nothing.
+    """
+    global CURRENT_SAMPLE_ID
+
+    SAMPLE_STATES.pop(sample_id, None)
+
+    if CURRENT_SAMPLE_ID == sample_id:
+        CURRENT_SAMPLE_ID = None
 
-RDD_COUNTER = 0
-NUMBER_OF_SHARDS_ALL = 0
-ANALYSIS_START_TIME = 0
-ANALYSIS_END_TIME = 0
+def get_scheduler_pool(sample_id=None):
+    """
+    Builds the name of the fair-scheduler pool of a sample.
+    Args:
+        sample_id:  The unique id of the sample. Defaults to the current sample.
 
-TIME_OF_LAST_RDD = 0
+    Returns:
+        The pool name.
+    """
+    return "flint_" + str(get_sample_state(sample_id).sample_id)
 
 #
 #   Assorted methods for accessing the above.
 #
-def increment_rdd_count():
+def increment_rdd_count(sample_id=None):
     """
     Increments the count that we use as an affix for the profile files.
     Returns:
             Nothing. It just increments the counter variable that we use to keep track of the incoming RDDs.
     """
-    global RDD_COUNTER
-    RDD_COUNTER = RDD_COUNTER + 1
+    get_sample_state(sample_id).rdd_counter += 1
 
 
-def set_number_of_shards(num_shards_from_run):
+def set_number_of_shards(num_shards_from_run, sample_id=None):
     """
     Sets global number of shards to the specified number of shards from an experimental run.
     Args:
@@ -102,31 +249,28 @@ def set_number_of_shards(num_shards_from_run):
     Returns:
         Nothing. This is a 'set()' function.
     """
-    global NUMBER_OF_SHARDS_ALL
-    NUMBER_OF_SHARDS_ALL = num_shards_from_run
+    get_sample_state(sample_id).number_of_shards = num_shards_from_run
 
 
-def get_shard_counter():
+def get_shard_counter(sample_id=None):
     """
     Accessor for returning the current number of shards that we have processed.
     Returns:
             Integer containing the current count of processed shards.
     """
-    global RDD_COUNTER
-    return int(RDD_COUNTER)
+    return int(get_sample_state(sample_id).rdd_counter)
 
 
-def get_shards():
+def get_shards(sample_id=None):
     """
     Accessor for returning the value of the overall number of shards we want to analyze.
     Returns:
             Integer containing the number of overall shards.
     """
-    global NUMBER_OF_SHARDS_ALL
-    return int(NUMBER_OF_SHARDS_ALL)
+    return int(get_sample_state(sample_id).number_of_shards)
 
 
-def shard_equals_counter():
+def shard_equals_counter(sample_id=None):
     """
     Checks whether the number of shards processed equals the specified limit.
     Returns:
@@ -134,27 +278,34 @@ def shard_equals_counter():
             False otherwise.
     """
     equality_check = False
-    if get_shard_counter() == get_shards():
+    if get_shard_counter(sample_id) == get_shards(sample_id):
         equality_check = True
     return equality_check
 
-def set_analysis_start_time():
+def set_analysis_start_time(sample_id=None):
     """
     Sets the time for the analysis when the first streamed shard is captured.
     Returns:
             Nothing, this is a 'setter' method.
     """
-    global ANALYSIS_START_TIME
-    ANALYSIS_START_TIME = time.time()
+    get_sample_state(sample_id).analysis_start_time = time.time()
 
-def set_analysis_end_time():
+def set_analysis_end_time(sample_id=None):
     """
     Sets the time for when all the shards have been processed.
     Returns:
             Nothing, this is a 'setter' method.
     """
-    global ANALYSIS_END_TIME
-    ANALYSIS_END_TIME = time.time()
+    get_sample_state(sample_id).analysis_end_time = time.time()
+
+def get_analysis_run_time(sample_id=None):
+    """
+    Retrieves the time between the first streamed shard and the last one.
+    Returns:
+            The run time in seconds.
+    """
+    sample_state = get_sample_state(sample_id)
+    return sample_state.analysis_end_time - sample_state.analysis_start_time
 
 def set_bowtie2_path(bowtie2_node_path):
     """
@@ -242,39 +393,256 @@ def get_bowtie2_number_threads():
     global BOWTIE2_THREADS
     return BOWTIE2_THREADS
 
-def set_time_of_last_rdd(time_of_last_rdd_processed):
+def set_use_align_service(use_align_service):
+    """
+    Sets whether reads are aligned by the resident Bowtie2 service in each worker node ('services/align_service.py')
+    instead of a new Bowtie2 process for every partition.
+    Args:
+        use_align_service:  Boolean flag.
+
+    Returns:
+        Nothing.
+    """
+    global USE_ALIGN_SERVICE
+    USE_ALIGN_SERVICE = use_align_service
+
+def get_use_align_service():
+    """
+    Retrieves whether reads are aligned by the resident Bowtie2 service.
+    Returns:
+        True if the resident Bowtie2 service is used, False otherwise.
+    """
+    global USE_ALIGN_SERVICE
+    return USE_ALIGN_SERVICE
+
+def set_distributed_reads(distributed_reads):
+    """
+    Sets whether the reads of a shard stay distributed in the Executors, instead of being collected in the driver
+    and broadcast to every worker node.
+    Args:
+        distributed_reads:  Boolean flag.
+
+    Returns:
+        Nothing.
+    """
+    global DISTRIBUTED_READS
+    DISTRIBUTED_READS = distributed_reads
+
+def get_distributed_reads():
+    """
+    Retrieves whether the reads of a shard stay distributed in the Executors.
+    Returns:
+        True if reads are not collected in the driver, False otherwise.
+    """
+    global DISTRIBUTED_READS
+    return DISTRIBUTED_READS
+
+def set_index_shard_registry(index_shard_registry):
+    """
+    Sets the registry of index shards and the worker nodes that hold them (see 'flint_index_shards.py'). When set,
+    each index shard is aligned against once per batch, on a node that holds it.
+    Args:
+        index_shard_registry:   Dictionary from 'flint_index_shards.discover_index_shards()', or None.
+
+    Returns:
+        Nothing.
+    """
+    global INDEX_SHARD_REGISTRY
+    INDEX_SHARD_REGISTRY = index_shard_registry
+
+def get_index_shard_registry():
+    """
+    Retrieves the registry of index shards.
+    Returns:
+        The shard registry dictionary, or None if shard-aware placement is not being used.
+    """
+    global INDEX_SHARD_REGISTRY
+    return INDEX_SHARD_REGISTRY
+
+def set_strain_table(broadcast_strain_table):
+    """
+    Sets the strain table that maps contigs to integer strain IDs (see 'flint_strain_table.py').
+    Args:
+        broadcast_strain_table: A Spark broadcast variable with a 'StrainTable' object.
+
+    Returns:
+        Nothing.
+    """
+    global STRAIN_TABLE
+    STRAIN_TABLE = broadcast_strain_table
+
+def get_strain_table():
+    """
+    Retrieves the strain table.
+    Returns:
+        The Spark broadcast variable with the 'StrainTable' object.
+    """
+    global STRAIN_TABLE
+    return STRAIN_TABLE
+
+def set_checkpoint_dir(checkpoint_dir, sample_id=None):
+    """
+    Sets the directory in which the checkpoint ledger of a sample is saved (see 'write_checkpoint_ledger()'). When
+    set, the rolling profile is kept in the driver instead of in the 'overall_abundances' accumulator.
+    Args:
+        checkpoint_dir: A path that all nodes can reach (HDFS or S3), or None.
+
+    Returns:
+        Nothing.
+    """
+    get_sample_state(sample_id).checkpoint_dir = checkpoint_dir
+
+def get_checkpoint_dir(sample_id=None):
+    """
+    Retrieves the checkpoint directory.
+    Returns:
+        The checkpoint directory, or None if the sample is not checkpointed.
+    """
+    return get_sample_state(sample_id).checkpoint_dir
+
+def set_abundance_model(abundance_model):
+    """
+    Sets the model used to calculate the strain abundances of each shard: 'fractional' splits a read evenly among the
+    strains it aligns to, and 'em' re-assigns multi-mapped reads with Expectation-Maximization.
+    Args:
+        abundance_model: One of 'fractional' or 'em'.
+
+    Returns:
+        Nothing.
+    """
+    global ABUNDANCE_MODEL
+    ABUNDANCE_MODEL = abundance_model
+
+def get_abundance_model():
+    """
+    Retrieves the abundance model.
+    Returns:
+        The abundance model, 'fractional' or 'em'.
+    """
+    global ABUNDANCE_MODEL
+    return ABUNDANCE_MODEL
+
+def set_wait_for_end_of_stream(wait_for_end_of_stream):
+    """
+    Makes streaming wait for the end-of-stream marker of every sample, instead of stopping once the requested number
+    of shards has been processed, or once no data has come in for a while.
+    Args:
+        wait_for_end_of_stream: Boolean flag.
+
+    Returns:
+        Nothing.
+    """
+    global WAIT_FOR_END_OF_STREAM
+    WAIT_FOR_END_OF_STREAM = wait_for_end_of_stream
+
+def get_wait_for_end_of_stream():
+    """
+    Returns:
+        True if streaming stops only at the end-of-stream marker of every sample.
+    """
+    return WAIT_FOR_END_OF_STREAM
+
+def set_stage_profiler(stage_profiler, sample_id=None):
+    """
+    Sets the profiler that records the Spark stage metrics of each shard.
+    Args:
+        stage_profiler: A 'flint_stage_profiler.StageProfiler', or None to turn profiling off.
+
+    Returns:
+        Nothing.
+    """
+    get_sample_state(sample_id).stage_profiler = stage_profiler
+
+def get_stage_profiler(sample_id=None):
+    """
+    Retrieves the stage profiler.
+    Returns:
+        The 'StageProfiler' object, or None if stages are not being profiled.
+    """
+    return get_sample_state(sample_id).stage_profiler
+
+def set_metrics_recorder(metrics_recorder, sample_id=None):
+    """
+    Sets the recorder that exports the metrics of each shard.
+    Args:
+        metrics_recorder:   A 'flint_metrics.MetricsRecorder', or None to turn the metrics export off.
+
+    Returns:
+        Nothing.
+    """
+    get_sample_state(sample_id).metrics_recorder = metrics_recorder
+
+def get_metrics_recorder(sample_id=None):
+    """
+    Retrieves the metrics recorder.
+    Returns:
+        The 'MetricsRecorder' object, or None if metrics are not being exported.
+    """
+    return get_sample_state(sample_id).metrics_recorder
+
+def set_time_of_last_rdd(time_of_last_rdd_processed, sample_id=None):
     """
     Sets the time at which the last RDD was processed.
     Returns:
         Nothing. Set() method.
     """
-    global TIME_OF_LAST_RDD
-    TIME_OF_LAST_RDD = time_of_last_rdd_processed
+    get_sample_state(sample_id).time_of_last_rdd = time_of_last_rdd_processed
 
 
-def get_time_of_last_rdd():
+def get_time_of_last_rdd(sample_id=None):
     """
     Retrieves the time at which the last RDD was processed.
     Returns:
-        TIME_OF_LAST_RDD object that represents the time at which the last RDD ended processing.
+        The time at which the last RDD ended processing.
+    """
+    return get_sample_state(sample_id).time_of_last_rdd
+
+#
+#   Accumulator.
+#   The 'overall_abundances' accumulator ('AbundanceAccumulator') of a sample contains the rolling sum of the
+#   abundances from each of the ingested shards. When there are no more shards to process, we write the abundances to
+#   a file.
+#
+def set_overall_abundances(abundance_acc, sample_id=None):
+    get_sample_state(sample_id).overall_abundances = abundance_acc
+
+def get_overall_abundaces(sample_id=None):
+    return get_sample_state(sample_id).overall_abundances
+
+#
+#   Streaming State.
+#   With a checkpoint directory, the rolling profile is kept in the driver as 'rolling_profile' (a vector indexed by
+#   strain ID), and it is saved in the checkpoint ledger after every batch.
+#
+def get_rolling_profile(sample_id=None):
+    """
+    Retrieves the latest rolling profile. It can be called at any time during the run.
+    Returns:
+        A NumPy vector with the rolling abundance of each strain ID, or None if streaming state is not being used.
     """
-    global TIME_OF_LAST_RDD
-    return TIME_OF_LAST_RDD
+    return get_sample_state(sample_id).rolling_profile
 
 #
-#   Dictionary.
-#   The 'OVERALL_ABUNDANCES' dictionary contains the rolling sum of the abundances from each of the
-#   ingested shards. When there are no more shards to process, we write the abundances to a file.
+#   EM Warm Start.
+#   'previous_batch_abundances' keeps the abundances vector of the last shard, so that the EM iterations of the next
+#   shard can start from it. Consecutive shards of a sample come from the same community, so they converge faster.
 #
-OVERALL_ABUNDANCES = {}
+def set_previous_batch_abundances(strain_abundances_vector, sample_id=None):
+    get_sample_state(sample_id).previous_batch_abundances = strain_abundances_vector
+
+def get_previous_batch_abundances(sample_id=None):
+    return get_sample_state(sample_id).previous_batch_abundances
 
-def set_overall_abundances(abundance_acc):
-    global OVERALL_ABUNDANCES
-    OVERALL_ABUNDANCES = abundance_acc
+def get_coalesced_profile(sample_id=None):
+    """
+    Retrieves the rolling profile for the coalesced report, from the streaming state or from the accumulator.
+    Returns:
+        A NumPy vector with the rolling abundance of each strain ID.
+    """
+    if get_checkpoint_dir(sample_id) is not None:
+        return get_rolling_profile(sample_id)
 
-def get_overall_abundaces():
-    global OVERALL_ABUNDANCES
-    return OVERALL_ABUNDANCES
+    return get_overall_abundaces(sample_id).value
 
 
 
@@ -284,9 +652,11 @@ def get_overall_abundaces():
 def dispatch_stream_from_dir(stream_source_dir, sampleID, sample_format, output_file, save_to_local, save_to_s3,
                              partition_size, ssc, sensitive_align, annotations_dictionary, s3_output_bucket,
                              number_of_shards, keep_shard_profiles, coalesce_output, sample_type, verbose_output,
-                             debug_mode, streaming_timeout):
+                             debug_mode, streaming_timeout, max_files_per_batch=None, max_reads_per_batch=None,
+                             target_batch_seconds=None):
     """
-    Executes the requested Spark job in the cluster using a streaming strategy.
+    Sets up the stream of a sample in the Streaming context. Streaming starts with 'run_streaming()', once the
+    streams of all the samples that are processed together have been set up.
     Args:
         stream_source_dir:      The directory to stream files from.
         number_of_shards:       The number of shards that we'll be picking up from 'stream_source_dir'.
@@ -306,6 +676,9 @@ def dispatch_stream_from_dir(stream_source_dir, sampleID, sample_format, output_
         verbose_output:         Flag for wordy terminal print statements.
         debug_mode:             Flag for debug mode. Activates slow checkpoints.
         streaming_timeout:      Time (in sec) after which streaming will stop.
+        max_files_per_batch:    Most shard files in a batch. None for no limit.
+        max_reads_per_batch:    Most reads in a batch, estimated from the size of the files. None for no limit.
+        target_batch_seconds:   Alignment time (in sec) that the batches are sized for. None to keep the batch size.
 
     Returns:
         Nothing, if all goes well it should return cleanly.
@@ -326,9 +699,28 @@ def dispatch_stream_from_dir(stream_source_dir, sampleID, sample_format, output_
     print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] ")
 
     #   Set the number of shards so that we can safely exit after we have analyzed the requested number of shards.
-    set_number_of_shards(int(number_of_shards))
+    set_number_of_shards(int(number_of_shards), sampleID)
+    set_streaming_timeout(streaming_timeout, sampleID)
+
+    #   Bursts of shard files are spread over several batches, see 'flint_batch_control.py'.
+    if max_files_per_batch is not None or max_reads_per_batch is not None or target_batch_seconds is not None:
+        set_batch_size_controller(batchControl.BatchSizeController(max_files=max_files_per_batch,
+                                                                   max_reads=max_reads_per_batch,
+                                                                   target_seconds=target_batch_seconds), sampleID)
+
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Batch Size Limits: " +
+              str(max_files_per_batch) + " files, " + str(max_reads_per_batch) + " reads, " +
+              str(target_batch_seconds) + " sec. target alignment time")
+
+    #   The producer drops a sentinel file into the directory once it has copied all the shards of the sample. A
+    #   sentinel left over from an earlier run is older than the stream, and is ignored, unless the run picks up
+    #   where that run left off (see 'load_checkpoint_ledger()').
+    end_of_stream_path = stream_source_dir.rstrip("/") + "/" + END_OF_STREAM_FILE
 
-    kinesis_decode = False
+    if get_file_modification_time(ssc.sparkContext, end_of_stream_path) is not None:
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] WARNING! Found an old end of " +
+              "stream sentinel, " + end_of_stream_path + ". Unless the run resumes from a checkpoint ledger, touch " +
+              "it again once all the shards are copied.")
 
     #   Tab5-formatted FASTQ reads.
     if sample_format == "tab5":
@@ -340,58 +732,221 @@ def dispatch_stream_from_dir(stream_source_dir, sampleID, sample_format, output_
         #
         sc = ssc.sparkContext
 
-        overall_abundance_accumulator = sc.accumulator({}, AbundanceAccumulator())
-        set_overall_abundances(overall_abundance_accumulator)
+        #   One slot per strain ID, so the size is fixed by the strain table.
+        number_of_strains = get_strain_table().value.get_number_of_strains()
+        overall_abundance_accumulator = sc.accumulator(np.zeros(number_of_strains, dtype=np.float64),
+                                                       AbundanceAccumulator())
+        set_overall_abundances(overall_abundance_accumulator, sampleID)
 
         #   In this approach, we'll stream the reads from a S3 directory that we monitor with Spark.
-        sample_dstream = ssc.textFileStream(stream_source_dir)
-
-        sample_dstream.foreachRDD(lambda rdd: profile_sample(sampleReadsRDD=rdd,
-                                                             sc=sc,
-                                                             ssc=ssc,
-                                                             output_file=output_file,
-                                                             save_to_s3=save_to_s3,
-                                                             save_to_local=save_to_local,
-                                                             sample_type=sample_type,
-                                                             sensitive_align=sensitive_align,
-                                                             annotations_dictionary=annotations_dictionary,
-                                                             partition_size=partition_size,
-                                                             s3_output_bucket=s3_output_bucket,
-                                                             kinesis_decode=kinesis_decode,
-                                                             keep_shard_profiles=keep_shard_profiles,
-                                                             coalesce_output=coalesce_output,
-                                                             verbose_output=verbose_output,
-                                                             debug_mode=debug_mode,
-                                                             streaming_timeout=streaming_timeout,
-                                                             bowtie2_node_path=get_bowtie2_path(),
-                                                             bowtie2_index_path=get_bowtie2_index_path(),
-                                                             bowtie2_index_name=get_bowtie2_index_name(),
-                                                             bowtie2_number_threads=get_bowtie2_number_threads()))
-
-
-        # ---------------------------------------- Start Streaming ----------------------------------------------------
-        #
-        #
-        ssc.start()     # Start to schedule the Spark job on the underlying Spark Context.
-        ssc.awaitTermination()      # Wait for the streaming computations to finish.
-        ssc.stop()  # Stop the Streaming context
+        sample_dstream = create_directory_dstream(ssc, stream_source_dir, sampleID)
+
+        def process_sample_batch(rdd, batch_time=None):
+            return profile_sample(sampleReadsRDD=rdd,
+                                  batch_time=batch_time,
+                                  sample_id=sampleID,
+                                  output_file=output_file,
+                                  save_to_s3=save_to_s3,
+                                  save_to_local=save_to_local,
+                                  sample_type=sample_type,
+                                  sensitive_align=sensitive_align,
+                                  annotations_dictionary=annotations_dictionary,
+                                  partition_size=partition_size,
+                                  s3_output_bucket=s3_output_bucket,
+                                  keep_shard_profiles=keep_shard_profiles,
+                                  coalesce_output=coalesce_output,
+                                  verbose_output=verbose_output,
+                                  debug_mode=debug_mode,
+                                  streaming_timeout=streaming_timeout,
+                                  bowtie2_node_path=get_bowtie2_path(),
+                                  bowtie2_index_path=get_bowtie2_index_path(),
+                                  bowtie2_index_name=get_bowtie2_index_name(),
+                                  bowtie2_number_threads=get_bowtie2_number_threads())
+
+        attach_sample_profiler(ssc, sample_dstream, process_sample_batch, sampleID)
+
+
+
+# ------------------------------------------------ Directory Source ---------------------------------------------------
+#
+#   The shard files of each batch are picked in the driver, instead of by 'textFileStream()', so that we know which
+#   files every batch read. Files are moved from 'pending_files' to 'processed_files' once their batch has been folded
+#   into the profile, and 'processed_files' is saved in the checkpoint ledger, so a restarted run skips them. Files
+#   that start with a '.' or a '_' are skipped, as are files that are still being copied ('._COPYING_').
+#
+#   With a batch size controller, a batch takes only the oldest of the waiting files, so a burst of files is spread
+#   over several batches, and the time to align a batch stays bounded (see 'flint_batch_control.py').
+#
+#   'textFileStream()' still ticks the batches. Its own RDDs are never computed.
+#
+def list_stream_files(sc, stream_source_dir):
+    """
+    Lists the files in a stream directory, using the Hadoop File API.
+    Args:
+        sc:                 Spark Context.
+        stream_source_dir:  The directory to stream files from.
 
+    Returns:
+        A list of (path, modification time in seconds, size in bytes) tuples, oldest first.
+    """
+    Path            = sc._gateway.jvm.org.apache.hadoop.fs.Path
+    directory_path  = Path(stream_source_dir)
+    fs              = directory_path.getFileSystem(sc._jsc.hadoopConfiguration())
 
+    if not fs.exists(directory_path):
+        return []
 
-# -------------------------------------------- Stream from a Directory ------------------------------------------------
+    stream_files = []
+    for file_status in fs.listStatus(directory_path):
+        file_name = file_status.getPath().getName()
+
+        if file_status.isDirectory() or file_name.endswith("._COPYING_"):
+            continue
+
+        if file_name != END_OF_STREAM_FILE and (file_name.startswith(".") or file_name.startswith("_")):
+            continue
+
+        stream_files.append((file_status.getPath().toString(), file_status.getModificationTime() / 1000.0,
+                             file_status.getLen()))
+
+    return sorted(stream_files, key=lambda stream_file: (stream_file[1], stream_file[0]))
+
+
+def create_directory_dstream(ssc, stream_source_dir, sample_id=None):
+    """
+    Creates the DStream of reads from the shard files that land in a directory.
+    Args:
+        ssc:                Spark Streaming Context.
+        stream_source_dir:  The directory to stream files from.
+        sample_id:          The unique id of the sample.
+
+    Returns:
+        A DStream of tab5-formatted reads.
+    """
+    sample_id = get_sample_state(sample_id).sample_id
+
+    return ssc.textFileStream(stream_source_dir)\
+              .transform(lambda batch_time, rdd: read_directory_batch(batch_time, rdd.context, stream_source_dir,
+                                                                      sample_id))
+
+
+def read_directory_batch(batch_time, sc, stream_source_dir, sample_id=None):
+    """
+    Picks the shard files of a batch: the files in the directory that no earlier batch has read, up to the limits of
+    the sample's batch size controller (see 'set_batch_size_controller()'). Once the end-of-stream sentinel is in the
+    directory, the batch that picks up the last of the files before it is the last batch of the sample.
+    Args:
+        batch_time:         Time of the batch.
+        sc:                 Spark Context.
+        stream_source_dir:  The directory to stream files from.
+        sample_id:          The unique id of the sample.
+
+    Returns:
+        An RDD with the reads of the batch's files.
+    """
+    sample_state = get_sample_state(sample_id)
+
+    if sample_state.streaming_finished or sample_state.end_of_stream_batch_time is not None:
+        return sc.emptyRDD()
+
+    stream_files = list_stream_files(sc, stream_source_dir)
+
+    #   A sentinel left over from an earlier run is older than the stream, and only counts if we resumed that run.
+    sentinel_found = any(file_path.endswith("/" + END_OF_STREAM_FILE) and
+                         (modification_time >= sample_state.stream_start_time or sample_state.resumed_from_ledger)
+                         for file_path, modification_time, file_size in stream_files)
+
+    claimed_files = set(sample_state.processed_files)
+    for pending_batch_files in sample_state.pending_files.values():
+        claimed_files.update(pending_batch_files)
+
+    waiting_files = [(file_path, file_size) for file_path, modification_time, file_size in stream_files
+                     if file_path not in claimed_files and not file_path.endswith("/" + END_OF_STREAM_FILE)]
+
+    batch_files = waiting_files
+    if sample_state.batch_size_controller is not None:
+        batch_files = sample_state.batch_size_controller.select_files(waiting_files)
+
+    sample_state.pending_files[get_batch_timestamp(batch_time)] = [file_path for file_path, file_size in batch_files]
+    sample_state.batch_bytes[get_batch_timestamp(batch_time)] = sum(file_size for file_path, file_size in batch_files)
+
+    if len(batch_files) < len(waiting_files):
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Batch Size: " +
+              str(len(batch_files)) + " files, " + str(len(waiting_files) - len(batch_files)) +
+              " files waiting (read budget: " + str(sample_state.batch_size_controller.get_read_budget()) + ")")
+
+    #   The last batch is the one that takes the last of the files before the sentinel.
+    if sentinel_found and len(batch_files) == len(waiting_files):
+        sample_state.end_of_stream_batch_time = get_batch_timestamp(batch_time)
+
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] End of Stream Sentinel Found. (" +
+              str(len(batch_files)) + " files in the last batch)")
+
+    if not batch_files:
+        return sc.emptyRDD()
+
+    batch_files = [file_path for file_path, file_size in batch_files]
+
+    return sc.textFile(",".join(batch_files))
+
+
+
+def set_batch_size_controller(batch_size_controller, sample_id=None):
+    """
+    Sets the controller that picks the shard files of each batch of a directory stream.
+    Args:
+        batch_size_controller:  A 'flint_batch_control.BatchSizeController', or None to read every waiting file.
+
+    Returns:
+        Nothing.
+    """
+    get_sample_state(sample_id).batch_size_controller = batch_size_controller
+
+
+def update_batch_size(batch_time, number_input_reads, alignment_total_time, sample_id=None):
+    """
+    Hands the measurements of an aligned batch to the batch size controller of the sample, if it has one.
+    Args:
+        batch_time:             Time of the batch, or None outside of streaming.
+        number_input_reads:     Number of reads in the batch.
+        alignment_total_time:   Time (in sec) taken to align the batch and compute its abundances.
+        sample_id:              The unique id of the sample.
+
+    Returns:
+        Nothing.
+    """
+    sample_state = get_sample_state(sample_id)
+
+    if batch_time is None or sample_state.batch_size_controller is None:
+        return
+
+    batch_bytes = sample_state.batch_bytes.get(get_batch_timestamp(batch_time))
+    sample_state.batch_size_controller.update(number_input_reads, batch_bytes, alignment_total_time)
+
+    if sample_state.batch_size_controller.get_read_budget() is not None:
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Next Batch Read Budget: " +
+              '{:0,.0f}'.format(sample_state.batch_size_controller.get_read_budget()) + " reads")
+
+
+
+# ---------------------------------------------- Stream from Kinesis --------------------------------------------------
 #
 #
 def dispatch_stream_from_kinesis(sampleID, sample_format, output_file, save_to_local, save_to_s3, partition_size, ssc,
                                  app_name, stream_name, endpoint_url, region_name, keep_shard_profiles,
                                  sensitive_align, annotations_dictionary, s3_output_bucket, coalesce_output,
-                                 number_of_shards, sample_type, verbose_output, debug_mode, streaming_timeout):
+                                 number_of_shards, sample_type, verbose_output, debug_mode, streaming_timeout,
+                                 number_of_receivers=1, kinesis_client=None):
     """
-    Executes the requested Spark job in the cluster using a streaming strategy.
+    Sets up the stream of a sample in the Streaming context. Streaming starts with 'run_streaming()', once the
+    streams of all the samples that are processed together have been set up.
     Args:
         sampleID:               The unique id of the sample.
         sample_format:          What type of input format are the reads in (tab5, fastq, tab6, etc.).
         sample_type:            Are the reads single-end or paired-end.
         number_of_shards:       The number of shards that we'll be picking up from the Kinesis stream.
+        number_of_receivers:    The number of Kinesis receivers, usually one per shard of the Kinesis stream.
+        kinesis_client:         A 'FakeKinesisClient' to stream from, instead of Kinesis (local tests only).
         output_file:            The path to the output file.
         save_to_s3:             Flag for storing output to AWS S3.
         save_to_local:          Flag for storing output to the local filesystem.
@@ -420,66 +975,728 @@ def dispatch_stream_from_kinesis(sampleID, sample_format, output_file, save_to_l
           "] Stream Source: [KINESIS]")
     print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Sample ID: " + sampleID +
           " (" + sample_format + ", " + sample_type + ")")
-    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Stream Name: " + endpoint_url)
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Stream Name: " + stream_name)
     print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Region: " + region_name)
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Receivers: " + str(number_of_receivers))
     print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Streaming starting...")
     print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] ")
 
     #   Set the number of shards so that we can safely exit after we have analyzed the requested number of shards.
-    set_number_of_shards(int(number_of_shards))
-
-    kinesis_decode = True
+    set_number_of_shards(int(number_of_shards), sampleID)
+    set_streaming_timeout(streaming_timeout, sampleID)
 
     #   Tab5-formatted FASTQ reads.
     if sample_format == "tab5":
 
         #
-        #   Kinesis streaming
-        #
-        sample_dstream = KinesisUtils.createStream(ssc,
-                                                   app_name,
-                                                   stream_name,
-                                                   endpoint_url,
-                                                   region_name,
-                                                   InitialPositionInStream.TRIM_HORIZON,
-                                                   5)
-
-        #
-        #   Before we do anything, we have to move the data back to the Master. The way Spark Streaming works, is that
-        #   the RDDs will be processed in the Worker in which they were received, which does not parallelize well.
-        #   If we did not ship the input reads back to the master, then they would only be aligned in one Executor.
-        #
-        sc = ssc.sparkContext
-        sample_dstream.foreachRDD(lambda rdd: profile_sample(sampleReadsRDD=rdd,
-                                                             sc=sc,
-                                                             ssc=ssc,
-                                                             output_file=output_file,
-                                                             save_to_s3=save_to_s3,
-                                                             save_to_local=save_to_local,
-                                                             sample_type=sample_type,
-                                                             sensitive_align=sensitive_align,
-                                                             annotations_dictionary=annotations_dictionary,
-                                                             partition_size=partition_size,
-                                                             s3_output_bucket=s3_output_bucket,
-                                                             kinesis_decode=kinesis_decode,
-                                                             keep_shard_profiles=keep_shard_profiles,
-                                                             coalesce_output=coalesce_output,
-                                                             verbose_output=verbose_output,
-                                                             debug_mode=debug_mode,
-                                                             streaming_timeout=streaming_timeout,
-                                                             bowtie2_node_path=get_bowtie2_path(),
-                                                             bowtie2_index_path=get_bowtie2_index_path(),
-                                                             bowtie2_index_name=get_bowtie2_index_name(),
-                                                             bowtie2_number_threads=get_bowtie2_number_threads()))
-
-
-        # ---------------------------------------- Start Streaming ----------------------------------------------------
-        #
+        #   Kinesis streaming. Records are de-aggregated and decoded into tab5 reads in the Executors that received
+        #   them, so that only reads flow into the profiling of every batch. The end-of-stream control records are
+        #   picked out of the raw records first.
         #
-        ssc.start()     # Start to schedule the Spark job on the underlying Spark Context.
-        ssc.awaitTermination()      # Wait for the streaming computations to finish.
-        ssc.stop()  # Stop the Streaming context
+        kinesis_dstream = create_kinesis_dstream(ssc, app_name, stream_name, endpoint_url, region_name,
+                                                 number_of_receivers, kinesis_client)
 
+        kinesis_dstream.foreachRDD(lambda batch_time, rdd: record_end_of_stream_markers(batch_time, rdd, sampleID))
+
+        sample_dstream = kinesis_dstream.flatMap(kinesisUtils.decode_record)
+
+        sc = ssc.sparkContext
+
+        #   One slot per strain ID, so the size is fixed by the strain table.
+        number_of_strains = get_strain_table().value.get_number_of_strains()
+        overall_abundance_accumulator = sc.accumulator(np.zeros(number_of_strains, dtype=np.float64),
+                                                       AbundanceAccumulator())
+        set_overall_abundances(overall_abundance_accumulator, sampleID)
+
+        def process_sample_batch(rdd, batch_time=None):
+            return profile_sample(sampleReadsRDD=rdd,
+                                  batch_time=batch_time,
+                                  sample_id=sampleID,
+                                  output_file=output_file,
+                                  save_to_s3=save_to_s3,
+                                  save_to_local=save_to_local,
+                                  sample_type=sample_type,
+                                  sensitive_align=sensitive_align,
+                                  annotations_dictionary=annotations_dictionary,
+                                  partition_size=partition_size,
+                                  s3_output_bucket=s3_output_bucket,
+                                  keep_shard_profiles=keep_shard_profiles,
+                                  coalesce_output=coalesce_output,
+                                  verbose_output=verbose_output,
+                                  debug_mode=debug_mode,
+                                  streaming_timeout=streaming_timeout,
+                                  bowtie2_node_path=get_bowtie2_path(),
+                                  bowtie2_index_path=get_bowtie2_index_path(),
+                                  bowtie2_index_name=get_bowtie2_index_name(),
+                                  bowtie2_number_threads=get_bowtie2_number_threads())
+
+        attach_sample_profiler(ssc, sample_dstream, process_sample_batch, sampleID)
+
+
+
+
+# ---------------------------------------------- Kinesis Receivers ----------------------------------------------------
+#
+#   A Kinesis receiver is a long-running task that pulls records from the stream, and it takes up an Executor core for
+#   the whole run. A single receiver can't keep up with a stream that has several shards, so one receiver is started
+#   per shard, and their streams are unioned. The received blocks stay in the Executors that pulled them.
+#
+def create_kinesis_dstream(ssc, app_name, stream_name, endpoint_url, region_name, number_of_receivers=1,
+                           kinesis_client=None):
+    """
+    Creates the DStream of raw Kinesis records for a sample.
+    Args:
+        ssc:                    Spark Streaming Context.
+        app_name:               Kinesis app name.
+        stream_name:            Kinesis stream name.
+        endpoint_url:           Kinesis Stream URL.
+        region_name:            Amazon region name for the Kinesis stream.
+        number_of_receivers:    The number of Kinesis receivers.
+        kinesis_client:         A 'FakeKinesisClient' to poll instead of Kinesis.
+
+    Returns:
+        A DStream of record data, as bytes.
+    """
+    if kinesis_client is not None:
+        return create_polling_dstream(ssc, kinesis_client, stream_name)
+
+    kinesis_dstreams = [KinesisUtils.createStream(ssc,
+                                                  app_name,
+                                                  stream_name,
+                                                  endpoint_url,
+                                                  region_name,
+                                                  InitialPositionInStream.TRIM_HORIZON,
+                                                  5,
+                                                  decoder=kinesisUtils.raw_decoder)
+                        for receiver in range(max(int(number_of_receivers), 1))]
+
+    if len(kinesis_dstreams) == 1:
+        return kinesis_dstreams[0]
+
+    return ssc.union(*kinesis_dstreams)
+
+
+def create_polling_dstream(ssc, kinesis_client, stream_name, records_per_shard=10000):
+    """
+    Creates a DStream that polls every shard of a stream from the driver, once per batch. Meant for local tests and
+    benchmarks against a 'FakeKinesisClient', as the client lives in the driver. The records of each shard end up in
+    their own partition, as they would with one receiver per shard. The stream can't be recovered from a checkpoint.
+    Args:
+        ssc:                Spark Streaming Context.
+        kinesis_client:     A 'FakeKinesisClient', or any client with the boto3 Kinesis calls.
+        stream_name:        Kinesis stream name.
+        records_per_shard:  Most records pulled from a shard per batch.
+
+    Returns:
+        A DStream of record data, as bytes.
+    """
+    sc = ssc.sparkContext
+
+    shard_iterators = {}
+    for shard in kinesis_client.list_shards(StreamName=stream_name)["Shards"]:
+        shard_iterators[shard["ShardId"]] = kinesis_client.get_shard_iterator(StreamName=stream_name,
+                                                                              ShardId=shard["ShardId"],
+                                                                              ShardIteratorType="TRIM_HORIZON")\
+                                                          ["ShardIterator"]
+
+    def poll_shards(rdd):
+        shard_records = []
+
+        for shard_id in sorted(shard_iterators):
+            response = kinesis_client.get_records(ShardIterator=shard_iterators[shard_id], Limit=records_per_shard)
+            shard_iterators[shard_id] = response["NextShardIterator"]
+            shard_records.append([record["Data"] for record in response["Records"]])
+
+        return sc.parallelize(shard_records, max(len(shard_records), 1)).flatMap(lambda records: records)
+
+    return ssc.queueStream([], default=sc.emptyRDD()).transform(poll_shards)
+
+
+
+# ---------------------------------------------- Start Streaming ------------------------------------------------------
+#
+#
+def run_streaming(ssc):
+    """
+    Streams the samples set up in the Streaming context, and returns once all of them have finished.
+    Args:
+        ssc:    Spark Streaming Context.
+
+    Returns:
+        Nothing.
+    """
+    ssc.start()     # Start to schedule the Spark job on the underlying Spark Context.
+
+    #   The watcher stops the Streaming context once every sample has reached the end of its stream.
+    streaming_done = threading.Event()
+    watcher = threading.Thread(target=watch_end_of_stream, args=(ssc, streaming_done))
+    watcher.daemon = True
+    watcher.start()
+
+    try:
+        ssc.awaitTermination()      # Wait for the streaming computations to finish.
+    finally:
+        streaming_done.set()
+        watcher.join()
+
+    ssc.stop(stopSparkContext=False)   # Stop the Streaming context, the Spark context is shared by the samples
+
+
+
+# ------------------------------------------------ Streaming State ----------------------------------------------------
+#
+#   Every batch is profiled in a 'foreachRDD()', so its Spark jobs run as the output operation of the batch, and not
+#   while the Streaming context generates the jobs of all the streams. With a checkpoint directory, the abundances of
+#   each batch are added to the rolling profile in the driver, and the profile is saved in the checkpoint ledger after
+#   every batch. The ledger seeds the profile when the sample is started again, e.g., after a driver restart. None of
+#   this is kept in Spark's own checkpoints, so the stream functions never have to be serialized.
+#
+def attach_sample_profiler(ssc, sample_dstream, process_sample_batch, sample_id=None):
+    """
+    Hooks the function that profiles a batch of reads to the stream of reads of a sample.
+    Args:
+        ssc:                    Spark Streaming Context.
+        sample_dstream:         DStream of reads.
+        process_sample_batch:   Function that takes the RDD of a batch (and optionally its time), profiles it, and
+                                returns whether the batch was profiled.
+        sample_id:              The unique id of the sample. Defaults to the current sample.
+
+    Returns:
+        Nothing.
+    """
+    sample_state = get_sample_state(sample_id)
+    sample_id = sample_state.sample_id
+
+    sample_state.stream_start_time = time.time()
+    sample_state.streaming_finished = False
+
+    checkpoint_dir = sample_state.checkpoint_dir
+
+    if checkpoint_dir is None:
+        sample_dstream.foreachRDD(lambda batch_time, rdd: process_sample_batch(rdd, batch_time))
+        return
+
+    sc = ssc.sparkContext
+
+    #   Pick up where a previous run of 'this' sample left off.
+    initial_profile = load_checkpoint_ledger(sc, checkpoint_dir, sample_id)
+    sample_state.rolling_profile = initial_profile
+
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Rolling Profile Checkpoint: " +
+          checkpoint_dir + " (" + str(len(np.flatnonzero(initial_profile))) + " strains, " +
+          str(sample_state.rdd_counter) + " shards, " + str(len(sample_state.processed_files)) +
+          " files restored)")
+
+    sample_dstream.foreachRDD(lambda batch_time, rdd: profile_checkpointed_batch(batch_time, rdd,
+                                                                                 process_sample_batch,
+                                                                                 checkpoint_dir, sample_id))
+
+
+def profile_checkpointed_batch(batch_time, rdd, process_sample_batch, checkpoint_dir, sample_id=None):
+    """
+    Profiles a batch of a sample with a checkpoint directory, and then saves the checkpoint ledger if the batch
+    brought in reads or shard files.
+    Args:
+        batch_time:             Time of the batch.
+        rdd:                    The RDD of reads of the batch.
+        process_sample_batch:   Function that takes the RDD of a batch and its time, profiles it, and returns
+                                whether the batch was profiled.
+        checkpoint_dir:         The checkpoint directory.
+        sample_id:              The unique id of the sample.
+
+    Returns:
+        Nothing.
+    """
+    sample_state = get_sample_state(sample_id)
+
+    shards_before_batch = sample_state.rdd_counter
+    files_before_batch  = len(sample_state.processed_files)
+
+    #   A failed batch leaves the ledger as it was.
+    if not process_sample_batch(rdd, batch_time):
+        return
+
+    if sample_state.rdd_counter == shards_before_batch and len(sample_state.processed_files) == files_before_batch:
+        return
+
+    checkpoint_start_time = time.time()
+    ledger_size = write_checkpoint_ledger(rdd.context, checkpoint_dir, sample_id)
+    checkpoint_seconds = time.time() - checkpoint_start_time
+
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Checkpoint Ledger: " +
+          '{:0,.1f}'.format(ledger_size / 1024.0) + " KB in " + str(timedelta(seconds=checkpoint_seconds)) +
+          " (" + str(sample_state.rdd_counter) + " shards, " + str(len(sample_state.processed_files)) + " files)")
+
+    if get_metrics_recorder(sample_id) is not None:
+        get_metrics_recorder(sample_id).record_checkpoint({"shard": sample_state.rdd_counter,
+                                                           "checkpoint_seconds": checkpoint_seconds,
+                                                           "checkpoint_bytes": ledger_size,
+                                                           "processed_files": len(sample_state.processed_files)})
+
+
+#
+#   Checkpoint Ledger.
+#   Everything a restarted run needs to carry on with a sample is saved in a single JSON file in the checkpoint
+#   directory: the number of shards profiled, the shard files that were read, and the rolling profile (by strain
+#   name). As it is a single file, the profile and the processed files always agree.
+#
+#   The ledger is written to 'ledger.json-tmp' first, and then moved over the old one. The move is a delete and a
+#   rename, so a run that stops in between leaves only the temporary ledger, which is complete as it was closed
+#   before the old one was deleted. The ledger is then restored from it.
+#
+#   The read positions of a Kinesis stream are kept by the Kinesis Client Library, in the lease table of the app.
+#
+def get_ledger_path(checkpoint_dir):
+    """
+    Returns:
+        The path of the checkpoint ledger in the checkpoint directory.
+    """
+    return checkpoint_dir.rstrip("/") + "/ledger.json"
+
+
+def get_ledger_tmp_path(checkpoint_dir):
+    """
+    Returns:
+        The path the checkpoint ledger is written to, before it replaces the old one.
+    """
+    return get_ledger_path(checkpoint_dir) + "-tmp"
+
+
+def read_checkpoint_ledger(sc, ledger_path):
+    """
+    Reads a checkpoint ledger.
+    Args:
+        sc:             Spark Context.
+        ledger_path:    Path of the ledger file.
+
+    Returns:
+        The ledger dictionary, or None if the file is not a complete ledger.
+    """
+    try:
+        return json.loads("\n".join(sc.textFile(ledger_path).collect()))
+
+    except ValueError:
+        return None
+
+
+def get_profile_snapshot_path(checkpoint_dir):
+    """
+    Returns:
+        The path of the rolling profile snapshot of older runs, which only held the profile.
+    """
+    return checkpoint_dir.rstrip("/") + "/rolling_profile.txt"
+
+
+def write_checkpoint_ledger(sc, checkpoint_dir, sample_id=None):
+    """
+    Saves the checkpoint ledger of a sample. The ledger is written next to the old one, which is then deleted and
+    replaced by it. If the run stops in between, the new ledger is restored from the temporary file.
+    Args:
+        sc:                 Spark Context.
+        checkpoint_dir:     The checkpoint directory.
+        sample_id:          The unique id of the sample.
+
+    Returns:
+        The size of the ledger, in bytes.
+    """
+    sample_state = get_sample_state(sample_id)
+    strain_table = get_strain_table().value
+
+    ledger = {"sample_id": sample_state.sample_id,
+              "shards_processed": sample_state.rdd_counter,
+              "processed_files": sorted(sample_state.processed_files),
+              "profile": [a_line.rstrip("\n") for a_line in
+                          abundanceUtils.format_profile_snapshot(sample_state.rolling_profile, strain_table)],
+              "timestamp": time.time()}
+
+    ledger_bytes = bytearray(json.dumps(ledger, sort_keys=True).encode('utf-8'))
+
+    Path            = sc._gateway.jvm.org.apache.hadoop.fs.Path
+    ledger_path     = Path(get_ledger_path(checkpoint_dir))
+    tmp_path        = Path(get_ledger_tmp_path(checkpoint_dir))
+    fs              = ledger_path.getFileSystem(sc._jsc.hadoopConfiguration())
+
+    output_stream = fs.create(tmp_path, True)
+    output_stream.write(ledger_bytes)
+    output_stream.close()
+
+    fs.delete(ledger_path, False)
+
+    if not fs.rename(tmp_path, ledger_path):
+        raise IOError("Could not move the checkpoint ledger into place: " + get_ledger_path(checkpoint_dir))
+
+    return len(ledger_bytes)
+
+
+def load_checkpoint_ledger(sc, checkpoint_dir, sample_id=None):
+    """
+    Restores the state of a sample from its checkpoint ledger: the rolling profile, the number of shards profiled,
+    and the shard files that were read. If the run stopped while the ledger was being replaced, the state is restored
+    from the temporary ledger, and older runs fall back to their rolling profile snapshot.
+    Args:
+        sc:             Spark Context.
+        checkpoint_dir: The checkpoint directory.
+        sample_id:      The unique id of the sample.
+
+    Returns:
+        Vector with the rolling abundance of each strain ID. All zeros if there is nothing to restore.
+    """
+    sample_state = get_sample_state(sample_id)
+    strain_table = get_strain_table().value
+
+    Path            = sc._gateway.jvm.org.apache.hadoop.fs.Path
+    ledger_path     = Path(get_ledger_path(checkpoint_dir))
+    tmp_path        = Path(get_ledger_tmp_path(checkpoint_dir))
+    snapshot_path   = Path(get_profile_snapshot_path(checkpoint_dir))
+    fs              = ledger_path.getFileSystem(sc._jsc.hadoopConfiguration())
+
+    ledger = None
+
+    if fs.exists(ledger_path):
+        ledger = read_checkpoint_ledger(sc, get_ledger_path(checkpoint_dir))
+
+        if ledger is None:
+            raise ValueError("The checkpoint ledger in " + checkpoint_dir + " is not complete")
+
+    #   The run stopped after the old ledger was deleted, and before the new one was renamed into place. A temporary
+    #   ledger that is cut short is from the first write of the sample, and there is nothing to restore.
+    elif fs.exists(tmp_path):
+        ledger = read_checkpoint_ledger(sc, get_ledger_tmp_path(checkpoint_dir))
+
+        if ledger is not None:
+            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] WARNING! Checkpoint Ledger " +
+                  "restored from " + get_ledger_tmp_path(checkpoint_dir))
+
+    if ledger is not None:
+        if ledger["sample_id"] != sample_state.sample_id:
+            raise ValueError("The checkpoint ledger in " + checkpoint_dir + " belongs to sample " +
+                             str(ledger["sample_id"]) + ", and not to " + str(sample_state.sample_id))
+
+        sample_state.rdd_counter        = int(ledger["shards_processed"])
+        sample_state.processed_files    = set(ledger["processed_files"])
+        sample_state.resumed_from_ledger = True
+
+        return abundanceUtils.parse_profile_snapshot(ledger["profile"], strain_table)
+
+    snapshot_lines = []
+    if fs.exists(snapshot_path):
+        snapshot_lines = sc.textFile(get_profile_snapshot_path(checkpoint_dir)).collect()
+
+    return abundanceUtils.parse_profile_snapshot(snapshot_lines, strain_table)
+
+
+def stop_streaming():
+    """
+    Stops the active Streaming context, once the batches that are already running are done. The Spark context is left
+    running, as it is shared by all the samples.
+    Returns:
+        Nothing.
+    """
+    active_ssc = StreamingContext.getActive()
+
+    if active_ssc is not None:
+        active_ssc.stop(stopSparkContext=False, stopGraceFully=True)
+
+
+
+# ------------------------------------------------- End of Stream -----------------------------------------------------
+#
+#   A sample ends when its producer says so: with a sentinel file in the stream directory (see 'END_OF_STREAM_FILE'),
+#   or with an end-of-stream control record on every shard of the Kinesis stream. The marker tells us the batch that
+#   holds the last reads of the sample, and a watcher thread in the driver stops streaming as soon as that batch has
+#   been folded into the rolling profile. Streaming is never stopped from within one of its own batches.
+#
+#   Without a marker, the watcher falls back to stopping once the requested number of shards has been profiled, or
+#   once no reads have come in for 'streaming_timeout' seconds ('--timeout'). With '--end_of_stream', only the marker
+#   stops a sample, so a slow producer can't cut the run short.
+#
+def set_streaming_timeout(streaming_timeout, sample_id=None):
+    get_sample_state(sample_id).streaming_timeout = streaming_timeout
+
+
+def get_batch_timestamp(batch_time):
+    """
+    Converts the time of a batch, as handed over by 'foreachRDD()', to seconds since the epoch.
+    """
+    return time.mktime(batch_time.timetuple()) + batch_time.microsecond / 1000000.0
+
+
+def complete_batch(batch_time, sample_id=None):
+    """
+    Records that a batch of a sample has been fully profiled and aggregated, along with the shard files it read.
+    Args:
+        batch_time: Time of the batch, or None outside of streaming.
+        sample_id:  The unique id of the sample.
+
+    Returns:
+        The number of shard files that the batch read.
+    """
+    if batch_time is None:
+        return 0
+
+    sample_state = get_sample_state(sample_id)
+    batch_timestamp = get_batch_timestamp(batch_time)
+
+    sample_state.completed_batch_time = max(sample_state.completed_batch_time, batch_timestamp)
+
+    batch_files = sample_state.pending_files.pop(batch_timestamp, [])
+    sample_state.processed_files.update(batch_files)
+    sample_state.batch_bytes.pop(batch_timestamp, None)
+
+    return len(batch_files)
+
+
+def fail_batch(batch_time, sample_id=None):
+    """
+    Records that a batch of a sample could not be profiled. Its shard files go back to the waiting files, so that a
+    later batch reads them again, and they are not saved as processed in the checkpoint ledger.
+    Args:
+        batch_time: Time of the batch, or None outside of streaming.
+        sample_id:  The unique id of the sample.
+
+    Returns:
+        Nothing.
+    """
+    if batch_time is None:
+        return
+
+    sample_state = get_sample_state(sample_id)
+    batch_timestamp = get_batch_timestamp(batch_time)
+
+    sample_state.completed_batch_time = max(sample_state.completed_batch_time, batch_timestamp)
+
+    batch_files = sample_state.pending_files.pop(batch_timestamp, [])
+    sample_state.batch_bytes.pop(batch_timestamp, None)
+
+    #   The last batch can't be the last one anymore. The sentinel is found again along with the returned files.
+    if batch_files:
+        sample_state.end_of_stream_batch_time = None
+
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] WARNING! The batch failed, " +
+              str(len(batch_files)) + " shard files will be read again.")
+
+
+def record_end_of_stream_markers(batch_time, records_RDD, sample_id=None):
+    """
+    Picks the end-of-stream control records out of a batch of raw Kinesis records. Once the markers of all the
+    shards are in, 'this' batch is the last one of the sample.
+    Args:
+        batch_time:     Time of the batch.
+        records_RDD:    RDD of raw Kinesis records.
+        sample_id:      The unique id of the sample.
+
+    Returns:
+        Nothing.
+    """
+    sample_state = get_sample_state(sample_id)
+
+    if sample_state.end_of_stream_batch_time is not None:
+        return
+
+    markers = records_RDD.filter(kinesisUtils.is_end_of_stream).map(kinesisUtils.decode_end_of_stream).collect()
+
+    for marker in markers:
+        sample_state.end_of_stream_markers[marker["shard"]] = marker
+
+    if markers and len(sample_state.end_of_stream_markers) >= markers[0]["shards"]:
+        sample_state.end_of_stream_batch_time = get_batch_timestamp(batch_time)
+
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] End of Stream Marker Received. (" +
+              '{:0,.0f}'.format(markers[0]["reads"]) + " Reads sent)")
+
+
+def get_file_modification_time(sc, file_path):
+    """
+    Looks up when a file was last modified, using the Hadoop File API.
+    Returns:
+        The modification time in seconds since the epoch, or None if the file does not exist.
+    """
+    Path            = sc._gateway.jvm.org.apache.hadoop.fs.Path
+    hadoop_path     = Path(file_path)
+    fs              = hadoop_path.getFileSystem(sc._jsc.hadoopConfiguration())
+
+    if not fs.exists(hadoop_path):
+        return None
+
+    return fs.getFileStatus(hadoop_path).getModificationTime() / 1000.0
+
+
+def check_end_of_stream(sample_state):
+    """
+    Checks whether the stream of a sample is done.
+    Args:
+        sample_state:   The 'SampleState' of the sample.
+
+    Returns:
+        A message with the reason to stop, or None if the sample is still streaming.
+    """
+    if sample_state.end_of_stream_batch_time is not None:
+        if sample_state.completed_batch_time >= sample_state.end_of_stream_batch_time:
+            return "End of Stream. (" + str(sample_state.rdd_counter) + " shards)"
+        return None
+
+    if get_wait_for_end_of_stream() or sample_state.time_of_last_rdd == 0:
+        return None
+
+    if sample_state.number_of_shards > 0 and shard_equals_counter(sample_state.sample_id):
+        return "All Requested Sample Shards Finished. (" + str(sample_state.number_of_shards) + " shards)"
+
+    #   Measured against the batches that came in empty, so that a long batch is not mistaken for an idle stream.
+    if sample_state.completed_batch_time - sample_state.time_of_last_rdd > sample_state.streaming_timeout:
+        return "Streaming Timeout. (" + str(sample_state.rdd_counter) + " shards)"
+
+    return None
+
+
+def finish_sample_stream(sample_state, reason):
+    """
+    Marks the stream of a sample as finished. The analysis ends when its last batch of reads was profiled.
+    Args:
+        sample_state:   The 'SampleState' of the sample.
+        reason:         Why the stream is done.
+
+    Returns:
+        Nothing.
+    """
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] " + sample_state.sample_id + ": " + reason)
+
+    if sample_state.time_of_last_rdd != 0:
+        sample_state.analysis_end_time = sample_state.time_of_last_rdd
+    else:
+        sample_state.analysis_end_time = time.time()
+
+    sample_state.streaming_finished = True
+
+
+def watch_end_of_stream(ssc, streaming_done, poll_interval=END_OF_STREAM_POLL_INTERVAL):
+    """
+    Runs in a thread of the driver while the samples stream. Finishes each sample once its stream is done, and stops
+    the Streaming context once all the samples in it are finished. The Streaming context is shared by the samples
+    that are processed together.
+    Args:
+        ssc:            Spark Streaming Context.
+        streaming_done: 'threading.Event' that is set once streaming has stopped for any reason.
+        poll_interval:  Seconds between checks.
+
+    Returns:
+        Nothing.
+    """
+    sc = ssc.sparkContext
+
+    while not streaming_done.wait(poll_interval):
+        try:
+            for sample_state in list(SAMPLE_STATES.values()):
+                if sample_state.streaming_finished:
+                    continue
+
+                reason = check_end_of_stream(sample_state)
+                if reason is not None:
+                    finish_sample_stream(sample_state, reason)
+
+            if SAMPLE_STATES and all(sample_state.streaming_finished for sample_state in SAMPLE_STATES.values()):
+                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Stopping Streaming.")
+                stop_streaming()
+                return
+
+        except Exception as ex:
+            template = "[Flint - ERROR] An exception of type {0} occurred in the end-of-stream watcher. " + \
+                       "Arguments:\n{1!r}"
+            print(template.format(type(ex).__name__, ex.args))
+
+
+
+# ------------------------------------------------ Alignment Metrics --------------------------------------------------
+#
+def print_alignment_metrics(number_input_reads, number_of_reads_aligned, number_of_reads_multimapped,
+                            alignment_stats):
+    """
+    Prints the mapping rate of a shard, and the hits of each index shard. All of the numbers are side outputs of the
+    alignment and abundance jobs, so printing them is free.
+    Args:
+        number_input_reads:             Number of reads in the shard.
+        number_of_reads_aligned:        Number of reads that aligned to at least one strain.
+        number_of_reads_multimapped:    Number of reads that aligned to more than one strain.
+        alignment_stats:                The value of an 'AlignmentStatsAccumulator'.
+
+    Returns:
+        Nothing.
+    """
+    #   Overall Mapping Rate for 'this' shard.
+    overall_mapping_rate = 0.0
+    if number_input_reads > 0:
+        overall_mapping_rate = float(number_of_reads_aligned) / number_input_reads * 100
+
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Shard Mapping Rate: " +
+          '{:.2f}'.format(overall_mapping_rate) + "%")
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Reads Aligned: " +
+          '{:0,.0f}'.format(number_of_reads_aligned) + ", Multi-Mapped: " +
+          '{:0,.0f}'.format(number_of_reads_multimapped))
+
+    for shard_key in sorted(alignment_stats):
+        shard_stats = alignment_stats[shard_key]
+
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "]   " + str(shard_key) + ": " +
+              '{:0,.0f}'.format(shard_stats["alignments"]) + " Alignments, " +
+              '{:0,.0f}'.format(shard_stats["reads_aligned"]) + " Reads, " +
+              '{:0,.0f}'.format(shard_stats["reads_multimapped"]) + " Multi-Mapped, " +
+              '{:.2f}'.format(shard_stats["alignment_seconds"]) + "s")
+
+        for process_stats in shard_stats["bowtie2"]:
+            summary = process_stats["summary"] or {}
+            peak_rss_bytes = process_stats["peak_rss_bytes"] or 0
+
+            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "]     Bowtie2: " +
+                  '{:0,.0f}'.format(summary.get("reads", 0)) + " Reads, " +
+                  '{:.2f}'.format(summary.get("overall_rate", 0.0)) + "% Aligned, " +
+                  '{:.2f}'.format(process_stats["wall_seconds"]) + "s, " +
+                  '{:0,.0f}'.format(peak_rss_bytes / (1024 * 1024)) + " MB Peak, Exit Code " +
+                  str(process_stats["exit_code"]))
+
+
+
+def record_batch_metrics(sc, number_input_reads, number_of_reads_aligned, number_of_reads_multimapped,
+                         alignment_stats, abundance_seconds, batch_time, sample_id=None):
+    """
+    Hands the metrics of a shard to the metrics recorder (see 'flint_metrics.py').
+    Args:
+        sc:                             Spark Context.
+        number_input_reads:             Number of reads in the shard.
+        number_of_reads_aligned:        Number of reads that aligned to at least one strain.
+        number_of_reads_multimapped:    Number of reads that aligned to more than one strain.
+        alignment_stats:                The value of an 'AlignmentStatsAccumulator'.
+        abundance_seconds:              Wall time of the alignment and abundance job.
+        batch_time:                     The time of the streaming batch that picked up the shard, or None.
+        sample_id:                      The unique id of the sample. Defaults to the current sample.
+
+    Returns:
+        Nothing.
+    """
+    driver_rss, driver_peak_rss = metricsUtils.get_driver_memory()
+    storage_memory_used, storage_memory_max = metricsUtils.get_storage_memory(sc)
+
+    #   Alignment and aggregation run in the same Spark job. What's left after the slowest index shard finished
+    #   aligning is the shuffle, the tree reduce, and the abundance calculation in the driver.
+    slowest_alignment = max([shard_stats["alignment_seconds"] for shard_stats in alignment_stats.values()] or [0.0])
+
+    latency_seconds = None
+    if batch_time is not None:
+        latency_seconds = time.time() - (time.mktime(batch_time.timetuple()) + batch_time.microsecond / 1e6)
+
+    get_metrics_recorder(sample_id).record_batch({
+        "shard": get_shard_counter(sample_id),
+        "input_reads": number_input_reads,
+        "alignments": sum(shard_stats["alignments"] for shard_stats in alignment_stats.values()),
+        "reads_aligned": number_of_reads_aligned,
+        "reads_multimapped": number_of_reads_multimapped,
+        "abundance_seconds": abundance_seconds,
+        "aggregation_seconds": max(abundance_seconds - slowest_alignment, 0.0),
+        "latency_seconds": latency_seconds,
+        "driver_rss_bytes": driver_rss,
+        "driver_peak_rss_bytes": driver_peak_rss,
+        "driver_jvm_heap_bytes": metricsUtils.get_driver_jvm_heap(sc),
+        "storage_memory_used_bytes": storage_memory_used,
+        "storage_memory_max_bytes": storage_memory_max,
+        "index_shards": alignment_stats})
 
 
 
@@ -488,81 +1705,188 @@ def dispatch_stream_from_kinesis(sampleID, sample_format, output_file, save_to_l
 #   This is where all the action is. This function gets called by both of the streaming job functions, and the code
 #   for passing the data to Bowtie2, and receiving it back, is in these functions.
 #
-def profile_sample(sampleReadsRDD, sc, ssc, output_file, save_to_s3, save_to_local, sensitive_align, partition_size,
+def profile_sample(sampleReadsRDD, output_file, save_to_s3, save_to_local, sensitive_align, partition_size,
                    annotations_dictionary, s3_output_bucket, keep_shard_profiles, coalesce_output, verbose_output,
                    bowtie2_node_path, bowtie2_index_path, bowtie2_index_name, bowtie2_number_threads, sample_type,
-                   debug_mode, streaming_timeout, kinesis_decode=None):
+                   debug_mode, streaming_timeout, batch_time=None, sample_id=None,
+                   split_input=False):
+
+    #
+    #   Nested inner function that gets called from the 'mapPartitions()' Spark function.
+    #
+    def align_with_bowtie2(iterator):
+        """
+        Function that runs on ALL worker nodes (Executors). Dispatches a Bowtie2 command and handles read alignments.
+        Args:
+            iterator:   Iterator object from Spark
+
+        Returns:    A generator of read alignments, each a (read ID, strain ID) tuple.
+
+        """
+        #
+        #   We pick up the RDD with reads that we set as a broadcast variable "previously" — The location of this action
+        #   happens in the code below, which executes before 'this' code block.
+        #
+        reads_list = broadcast_sample_reads.value
+
+        if not shard_placement:
+            return align_reads(reads_list)
+
+        #   With shard-aware placement, each element of the partition names the index shard to align against.
+        return itertools.chain.from_iterable(align_reads(reads_list, get_local_shard_path(index_shard),
+                                                         shard_key=get_shard_key(index_shard))
+                                             for index_shard in iterator)
+
 
     #
-    #   Nested inner function that gets called from the 'mapPartitions()' Spark function.
+    #   Nested inner function that gets called from the 'mapPartitions()' Spark function in 'distributed_reads' mode.
     #
-    def align_with_bowtie2(iterator):
+    def align_read_blocks(iterator):
         """
-        Function that runs on ALL worker nodes (Executors). Dispatches a Bowtie2 command and handles read alignments.
+        Function that runs on ALL worker nodes (Executors). Each element of the partition is a (read block, index
+        shard) pair from the 'cartesian()' of the read blocks and the index shards, so the reads are pulled by the
+        Executor from wherever the block lives, and not from a broadcast variable.
         Args:
-            iterator:   Iterator object from Spark
+            iterator:   Iterator object from Spark, with ((first read ID, read block), index shard) pairs.
 
-        Returns:    An iterable collection of read alignments in SAM format.
+        Returns:    A generator of read alignments, each a (read ID, strain ID) tuple.
 
         """
-        alignments = []
+        for (first_read_id, read_block), index_shard in iterator:
+            if shard_placement:
+                index_path  = get_local_shard_path(index_shard)
+                shard_key   = get_shard_key(index_shard)
+            else:
+                index_path  = bowtie2_index_path
+                shard_key   = None
 
-        worker_node_ip = str(sp.check_output(["hostname"])).strip()
+            for alignment in align_reads(read_block, index_path, first_read_id, shard_key):
+                yield alignment
 
-        #
-        #   We pick up the RDD with reads that we set as a broadcast variable "previously" — The location of this action
-        #   happens in the code below, which executes before 'this' code block.
-        #
-        reads_list = broadcast_sample_reads.value
+
+    #
+    #   Resolves an element of the index shards RDD into the local path of its shard.
+    #
+    def get_local_shard_path(index_shard):
+        """
+        Function that runs on ALL worker nodes (Executors). Checks that the index shard is in 'this' worker node, so
+        that a task that landed on the wrong node fails and is retried, instead of aligning against the wrong shard.
+        Args:
+            index_shard:    An element of the RDD from 'flint_index_shards.make_index_shard_rdd()'.
+
+        Returns:    The local directory of the index shard.
+
+        """
+        shard_id, shard_dir = shards.parse_index_shard_element(index_shard)
+        shards.verify_local_shard(shard_id, shard_dir)
+
+        return shard_dir
+
+
+    #
+    #   Names the index shard of an element of the index shards RDD in the alignment metrics.
+    #
+    def get_shard_key(index_shard):
+        """
+        Function that runs on ALL worker nodes (Executors).
+        Args:
+            index_shard:    An element of the RDD from 'flint_index_shards.make_index_shard_rdd()'.
+
+        Returns:    The key of the index shard in the alignment metrics.
+
+        """
+        shard_id, shard_dir = shards.parse_index_shard_element(index_shard)
+
+        return "shard_" + str(shard_id)
+
+
+    #
+    #   Aligns a list of reads against the index shard of 'this' worker node.
+    #
+    def align_reads(reads_list, index_path=None, first_read_id=0, shard_key=None):
+        """
+        Function that runs on ALL worker nodes (Executors). Dispatches a Bowtie2 command and handles read alignments.
+        Args:
+            reads_list:     A list of tab5-formatted reads.
+            index_path:     Local directory of the index shard. Defaults to the run's 'bowtie2_index_path'.
+            first_read_id:  Read ID of the first read in the list. Reads are numbered consecutively from it.
+            shard_key:      Name of the index shard in the alignment metrics. Defaults to the worker node's name, as
+                            each worker node holds a single shard at 'bowtie2_index_path'.
+
+        Returns:    A generator of read alignments, each a (read ID, strain ID) tuple.
+
+        """
+        if index_path is None:
+            index_path = bowtie2_index_path
 
         #   Obtain a properly formatted Bowtie2 command.
         bowtieCMD = getBowtie2Command(bowtie2_node_path=bowtie2_node_path,
-                                      bowtie2_index_path=bowtie2_index_path,
+                                      bowtie2_index_path=index_path,
                                       bowtie2_index_name=bowtie2_index_name,
                                       bowtie2_number_threads=bowtie2_number_threads)
         if sensitive_align:
             bowtieCMD = getBowtie2CommandSensitive(bowtie2_node_path=bowtie2_node_path,
-                                                   bowtie2_index_path=bowtie2_index_path,
+                                                   bowtie2_index_path=index_path,
                                                    bowtie2_index_name=bowtie2_index_name,
                                                    bowtie2_number_threads=bowtie2_number_threads)
 
 
-        #   Open a pipe to the subprocess that will launch the Bowtie2 aligner.
-        try:
-            align_subprocess = sp.Popen(bowtieCMD, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
-
-            pickled_reads_list = pickle.dumps(reads_list)
-            # no_reads = len(reads_list)
-
-            alignment_output, alignment_error = align_subprocess.communicate(input=pickled_reads_list.decode('latin-1'))
+        #   Each alignment (in SAM format) is parsed and broken down into two (2) pieces: the read name, and the
+        #   genome reference the read aligns to. We do the parsing here so that it occurs in the worker node and not in
+        #   the master node. A benefit of parsing alignments in the worker node is that it also brings down the size
+        #   of the 'alignment' object that gets transmitted through the network. Note that networking costs are
+        #   minimal for a 'few' alignments, but they do add up for large samples with many shards.
+        #
+        #   Reads are streamed into Bowtie2 by a writer thread, and alignments are handed to Spark as Bowtie2 reports
+        #   them, so neither the reads nor the SAM output are ever held in memory as a whole.
+        #
+        #   Read names are replaced with integer read IDs before they go into Bowtie2, and the RNAME is looked up in
+        #   the strain table as the SAM line is parsed, so alignments leave 'this' worker node as a pair of integers.
+        #
+        numbered_reads  = bowtieUtils.number_reads(reads_list, first_read_id)
+        strain_table    = broadcast_strain_table.value
+
+        #   Exit code, wall time, peak memory, and the parsed STDERR alignment summary of the Bowtie2 process.
+        process_stats   = None
+
+        #   The alignments are counted as they are parsed, and the counts are sent back with the task's accumulator
+        #   updates, so the metrics don't need any Spark jobs of their own.
+        alignment_stats = bowtieUtils.new_alignment_stats()
+
+        if use_align_service:
+            #   The resident Bowtie2 service in 'this' worker node already has the index loaded, so we just hand it
+            #   the reads. The service is started by the first task that needs it.
+            alignments = bowtieUtils.align_with_service(numbered_reads,
+                                                        SparkFiles.get("align_service.py"),
+                                                        bowtieUtils.get_align_service_command(bowtieCMD),
+                                                        strain_table=strain_table,
+                                                        alignment_stats=alignment_stats)
+        else:
+            process_stats = bowtieUtils.new_bowtie2_process_stats()
+            alignments = bowtieUtils.stream_reads_to_bowtie2(numbered_reads, bowtieCMD, strain_table=strain_table,
+                                                             process_stats=process_stats,
+                                                             alignment_stats=alignment_stats)
 
-            #   The output is returned as a 'bytes' object, so we'll convert it to a list. That way, 'this' worker node
-            #   will return a list of the alignments it found.
-            for a_read in alignment_output.strip().decode().splitlines():
+        try:
+            for alignment in bowtieUtils.count_alignments(alignments, alignment_stats):
+                yield alignment
 
-                #   Each alignment (in SAM format) is parsed and broken down into two (2) pieces: the read name,
-                #   and the genome reference the read aligns to. We do the parsing here so that it occurs in the
-                #   worker node and not in the master node. A benefit of parsing alignments in the worker node is
-                #   that it also brings down the size of the 'alignment' object that gets transmitted through the
-                #   network. Note that networking costs are minimal for a 'few' alignments, but they do add up
-                #   for large samples with many shards.
-                #
-                #   SAM format: [0] - QNAME (the read name)
-                #               [1] - FLAG
-                #               [2] - RNAME (the genome reference name that the read aligns to
-                #
-                alignment = a_read.split("\t")[0] + "\t" + a_read.split("\t")[2]
+        except (sp.CalledProcessError, RuntimeError) as err:
+            print( "[Flint - ALIGN ERROR] " + str(err))
 
-                #   Once the alignment has been parsed, we add it to the return list of alignments that will be
-                #   sent back to the master node.
-                alignments.append(alignment)
+            #   Fails the task with the error, so that the driver sees Bowtie2's exit code and STDERR. Exiting here
+            #   would only tell it that the Python worker died.
+            raise
 
+        if shard_key is None:
+            shard_key = socket.gethostname()
 
-        except sp.CalledProcessError as err:
-            print( "[Flint - ALIGN ERROR] " + str(err))
-            sys.exit(-1)
+        #   The resident Bowtie2 service never exits, so it has no per-batch process record.
+        if process_stats is not None:
+            process_stats["index_path"] = index_path
+            alignment_stats["bowtie2"].append(process_stats)
 
-        return iter(alignments)
+        alignment_stats_acc.add({shard_key: alignment_stats})
 
 
     # -----------------------------------------------------------------------------------------------------------------
@@ -593,55 +1917,97 @@ def profile_sample(sampleReadsRDD, sc, ssc, output_file, save_to_s3, save_to_loc
         return organism_name_string
 
 
+
     # -----------------------------------------------------------------------------------------------------------------
     #
+    #   The main 'profileSample()' function starts here.
     #
-    def accumulate_abundaces(a_strain):
-        print("Hello from accumulate_abundances()")
-        strain_name = a_strain[0]
-        abundance_count = a_strain[1]
 
-        # abundances = get_overall_abundaces()
-        global OVERALL_ABUNDANCES
-        OVERALL_ABUNDANCES += {strain_name: abundance_count}
+    #   We take the Spark context from the RDD, so that nothing here holds on to the Spark or Streaming contexts.
+    sc = sampleReadsRDD.context
 
-        return a_strain
+    #   Copied into locals so that they are shipped with the 'align_with_bowtie2()' closure to the Executors. The
+    #   splits of a sample file (see 'dispatch_local_job()') are too large for the driver, and always stay in the
+    #   Executors.
+    use_align_service = get_use_align_service()
+    distributed_reads = get_distributed_reads() or split_input
 
+    index_shard_registry = get_index_shard_registry()
+    shard_placement = index_shard_registry is not None
+
+    broadcast_strain_table = get_strain_table()
+
+    #   Per-batch artifacts. They are released at the end of the batch, see 'release_batch_artifacts()'.
+    broadcast_sample_reads  = None
+    read_blocks_RDD         = None
+    strain_abundances       = None
+
+    #   Alignment metrics of 'this' batch, per index shard. See 'AlignmentStatsAccumulator'.
+    alignment_stats_acc = sc.accumulator({}, AlignmentStatsAccumulator())
+
+    #   The jobs of each sample are scheduled in their own fair-scheduler pool (see '--concurrent_samples'), so that
+    #   the samples that are streamed together share the cluster evenly. The pool is a thread-local property of the
+    #   JVM thread that submits the jobs, and it only reliably reaches that thread in PySpark's pinned-thread mode
+    #   ('PYSPARK_PIN_THREAD', Spark 3.0+). Otherwise the jobs may land in the pool of another sample, or the default.
+    sc.setLocalProperty("spark.scheduler.pool", get_scheduler_pool(sample_id))
+
+    #   Only a batch that was profiled from start to end is completed, see 'complete_batch()' and 'fail_batch()'.
+    batch_profiled = False
 
-    # -----------------------------------------------------------------------------------------------------------------
-    #
-    #   The main 'profileSample()' function starts here.
-    #
     try:
-        if not sampleReadsRDD.isEmpty():
+        #   Reads that come in after the end of the sample, e.g., while the other samples of the group still stream,
+        #   are left out of its profile.
+        if not get_sample_state(sample_id).streaming_finished and not sampleReadsRDD.isEmpty():
 
-            if get_shard_counter() == 0:
-                set_analysis_start_time()
+            if get_shard_counter(sample_id) == 0:
+                set_analysis_start_time(sample_id)
+
+            #   The Spark jobs of 'this' shard are tagged, so that their stages can be profiled once the shard is done.
+            stage_profiler = get_stage_profiler(sample_id)
+            if stage_profiler is not None:
+                stage_profiler.begin_batch(get_shard_counter(sample_id))
 
             # -------------------------------------- Alignment --------------------------------------------------------
             #
             #   First, we'll convert the RDD to a list, which we'll then convert to a Spark.broadcast variable
             #   that will be shipped to all the Worker Nodes (and their Executors) for read alignment.
             #
-            if kinesis_decode:
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Decoding Kinesis Stream...")
-                sample_reads_list = json.loads(sampleReadsRDD.collect())
+            #   In 'distributed_reads' mode the reads never reach the driver. Each partition of the incoming RDD
+            #   becomes a block of reads that is written out through a shuffle, and every alignment task pulls the
+            #   block it needs from the shuffle files. The reads of a block are numbered from '(partition index << 32)',
+            #   so that read IDs are unique across blocks.
+            #
+            #   The blocks are shuffled, and not cached, so that they have no preferred location (the reduce locality
+            #   of shuffles is turned off, see 'flint.py'). The alignment task of a (read block, index shard) pair
+            #   then goes where its index shard is, and not to the node that happens to hold the block, which would
+            #   align a block against the index of the same node several times.
+            #
+            if distributed_reads:
+                number_of_blocks = sampleReadsRDD.getNumPartitions()
+
+                read_blocks_RDD = sampleReadsRDD.mapPartitionsWithIndex(lambda index, reads: [(index << 32,
+                                                                                               list(reads))])\
+                                                .partitionBy(number_of_blocks, lambda read_id: read_id >> 32)\
+                                                .filter(lambda read_block: len(read_block[1]) > 0)
+
+                number_input_reads = read_blocks_RDD.map(lambda read_block: len(read_block[1])).sum()
+
             else:
                 sample_reads_list = sampleReadsRDD.collect()    # collect returns <type 'list'> on the main driver.
 
-            number_input_reads = len(sample_reads_list)
+                number_input_reads = len(sample_reads_list)
 
-            #
-            #   The RDD with reads is set as a Broadcast variable that will be picked up by each worker node.
-            #
-            broadcast_sample_reads = sc.broadcast(sample_reads_list)
+                #
+                #   The RDD with reads is set as a Broadcast variable that will be picked up by each worker node.
+                #
+                broadcast_sample_reads = sc.broadcast(sample_reads_list)
 
 
             #
             #   Run starts here.
             #
             print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Shard: " +
-                  str(get_shard_counter()) + " of " + str(get_shards()))
+                  str(get_shard_counter(sample_id)) + " of " + str(get_shards(sample_id)))
 
             read_noun = ""
             if sample_type.lower() == "paired":
@@ -652,7 +2018,24 @@ def profile_sample(sampleReadsRDD, sc, ssc, output_file, save_to_s3, save_to_loc
 
             alignment_start_time = time.time()
 
-            data = sc.parallelize(range(1, partition_size))
+            #
+            #   With shard-aware placement, there is one partition per index shard, and each prefers the worker node
+            #   that holds its shard. Otherwise we rely on the scheduler spreading 'partition_size' partitions over
+            #   the worker nodes.
+            #
+            if shard_placement:
+                index_shards_RDD = shards.make_index_shard_rdd(sc, index_shard_registry)
+            elif distributed_reads:
+                index_shards_RDD = sc.parallelize(range(partition_size), partition_size)
+            else:
+                index_shards_RDD = sc.parallelize(range(1, partition_size))
+
+            if distributed_reads:
+                #   One element per index shard, so that every (read block, index shard) pair is its own partition.
+                data = read_blocks_RDD.cartesian(index_shards_RDD)
+            else:
+                data = index_shards_RDD
+
             data_num_partitions = data.getNumPartitions()
 
             if verbose_output:
@@ -669,237 +2052,107 @@ def profile_sample(sampleReadsRDD, sc, ssc, output_file, save_to_s3, save_to_loc
                 print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
                       "] Using Sensitive Alignment Mode...")
 
-            alignments_RDD = data.mapPartitions(align_with_bowtie2)
-            number_of_alignments = alignments_RDD.count()
-
-            alignment_end_time = time.time()
-            alignment_total_time = alignment_end_time - alignment_start_time
-
-            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Bowtie2 - Complete. " +
-                  "(" + str(timedelta(seconds=alignment_total_time)) + ")")
-            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "]" + " Found: " +
-                  '{:0,.0f}'.format(number_of_alignments) + " Alignments.")
-
-            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                  "] Analyzing...")
-
-            # ------------------------------------------- Map 1 -------------------------------------------------------
-            #
-            #   The Map step sets up the basic data structure that we start with — a map of reads to the genomes they
-            #   align to. We'll Map a read (QNAME) with a genome reference name (RNAME).
-            #   The REDUCE 1 step afterwards will collect all the genomes and key them to a unique read name.
-            #
-            if verbose_output:
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "] Mapping Reads to Genomes (QNAME-RNAME).")
-
-            map_reads_to_genomes = alignments_RDD.map(lambda line: (line.split("\t")[0], [line.split("\t")[1]])).cache()
-
-            if debug_mode:
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "] • Checkpoint 1: Map 1, map_reads_to_genomes")
-                chk_1_s = time.time()
-                checkpoint_1 = map_reads_to_genomes.count()
-                chk_1_e = time.time()
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "]   TIME: " + str(timedelta(seconds=(chk_1_e - chk_1_s))))
-
-
-            if verbose_output:
-                #   We use the following block to get the Overall Mapping Rate for 'this' shard.
-                list_unique_reads = map_reads_to_genomes.flatMap(lambda x: x).keys().distinct()
-                number_of_reads_aligned = list_unique_reads.count()
-
-                overall_mapping_rate = float(number_of_reads_aligned) / number_input_reads
-                overall_mapping_rate = overall_mapping_rate * 100
-
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Shard Mapping Rate: " +
-                      '{:.2f}'.format(overall_mapping_rate) + "%")
-
-
-            # ------------------------------------------ Reduce 1 -----------------------------------------------------
-            #
-            #   Reduce will operate first by calculating the read contributions, and then using these contributions
-            #   to calculate an abundance.
-            #   Note the "+" operator can be used to concatenate two lists. :)
-            #
-
-            #   'Reduce by Reads' will give us a 'dictionary-like' data structure that contains a Read Name (QNAME) as
-            #   the KEY, and a list of genome references (RNAME) as the VALUE. This allows us to calculate
-            #   each read's contribution.
-            #
-            if verbose_output:
+            if verbose_output and use_align_service:
                 print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "] Reducing Reads to list of Genomes...")
+                      "] Using resident Bowtie2 service...")
 
-            reads_to_genomes_list = map_reads_to_genomes.reduceByKey(lambda l1, l2: l1 + l2)
-
-            if debug_mode:
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "] • Checkpoint 2: Reduce 1, reads_to_genomes_list")
-                chk_2_s = time.time()
-                checkpoint_2 = reads_to_genomes_list.count()
-                chk_2_e = time.time()
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "]   TIME: " + str(timedelta(seconds=(chk_2_e - chk_2_s))))
+            if distributed_reads:
+                alignments_RDD = data.mapPartitions(align_read_blocks)
+            else:
+                alignments_RDD = data.mapPartitions(align_with_bowtie2)
 
+            #   Alignments are not counted here, as that would run Bowtie2 twice. They stream straight into the
+            #   abundance calculation below, and the alignment metrics are read from 'alignment_stats_acc' after it.
 
-            # ------------------------------------ Map 2, Fractional Reads --------------------------------------------
+            # ------------------------------------------ Abundances ---------------------------------------------------
             #
-            #   Read Contributions.
             #   Each read is normalized by the number of genomes it maps to. The idea is that reads that align to
             #   multiple genomes will contribute less (have a hig denominator) than reads that align to fewer genomes.
+            #   The alignments are compressed into one record per read, shuffled once by read ID, and collapsed into
+            #   equivalence classes (reads that hit the same strains), which are brought back with a tree reduce.
+            #   With the 'em' abundance model, multi-mapped reads are instead re-assigned with Expectation-Maximization,
+            #   warm-started from the abundances of the previous shard.
+            #   See 'flint_abundances.py'.
             #
+            abundance_model = get_abundance_model()
 
             if verbose_output:
                 print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "] Calculating Read Contributions...")
-
-            read_contributions = reads_to_genomes_list.mapValues(lambda l1: 1 / float(len(l1)))
-
-            if debug_mode:
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "] • Checkpoint 3: Map 2, read_contributions")
-                chk_3_s = time.time()
-                checkpoint_3 = read_contributions.count()
-                chk_3_e = time.time()
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "]   TIME: " + str(timedelta(seconds=(chk_3_e - chk_3_s))))
-
-
-            #
-            #   Once we have the read contributions, we'll JOIN them with the starting 'map_reads_to_genomes' RDD to
-            #   get an RDD that will map the read contribution to the Genome it aligns to.
-            #   Note: l[0] is the Read name (key), and l[1] is the VALUE (a list) after the join.
-            #
-            if verbose_output:
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "] Joining Read Contributions to Genomes...")
-
-            read_contribution_to_genome = read_contributions.join(map_reads_to_genomes)\
-                                                            .map(lambda l: (l[1][0], "".join(l[1][1])))
-
-            if debug_mode:
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "] • Checkpoint 4: read_contribution_to_genome")
-                chk_4_s = time.time()
-                checkpoint_4 = read_contribution_to_genome.count()
-                chk_4_e = time.time()
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "]   TIME: " + str(timedelta(seconds=(chk_4_e - chk_4_s))))
-
-
-            #
-            #   Now have an RDD mapping the Read Contributions to Genome Names, we'll flip the (KEY,VALUE) pairings
-            #   so that we have Genome Name as KEY and Read Contribution as Value.
-            #
-            if verbose_output:
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "] Flipping Genomes and Read Contributions...")
+                      "] Calculating Strain Abundances (" + abundance_model + ")...")
+
+            strain_table = broadcast_strain_table.value
+            number_of_strains = strain_table.get_number_of_strains()
+
+            #   Placed alignment tasks can only run in the node of their index shard, so the scheduler waits for a
+            #   slot there for as long as these jobs run, instead of the default few seconds.
+            if shard_placement:
+                previous_locality_wait = shards.set_node_locality_wait(sc, shards.PLACEMENT_LOCALITY_WAIT)
+
+            try:
+                if abundance_model == abundanceUtils.ABUNDANCE_MODEL_EM:
+                    strain_abundances_vector, number_of_reads_aligned, number_of_reads_multimapped = \
+                        abundanceUtils.compute_strain_abundances_em(alignments_RDD,
+                                                                    number_of_partitions=data_num_partitions,
+                                                                    number_of_strains=number_of_strains,
+                                                                    initial_abundances=get_previous_batch_abundances(
+                                                                        sample_id),
+                                                                    debug_mode=debug_mode)
+
+                    set_previous_batch_abundances(strain_abundances_vector, sample_id)
+
+                else:
+                    strain_abundances_vector, number_of_reads_aligned, number_of_reads_multimapped = \
+                        abundanceUtils.compute_strain_abundances(alignments_RDD,
+                                                                 number_of_partitions=data_num_partitions,
+                                                                 number_of_strains=number_of_strains,
+                                                                 debug_mode=debug_mode)
+
+            finally:
+                if shard_placement:
+                    shards.set_node_locality_wait(sc, previous_locality_wait)
 
-            genomes_to_read_contributions = read_contribution_to_genome.map(lambda x: (x[1], x[0]))
+            alignment_end_time = time.time()
+            alignment_total_time = alignment_end_time - alignment_start_time
 
-            if debug_mode:
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "] • Checkpoint 5: genomes_to_read_contributions")
-                chk_5_s = time.time()
-                checkpoint_5 = genomes_to_read_contributions.count()
-                chk_5_e = time.time()
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "]   TIME: " + str(timedelta(seconds=(chk_5_e - chk_5_s))))
+            alignment_stats = alignment_stats_acc.value
+            number_of_alignments = sum(shard_stats["alignments"] for shard_stats in alignment_stats.values())
 
+            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Bowtie2 & Abundances - Complete. " +
+                  "(" + str(timedelta(seconds=alignment_total_time)) + ")")
+            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "]" + " Found: " +
+                  '{:0,.0f}'.format(number_of_alignments) + " Alignments.")
 
-            # --------------------------------------- Reduce 2, Abundances --------------------------------------------
-            #
-            #   Following the KEY-VALUE inversion, we do a reduceByKey() to aggregate the fractional counts for a
-            #   given genomic assembly and calculate its abundance.
-            #
             if verbose_output:
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "] Calculating Genome Abundances...")
-
-            genomic_assembly_abundances = genomes_to_read_contributions.reduceByKey(lambda l1, l2: l1 + l2)
-
-            if debug_mode:
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "] • Checkpoint 6: Reduce 2, genomic_assembly_abundances")
-                chk_6_s = time.time()
-                checkpoint_6 = genomic_assembly_abundances.count()
-                chk_6_e = time.time()
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "]   TIME: " + str(timedelta(seconds=(chk_6_e - chk_6_s))))
-
-
-            #
-            #   Strain level abundances
-            #   At this point we have abundances at the genomic-assembly level (chromosomes, contigs, etc.), but what
-            #   we are after is abundances one level higher, i.e., at the Strain level. So we'll do one more map to
-            #   to set a key that we can reduce with at the Strain level.
-            #
-            #   Note: The key to map here is critical. The assembly FASTA files need to be in a format that tells us
-            #   how to 'fold up' the assemblies into a parent taxa. The FASTA files we indexed had a Taxonomic ID
-            #   that tells us the Organism name (at the Strain level), and it is delimited by a period and located
-            #   at the beginning of the FASTA record.
-            #
-            strain_map = genomic_assembly_abundances.map(lambda x: ("GCA_" + x[0].split(".")[0], x[1]))
-
-            if debug_mode:
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "] • Checkpoint 7: strain_map")
-                chk_7_s = time.time()
-                checkpoint_7 = strain_map.count()
-                chk_7_e = time.time()
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "]   TIME: " + str(timedelta(seconds=(chk_7_e - chk_7_s))))
+                print_alignment_metrics(number_input_reads, number_of_reads_aligned, number_of_reads_multimapped,
+                                        alignment_stats)
 
+            batch_abundances = [(int(strain_id), float(strain_abundances_vector[strain_id]))
+                                for strain_id in np.flatnonzero(strain_abundances_vector)]
 
-            #
-            #   Once the Mapping of organism names at the Strain level is complete, we can just Reduce them to
-            #   aggregate the Strain-level abundances.
-            #
-            strain_abundances = strain_map.reduceByKey(lambda l1, l2: l1 + l2).cache()
-
-            if debug_mode:
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "] • Checkpoint 8: strain_abundances")
-                chk_8_s = time.time()
-                checkpoint_8 = strain_abundances.count()
-                chk_8_e = time.time()
-                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                      "]   TIME: " + str(timedelta(seconds=(chk_8_e - chk_8_s))))
+            #   One (strain, abundance) pair per strain that 'this' shard touched, for the outputs below. This is where
+            #   strain IDs are turned back into strain names.
+            strain_abundances = sc.parallelize([(strain_table.get_strain_name(strain_id), abundance)
+                                                for strain_id, abundance in batch_abundances]).cache()
 
 
             # --------------------------------------- Abundance Coalescing --------------------------------------------
             #
-            #   If requested, we'll continously update the rolling count of abundances for the strains that we've
-            #   seen, or add new ones. Note that this involves a call to 'collect()' which brings back everything
-            #   to the Master node, so there is a slight hit on performance.
+            #   If requested, we'll continously update the rolling count of abundances for all strains. The abundances
+            #   of 'this' shard are already in the driver as a vector indexed by strain ID, so this is a single
+            #   vectorized add into the accumulator, and no extra Spark job. With a checkpoint directory, the rolling
+            #   count is kept in the sample's rolling profile instead, once the batch is done (see below).
             #
             if coalesce_output:
                 print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Updating abundance counts...")
 
-                #   Use 'collect()' to aggregate the counts for 'this' Shard and accumulate the rolling count.
-                #   We are violating the prime directive of Spark design patterns by using 'collect()', but in
-                #   practice, the call adds a negligible amount to the running time.
-                # list_strain_abundances = strain_abundances.collect()
-                #
-                # for a_strain in list_strain_abundances:
-                #     strain_name     = a_strain[0]
-                #     abundance_count = a_strain[1]
-                #
-                #     if strain_name in OVERALL_ABUNDANCES:
-                #         OVERALL_ABUNDANCES[strain_name] += abundance_count
-                #     else:
-                #         OVERALL_ABUNDANCES[strain_name] = abundance_count
-
-                abundace_rdd    = strain_abundances.map(lambda x: accumulate_abundaces(x)).cache()
-                abundance_count = abundace_rdd.count()
+                if get_checkpoint_dir(sample_id) is None:
+                    get_overall_abundaces(sample_id).add(strain_abundances_vector)
 
             else:
                 if save_to_s3:
                     output_file = output_file.replace("/abundances.txt", "")
                     output_dir_s3_path = "s3a://" + s3_output_bucket + "/" + output_file + "/shard_" + \
-                                         str(RDD_COUNTER) + "/"
+                                         str(get_shard_counter(sample_id)) + "/"
 
                     strain_abundances.map(lambda x: "%s\t%s" % (get_organism_name(x[0]), x[1])) \
                         .saveAsTextFile(output_dir_s3_path)
@@ -908,7 +2161,8 @@ def profile_sample(sampleReadsRDD, sc, ssc, output_file, save_to_s3, save_to_loc
                 #   not in the Master node.
                 #   TODO: Refactor so that it sends it back to the Master, and stores it in the 'local' master path.
                 # if save_to_local:
-                #     output_dir_local_path = output_file.replace("abundances.txt", "/shard_" + str(RDD_COUNTER))
+                #     output_dir_local_path = output_file.replace("abundances.txt", "/shard_" +
+                #                                                 str(get_shard_counter(sample_id)))
                 #     abundances_list = strain_abundances.map(lambda x: "%s\t%s" % (get_organism_name(x[0]), x[1])) \
                 #         .saveAsTextFile("file://" + output_dir_local_path)
 
@@ -951,7 +2205,7 @@ def profile_sample(sampleReadsRDD, sc, ssc, output_file, save_to_s3, save_to_loc
 
                     #   The gimmick here is to move the tmp file into a final location so that "saveAsTextFile()"
                     #   can write again.
-                    str_for_rename = shard_sub_dir_path + "/abundances-" + str(RDD_COUNTER) + ".txt"
+                    str_for_rename = shard_sub_dir_path + "/abundances-" + str(get_shard_counter(sample_id)) + ".txt"
                     renamed_file_path = Path(str_for_rename)
 
                     #   Create the directory in which we'll be storing the shard profiles.
@@ -970,7 +2224,7 @@ def profile_sample(sampleReadsRDD, sc, ssc, output_file, save_to_s3, save_to_loc
                         print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
                               "] Saving to local filesystem...")
 
-                    rdd_counter_str = "-" + str(RDD_COUNTER) + ".txt"
+                    rdd_counter_str = "-" + str(get_shard_counter(sample_id)) + ".txt"
                     output_file = output_file.replace("abundances", "/shard_profiles/abundances")
                     output_file = output_file.replace(".txt", rdd_counter_str)
 
@@ -987,197 +2241,175 @@ def profile_sample(sampleReadsRDD, sc, ssc, output_file, save_to_s3, save_to_loc
             #
             #   Housekeeping tasks go here. This completes the processing of a single streamed shard.
 
-            #   Increment the counter that we use to keep track of, and also use as an affix for a RDDs profile count.
-            increment_rdd_count()
-
-            #   Set the time at which 'this' RDD (a sample shard) was last processed.
-            set_time_of_last_rdd(time.time())
+            if stage_profiler is not None:
+                stage_profiler.end_batch(get_shard_counter(sample_id))
 
-            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Done.")
-            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "]")
+            update_batch_size(batch_time, number_input_reads, alignment_total_time, sample_id)
 
+            if get_metrics_recorder(sample_id) is not None:
+                record_batch_metrics(sc, number_input_reads, number_of_reads_aligned, number_of_reads_multimapped,
+                                     alignment_stats, alignment_total_time, batch_time, sample_id)
 
-        # ---------------------------------------------- Empty RDD Case -----------------------------------------------
-        #
-        else:
-            #   If we've analyzed the same number of shards as those that were requested, we stop the streaming.
-            #   How we stop streaming, it depends on what flags were set. We'll stop the streaming if the time
-            #   between the last RDD processed and now is greater than a user-defined timeout, or 3 seconds for
-            #   the default. Another way to stop is to have processed a certain number of shards. If this number
-            #   has been reached, then we'll go ahead and stop.
+            #   Increment the counter that we use to keep track of, and also use as an affix for a RDDs profile count.
+            increment_rdd_count(sample_id)
 
-            time_of_last_check = get_time_of_last_rdd()
-            time_now = time.time()
-            check_delta = timedelta(seconds=(time_now - time_of_last_check))
-            check_delta_int = int(check_delta.seconds)
+            #   Set the time at which 'this' RDD (a sample shard) was last processed.
+            set_time_of_last_rdd(time.time(), sample_id)
 
-            if time_of_last_check != 0:
-                if shard_equals_counter() or check_delta_int > streaming_timeout:
-                    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-                          "] All Requested Sample Shards Finished. (" + str(get_shards()) + " shards)")
+            #   The cached blocks of 'this' batch are released below, so this should stay flat over the run.
+            storage_memory_used, storage_memory_max = metricsUtils.get_storage_memory(sc)
+            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Storage Memory: " +
+                  '{:0,.0f}'.format(storage_memory_used / (1024 * 1024)) + " MB of " +
+                  '{:0,.0f}'.format(storage_memory_max / (1024 * 1024)) + " MB, Persisted RDDs: " +
+                  str(sc._jsc.getPersistentRDDs().size()))
 
-                    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Stopping Streaming.")
+            #   Last, so that a batch that failed halfway is not in the profile that the checkpoint ledger saves.
+            if get_checkpoint_dir(sample_id) is not None:
+                get_sample_state(sample_id).rolling_profile += strain_abundances_vector
 
-                    set_analysis_end_time()
+            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Done.")
+            print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "]")
 
-                    #   The last thing we do is to stop the streaming context. Once this command finishes, we are
-                    #   jumped back-out into the code-block that called us — the 'flint.py' script.
-                    ssc.stop()
+        batch_profiled = True
 
     except Exception as ex:
         template = "[Flint - ERROR] An exception of type {0} occurred. Arguments:\n{1!r}"
         message = template.format(type(ex).__name__, ex.args)
         print(message)
 
+        #   A streamed sample carries on with its next batch, but a sample file that was not profiled fails the run.
+        if split_input or batch_time is None:
+            raise
 
+    finally:
+        release_batch_artifacts(broadcast_sample_reads, [read_blocks_RDD, strain_abundances])
 
+        if batch_profiled:
+            complete_batch(batch_time, sample_id)
+        else:
+            fail_batch(batch_time, sample_id)
 
+    return batch_profiled
 
-# --------------------------------------------- Non-Streaming Job -----------------------------------------------------
-#
-#
-def dispatch_local_job(mate_1, mate_2, tab5File, sampleID, sample_format, output_file,
-                       save_to_s3, partition_size, sc):
+
+def release_batch_artifacts(broadcast_variable, cached_RDDs):
     """
-    Executes the requested Spark job in the cluster in a non-streaming method.
+    Releases the broadcast variable and the cached RDDs of a batch, so that a long stream runs in flat memory. Spark
+    would only drop them when it runs out of storage memory, or when the driver garbage-collects them.
     Args:
-        mate_1: Paired-end reads left-side read.
-        mate_2: Paired-end reads right-side read.
-        tab5File:   Sample reads file in tab5 format.
-        sampleID:   The unique id of the sample.
-        sample_format: What type of input format are the reads in (tab5, fastq, tab6, etc.).
-        output_file:    The path to the output file.
-        save_to_s3: Flag for storing output to AWS S3.
-        partition_size: Level of parallelization for RDDs that are not partitioned by the system.
-        sc:     Spark Context.
+        broadcast_variable: The broadcast variable with the reads of the batch, or None.
+        cached_RDDs:        A list of cached RDDs (or None).
 
     Returns:
-        Nothing, if all goes well it should return cleanly.
+        Nothing.
     """
+    for cached_RDD in cached_RDDs:
+        if cached_RDD is not None:
+            cached_RDD.unpersist()
 
-    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] ")
-    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "]" + " Analyzing Sample " + sampleID +
-          " (" + sample_format + ")")
-
-    #
-    #   Paired-end Reads Code path.
-    #
-    if sample_format == "tab5":
-
-        # ------------------------------------------ Alignment ----------------------------------------------------
-        #
-        #   Alignment of sample reads to the index in each of the workers is delegated to Bowtie2, and getting the
-        #   reads to bowtie2 is performed through Spark's most-excellent pipe() function that sends the contents
-        #   of the RDD to the STDIN of the mapping script. The mapping script communicates with bowtie2 and outputs
-        #   the alignments to STDOUT which is captured by Spark and returned to us as an RDD.
-        #
-
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Loading Sample...")
-        sampleRDD = loadTab5File(sc, tab5File)
-        sampleReadsRDD = sampleRDD.values()
-
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Starting Alignment with Bowtie2...")
-        alignment_start_time = time.time()
-
-        alignmentsRDD = sampleReadsRDD.pipe(dnaMappingScript)
-
-        numberOfAlignments = alignmentsRDD.count()
-
-        alignment_end_time = time.time()
-        alignment_total_time = alignment_end_time - alignment_start_time
-
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Bowtie2 - Complete. " +
-              "(" + str(timedelta(seconds=alignment_total_time)) + ")")
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "]" + " Found: " +
-              '{:0,.0f}'.format(numberOfAlignments) + " Alignments.")
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "]")
-
-
-        # --------------------------------------------- Map -------------------------------------------------------
-        #
-        #   The Map step sets up the basic data structure that we start with — a map of reads to the genomes they
-        #   align to.  Each alignment (in SAM format) is parsed an broken down into two (2) pieces: the read name,
-        #   and the genome reference.  The REDUCE step afterwards will collect all the genomes and key them to a
-        #   unique read name.
-        #
-        #   SAM format: [0] - QNAME (the read name)
-        #               [1] - FLAG
-        #               [2] - RNAME (the genome reference name that the read aligns to
-
-        #   We'll Map a read (QNAME) with a genome reference name (RNAME).
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] MAP - Reads to Genomes (QNAME-RNAME).")
-        mapReadToGenomes    = alignmentsRDD.map(lambda line: (line.split("\t")[0], [line.split("\t")[2]] ))
-
-
-        # -------------------------------------------- Reduce -----------------------------------------------------
-        #
-        #   Reduce will operate first by calculating the read contributions, and then using these contributions
-        #   to calculate an abundance.
-        #   Note the "+" operator can be used to concatenate two lists. :)
-        #
-
-        #   'Reduce by Reads' will give us a 'dictionary-like' data structure that contains a Read Name (QNAME) as
-        #   the KEY, and a list of genome references (RNAME) as the VALUE. This allows us to calculate
-        #   each read's contribution.
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] REDUCE - Reads to list of Genomes.")
-        readsToGenomesList = mapReadToGenomes.reduceByKey(lambda l1, l2: l1 + l2)
+    #   'destroy()' also drops the copy in the driver. The broadcast can't be used after this.
+    if broadcast_variable is not None:
+        broadcast_variable.destroy()
 
 
-        # ---------------------------------- Fractional Reads & Abundances ----------------------------------------
-        #
-        #   Read Contributions.
-        #   Each read is normalized by the number of genomes it maps to. The idea is that reads that align to
-        #   multiple genomes will contribute less (have a hig denominator) than reads that align to fewer genomes.
-
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "]")
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Calculating Read Contributions...")
-        readContributions = readsToGenomesList.mapValues(lambda l1: 1/float(len(l1)))
-
-        #   Once we have the read contributions, we'll JOIN them with the starting mapReadToGenomes RDD to get an
-        #   RDD that will map the read contribution to the Genome it aligns to.
-        #   Note: l[0] is the Read name (key), and l[1] is the VALUE (a list) after the join.
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-              "] Joining Read Contributions to Genomes...")
-
-        readContributionToGenome = readContributions.join(mapReadToGenomes)\
-                                                    .map(lambda l: (l[1][0], "".join(l[1][1])))
 
-        #   After we have the RDD mapping the Read Contributions to Genome Names, we'll flip the (KEY,VALUE) pairings
-        #   so that we have Genome Name as KEY and Read Contribution as Value.
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) +
-              "] Flipping Genomes and Read Contributions...")
 
-        genomesToReadContributions = readContributionToGenome.map(lambda x: (x[1], x[0]))
 
-        #   Following the KEY-VALUE inversion, we do a reduceByKey() to aggregate the fractional counts for a
-        #   given Genome and calculate its abundance.
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Calculating Genome Abundances...")
-
-        genomeAbundances = genomesToReadContributions.reduceByKey(lambda l1, l2: l1 + l2)
-
-
-        # ------------------------------------------ Output Reports -----------------------------------------------
-        #
-        #   Reports are written out to an S3 bucket specified in the initial JSON config file.
-        #
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "]")
-        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Writing Output Reports...")
+# --------------------------------------------- Non-Streaming Job -----------------------------------------------------
+#
+#
+def dispatch_local_job(sampleID, sample_format, sample_type, output_file, save_to_s3, save_to_local, partition_size,
+                       sc, sensitive_align, annotations_dictionary, s3_output_bucket, keep_shard_profiles,
+                       coalesce_output, verbose_output, debug_mode, sample_file=None, mate_1=None, mate_2=None):
+    """
+    Executes the requested Spark job in the cluster in a non-streaming (batch) method. The sample file is read as
+    splittable input, and every input split is aligned against all the index shards in the Executors, so that a large
+    sample is profiled with the whole cluster, and without a producer process. The sample goes through
+    'profile_sample()' as a single shard, so its output is the same as that of a streamed sample.
+    Args:
+        sampleID:               The unique id of the sample.
+        sample_format:          What type of input format are the reads in (tab5, fastq, or interleaved_fastq).
+        sample_type:            Are the reads single-end or paired-end.
+        output_file:            The path to the output file.
+        save_to_s3:             Flag for storing output to AWS S3.
+        save_to_local:          Flag for storing output to the local filesystem.
+        partition_size:         Level of parallelization for RDDs that are not partitioned by the system. The
+                                sample file is read in at least this many splits.
+        sc:                     Spark Context.
+        sensitive_align:        Sensitive Alignment Mode.
+        annotations_dict:       Dictionary of Annotations for reporting organism names.
+        s3_output_bucket:       The S3 bucket to write files into.
+        keep_shard_profiles:    Retains the shard profile in S3 or the local filesystem.
+        coalesce_output:        Merge output into a single file.
+        verbose_output:         Flag for wordy terminal print statements.
+        debug_mode:             Flag for debug mode.
+        sample_file:            Sample reads file, in tab5, FASTQ, or interleaved FASTQ format. A local, HDFS, or S3
+                                ('s3a://') path. FASTQ files can be gzipped.
+        mate_1:                 Instead of 'sample_file', the FASTQ file with mate 1 of a paired-end sample.
+        mate_2:                 The FASTQ file with mate 2 of a paired-end sample.
 
-        if save_to_s3:
+    Returns:
+        Nothing, if all goes well it should return cleanly.
+    """
 
-            #   We map the abundances so that we get a nice tab-delimited file, then repartition it so that we only
-            #   get a single file, and not multiple ones for each partition.
-            genomeAbundances.map(lambda x: "%s\t%s" %(x[0],x[1]))\
-                            .repartition(1)\
-                            .saveAsTextFile(output_file)
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] ")
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Sample Source: [FILE]")
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Sample ID: " + sampleID +
+          " (" + sample_format + ", " + sample_type + ")")
 
-        else:
-            writer = csv.writer(open(output_file, "wb"), delimiter='\t', lineterminator="\n")
-            abundances = genomeAbundances.collect()
-            writer.writerow(abundances)
+    if sample_file is not None:
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Sample File: " + sample_file)
+    else:
+        print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Mate Files: " + mate_1 + ", " +
+              mate_2)
 
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] ")
 
-        return
+    #   The whole sample is a single shard.
+    set_number_of_shards(1, sampleID)
+
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Loading Sample...")
+
+    #   FASTQ records are parsed into tab5 reads in the Executors, as the splits are read.
+    if sample_format == fastqUtils.FORMAT_TAB5:
+        sample_reads_RDD = loadTab5File(sc, sample_file, min_partitions=partition_size)
+    elif sample_format == fastqUtils.FORMAT_INTERLEAVED_FASTQ:
+        sample_reads_RDD = loadFASTQFile(sc, sample_file, min_partitions=partition_size, interleaved=True)
+    elif sample_format == fastqUtils.FORMAT_FASTQ and sample_file is not None:
+        sample_reads_RDD = loadFASTQFile(sc, sample_file, min_partitions=partition_size)
+    elif sample_format == fastqUtils.FORMAT_FASTQ:
+        sample_reads_RDD = loadPairedFASTQFiles(sc, mate_1, mate_2, min_partitions=partition_size)
+    else:
+        raise ValueError("Unsupported sample format: " + str(sample_format))
+
+    #   One slot per strain ID, so the size is fixed by the strain table.
+    number_of_strains = get_strain_table().value.get_number_of_strains()
+    overall_abundance_accumulator = sc.accumulator(np.zeros(number_of_strains, dtype=np.float64),
+                                                   AbundanceAccumulator())
+    set_overall_abundances(overall_abundance_accumulator, sampleID)
+
+    profile_sample(sampleReadsRDD=sample_reads_RDD,
+                   sample_id=sampleID,
+                   split_input=True,
+                   output_file=output_file,
+                   save_to_s3=save_to_s3,
+                   save_to_local=save_to_local,
+                   sample_type=sample_type,
+                   sensitive_align=sensitive_align,
+                   annotations_dictionary=annotations_dictionary,
+                   partition_size=partition_size,
+                   s3_output_bucket=s3_output_bucket,
+                   keep_shard_profiles=keep_shard_profiles,
+                   coalesce_output=coalesce_output,
+                   verbose_output=verbose_output,
+                   debug_mode=debug_mode,
+                   streaming_timeout=0,
+                   bowtie2_node_path=get_bowtie2_path(),
+                   bowtie2_index_path=get_bowtie2_index_path(),
+                   bowtie2_index_name=get_bowtie2_index_name(),
+                   bowtie2_number_threads=get_bowtie2_number_threads())
+
+    set_analysis_end_time(sampleID)
 
 
 
@@ -1186,48 +2418,81 @@ def dispatch_local_job(mate_1, mate_2, tab5File, sampleID, sample_format, output
 #   Miscellaneous helper functions for Mapping, accumulating, reducing, etc.
 #
 
-def loadTab5File(sc, pathToSampleFile):
+def loadTab5File(sc, pathToSampleFile, min_partitions=None):
     """
-    Loads a Tab5-formatted file into an RDD. The file is loaded using the Hadoop File API so we can create an RDD
-    based on the tab5 format: [name]\t[seq1]\t[qual1]\t[seq2]\t[qual2]\n
+    Loads a Tab5-formatted file into an RDD. The file is loaded using the Hadoop File API, so an uncompressed file is
+    split at line boundaries, and its splits are read in parallel.
+    Tab5 format: [name]\t[seq1]\t[qual1]\t[seq2]\t[qual2]\n
     Args:
         sc: A Spark context
         pathToSampleFile: A valid Hadoop file path (S3, HDFS, etc.).
+        min_partitions: Minimum number of splits to read the file in.
 
     Returns:
-        An RDD with a record number as KEY, and reads as VALUE.
+        An RDD of tab5-formatted reads, one per line.
     """
-    sampleRDD = sc.newAPIHadoopFile(pathToSampleFile,
-                                    'org.apache.hadoop.mapreduce.lib.input.TextInputFormat',
-                                    'org.apache.hadoop.io.LongWritable',
-                                    'org.apache.hadoop.io.Text',
-                                    conf={'textinputformat.record.delimiter': '\n'})
+    sampleRDD = sc.textFile(pathToSampleFile, minPartitions=min_partitions)
 
-    return sampleRDD
+    return sampleRDD.filter(lambda read: len(read) > 0)
 
 
-def loadFASTQFile(sc, pathToSampleFile):
+def loadFASTQFile(sc, pathToSampleFile, min_partitions=None, interleaved=False):
     """
-    Loads a FASTQ file into an RDD. The file is loaded using the Hadoop File API so we can create an RDD based on the
-    FASTQ file format, i.e., multiline parsing of the file.
+    Loads a FASTQ file (plain or gzipped) into an RDD of tab5 reads. The file is read as lines, and every split is
+    parsed in the Executors from its first record on. The lines that complete the last record of a split are looked up
+    first with a small job that only reads the beginning of each split. See 'flint_fastq.py'.
 
     Args:
         sc: A Spark context
         pathToSampleFile: A valid Hadoop file path (S3, HDFS, etc.).
+        min_partitions: Minimum number of partitions of the reads. Gzipped files are read by a single task, and their
+                        reads are repartitioned.
+        interleaved: The file is an interleaved FASTQ file, with the mates of each pair next to each other.
 
     Returns:
-        An RDD with a record number as KEY, and read attributes as VALUE.
+        An RDD of tab5-formatted reads, paired-end if the file is interleaved.
     """
+    linesRDD = sc.textFile(pathToSampleFile, minPartitions=min_partitions)
+
+    split_heads = linesRDD.mapPartitionsWithIndex(
+        lambda index, lines: [(index, fastqUtils.read_split_head(lines, interleaved))]).collect()
+
+    #   Small enough to ship with the closure.
+    split_continuations = fastqUtils.get_split_continuations(split_heads, interleaved)
 
-    sampleRDD = sc.newAPIHadoopFile(pathToSampleFile,
-                                    'org.apache.hadoop.mapreduce.lib.input.TextInputFormat',
-                                    'org.apache.hadoop.io.LongWritable',
-                                    'org.apache.hadoop.io.Text',
-                                    conf={'textinputformat.record.delimiter': '\n@'})
+    def split_to_tab5(index, lines):
+        skip_lines, continuation = split_continuations[index]
+        return fastqUtils.fastq_split_to_tab5(lines, skip_lines, continuation, interleaved)
+
+    sampleRDD = linesRDD.mapPartitionsWithIndex(split_to_tab5)
+
+    if min_partitions is not None and sampleRDD.getNumPartitions() < min_partitions:
+        sampleRDD = sampleRDD.repartition(min_partitions)
 
     return sampleRDD
 
 
+def loadPairedFASTQFiles(sc, pathToMate1, pathToMate2, min_partitions=None):
+    """
+    Loads the two FASTQ files (plain or gzipped) of a paired-end sample into an RDD of tab5 reads. Each file is parsed
+    with 'loadFASTQFile()', and the mates are joined by read name.
+
+    Args:
+        sc: A Spark context
+        pathToMate1: A valid Hadoop file path (S3, HDFS, etc.) to the mate 1 reads.
+        pathToMate2: A valid Hadoop file path (S3, HDFS, etc.) to the mate 2 reads.
+        min_partitions: Minimum number of partitions of the reads.
+
+    Returns:
+        An RDD of paired-end tab5-formatted reads.
+    """
+    mate_1_RDD = loadFASTQFile(sc, pathToMate1, min_partitions).map(fastqUtils.tab5_to_mate)
+    mate_2_RDD = loadFASTQFile(sc, pathToMate2, min_partitions).map(fastqUtils.tab5_to_mate)
+
+    return mate_1_RDD.join(mate_2_RDD, numPartitions=min_partitions)\
+                     .map(lambda paired_read: fastqUtils.mates_to_tab5(paired_read[0], paired_read[1]))
+
+
 def getBowtie2Command(bowtie2_node_path, bowtie2_index_path, bowtie2_index_name, bowtie2_number_threads):
     """
     Constructs a properly formatted shell Bowtie2 command by performing a simple lexical analysis using 'shlex.split()'.
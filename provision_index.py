@@ -42,7 +42,7 @@
 from pyspark import SparkConf, SparkContext
 
 # 	Python Modules
-import sys
+import os, sys
 import argparse
 import time
 import collections
@@ -50,6 +50,13 @@ from datetime import timedelta
 import subprocess as sp
 import shlex
 
+#   Flint Modules
+sys.path.append(os.path.join(os.path.dirname(__file__), 'modules'))
+import flint_index_shards as shards
+
+#   Local path of the Bowtie2 index in the worker nodes.
+LOCAL_INDEX_PATH = "/mnt/bio_data/index"
+
 # -------------------------------------------------------- Main -------------------------------------------------------
 #
 #
@@ -69,12 +76,15 @@ def main(args):
     parser = argparse.ArgumentParser()
     parser.add_argument("--shards", required=True, type=int, help="Number of Bowtie2 Index Shards.")
     parser.add_argument("--bowtie2_index", required=True, type=str, help="S3 Path of bucket.")
+    parser.add_argument("--shard_dirs", required=False, action="store_true",
+                        help="Copy each shard into its own sub-directory, so that a worker can hold more than one.")
     parser.add_argument("--verbose", required=False, action="store_true", help="Wordy print statements.")
     args = parser.parse_args(args)
 
     index_location_s3 = args.bowtie2_index
     index_location_s3.strip()
     number_of_index_shards = args.shards
+    shard_dirs = args.shard_dirs
 
     #
     #   Spark Configuration, and App declaration.
@@ -91,6 +101,7 @@ def main(args):
 
     #   Initialize the Spark context for this run.
     sc = SparkContext(conf=conf)
+    sc.addPyFile(os.path.join(os.path.dirname(__file__), 'modules/flint_index_shards.py'))
 
     start_time = time.time()
 
@@ -104,16 +115,16 @@ def main(args):
     range_end = number_of_index_shards + 1  # Range function does not include the end.
     for partition_id in range(1, range_end):
         s3_location = index_location_s3 + "/" + str(partition_id)
-        list_of_index_shards.append(s3_location)
+        list_of_index_shards.append((partition_id, s3_location))
 
     print("[ " + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + " ] Index Shards to Copy:")
 
-    for location in list_of_index_shards:
+    for shard_id, location in list_of_index_shards:
         print(location)
 
     print("[ " + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + " ] ")
 
-    index_shards = sc.parallelize(list_of_index_shards)
+    index_shards = sc.parallelize(list_of_index_shards, number_of_index_shards)
     # index_shards = index_shards.repartition(number_of_index_shards)
 
     print("[ " + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + " ] No. RDD Partitions: " +
@@ -126,7 +137,7 @@ def main(args):
     #   The acknowledge_RDD will dispatch the "copy_index_to_worker()" function to all the workers via the
     #   "mapPartitions()" function.
     #
-    acknowledge_RDD = index_shards.mapPartitions(copy_index_to_worker)
+    acknowledge_RDD = index_shards.mapPartitions(lambda iterator: copy_index_to_worker(iterator, shard_dirs))
 
     #
     #   Once the "mapPartitions()" has executed (not really because it lazely evaluated), we'll collect the
@@ -137,19 +148,30 @@ def main(args):
 
     number_of_acknowledgements = len(acknowledge_list)
 
+    #   Every shard leaves a marker in its directory, which 'flint.py --shard_placement' uses to find it. Without
+    #   '--shard_dirs', a worker that received two shards only keeps the last one.
+    worker_hosts = [worker_node_ip for shard_id, worker_node_ip, report in acknowledge_list]
+    duplicate_hosts = [item for item, count in collections.Counter(worker_hosts).items() if count > 1]
+
     print("[ " + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + " ] ")
     print("[ " + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + " ] No. of Workers that acknowledged: " +
           str(number_of_acknowledgements))
     print("[ " + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + " ] ")
 
     if args.verbose:
-        for ack in acknowledge_list:
-            print(ack)
+        for shard_id, worker_node_ip, report in acknowledge_list:
+            print("Shard " + str(shard_id) + " -> " + report)
 
-        print("[ " + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + " ] ")
+    if duplicate_hosts:
         print("[ " + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + " ] Duplicate Worker IPs:")
 
-        print [item for item, count in collections.Counter(acknowledge_list).items() if count > 1]
+        for worker_node_ip in sorted(duplicate_hosts):
+            print(worker_node_ip + ": shards " + ", ".join([str(shard_id) for shard_id, a_host, report
+                                                            in acknowledge_list if a_host == worker_node_ip]))
+
+        if not shard_dirs:
+            print("[ " + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + " ] WARNING! Workers above only " +
+                  "keep their last shard. Use '--shard_dirs', or one Executor per worker.")
 
 
     end_time = time.time()
@@ -167,31 +189,39 @@ def main(args):
     sc.stop()
 
 
-def copy_index_to_worker(iterator):
+def copy_index_to_worker(iterator, shard_dirs=False):
     """
     Function that runs on all the Worker nodes. It will copy the Index from the specified location into the worker's
-    local filesystem.
+    local filesystem, and mark the directory with the number of the shard it holds.
     Args:
-        iterator:
+        iterator:   (shard number, S3 location) tuples.
+        shard_dirs: If True, each shard is copied into its own sub-directory of the local index path.
 
     Returns:
-
+        (shard number, worker host, report) tuples.
     """
     return_data = []
 
-    worker_node_ip = str(sp.check_output(["hostname"])).strip()
+    worker_node_ip = sp.check_output(["hostname"]).decode().strip()
 
-    local_index_path = "/mnt/bio_data/index"
+    for shard_id, s3_location in iterator:
 
-    for s3_location in iterator:
+        local_index_path = LOCAL_INDEX_PATH
+        if shard_dirs:
+            local_index_path = os.path.join(LOCAL_INDEX_PATH, str(shard_id))
 
         aws_copy_command = "aws s3 cp --recursive " + s3_location + " " + local_index_path
 
         aws_process = sp.Popen(shlex.split(aws_copy_command), stdout=sp.PIPE, stderr=sp.PIPE)
         stdout, stderr = aws_process.communicate()
-        return_data.append(worker_node_ip + "\n" +
-                           "STDERR: " + stderr + "**********\n" +
-                           "AWS COMMAND:\n" + aws_copy_command + "\n")
+
+        if aws_process.returncode == 0:
+            shards.write_shard_marker(local_index_path, shard_id)
+
+        return_data.append((shard_id, worker_node_ip,
+                            worker_node_ip + "\n" +
+                            "STDERR: " + stderr.decode() + "**********\n" +
+                            "AWS COMMAND:\n" + aws_copy_command + "\n"))
 
     return iter(return_data)
 
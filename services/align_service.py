@@ -15,6 +15,16 @@
 #   NOTES:
 #   Please see the dependencies section below for the required libraries (if any).
 #
+#   The service is started on-demand by the Spark Executors (see 'flint_bowtie2_mapping.py'), one per index shard on
+#   each worker node, and it listens on a local UNIX socket. A client sends a batch of tab5 reads followed by an
+#   empty line, and receives the SAM lines of the reads that aligned, followed by an empty line. Bowtie2 itself is
+#   started once, with its STDIN kept open, so the index is loaded only when the service starts.
+#
+#   Bowtie2 does not tell us when it is done with a batch, so after the reads of a batch we send a 'sentinel' read
+#   that cannot align, and a block of 'padding' reads that push the sentinel through Bowtie2's input and output
+#   buffers. Bowtie2 runs with '--reorder', so once the sentinel shows up in the output, all the reads of the batch
+#   have been reported.
+#
 #   DEPENDENCIES:
 #
 #       • Python & the modules listed below
@@ -34,67 +44,179 @@
 
 
 # 	Python Modules
-import sys
-import shlex
+import os, sys
+import time
+import argparse
+import json
+import socket
+import threading
 from subprocess import Popen, PIPE
 import signal
 
 
+#   Read names for the reads that we append to each batch. They are made of 'N' bases, so they never align.
+SENTINEL_READ_NAME  = "FLINT_BATCH_END"
+PADDING_READ_NAME   = "FLINT_BATCH_PAD"
+PADDING_READ_LENGTH = 100
+
+
 # -------------------------------------------------------- Main -------------------------------------------------------
 #
 #
 def main(args):
 
-    #   Obtain a properly formatted Bowtie2 command.
-    bowtieCMD = getBowtie2Command()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", required=True, type=str, help="Path of the UNIX socket to listen on.")
+    parser.add_argument("--bowtie2_cmd", required=True, type=str, help="Bowtie2 command, as a JSON list.")
+    parser.add_argument("--idle_timeout", type=int, default=900,
+                        help="Seconds without clients after which the service shuts down.")
+    parser.add_argument("--padding_reads", type=int, default=2048,
+                        help="Number of padding reads sent after each batch to flush Bowtie2's buffers.")
+    args = parser.parse_args(args)
 
-    try:
-        #   Open a pipe to the subprocess that will launch the Bowtie2 aligner.
-        align_subprocess = Popen(bowtieCMD, stdin=PIPE, stdout=sys.stdout, stderr=PIPE)
+    bowtieCMD = json.loads(args.bowtie2_cmd)
 
-        #   Dispatch the subprocess using STDIN as the input.
-        #   The Alignment Rate reported from Bowtie2 comes in through STDERR.
-        alignment_output, alignment_error = align_subprocess.communicate(input=sys.stdin.read())
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Starting Bowtie2 service: " +
+          " ".join(bowtieCMD))
 
+    try:
+        #   Open a pipe to the subprocess that will launch the Bowtie2 aligner. It stays up for as long as the
+        #   service does, so the index is only loaded once.
+        align_subprocess = Popen(bowtieCMD, stdin=PIPE, stdout=PIPE, preexec_fn=default_sigpipe)
 
     except OSError as e:
         print("OS ERROR: " + str(e))
+        sys.exit(1)
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(args.socket)
+    server.listen(64)
+    server.settimeout(args.idle_timeout)
+
+    padding_block = build_padding_block(args.padding_reads)
+
+    try:
+        while align_subprocess.poll() is None:
+            try:
+                connection, _ = server.accept()
+            except socket.timeout:
+                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Idle timeout. Shutting down.")
+                break
+
+            connection.settimeout(None)
+
+            try:
+                align_batch(connection, align_subprocess, padding_block)
+            except (IOError, OSError, socket.error) as e:
+                print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Batch Error: " + str(e))
+            finally:
+                connection.close()
+
+    finally:
+        server.close()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+
+        if align_subprocess.poll() is None:
+            align_subprocess.stdin.close()
+            align_subprocess.terminate()
+            align_subprocess.wait()
 
 
 
 # ----------------------------------------------- Helper Functions -----------------------------------------------------
 #
 #
-def getBowtie2Command():
+def align_batch(connection, align_subprocess, padding_block):
     """
-    Constructs a properly formatted shell Bowtie2 command by performing a simple lexical analysis using 'shlex.split()'.
+    Aligns a single batch of reads sent by a client. Reads are copied from the socket into Bowtie2's STDIN in a
+    separate thread, while this thread copies the SAM lines from Bowtie2's STDOUT back into the socket.
+    Args:
+        connection:         The client socket.
+        align_subprocess:   The resident Bowtie2 process.
+        padding_block:      Bytes with the sentinel and padding reads that close a batch.
+
     Returns:
-        An array with the bowtie 2 command call split into an array that can be used by the popen() function.
+        Nothing. The alignments are written back into the socket.
     """
+    client_in  = connection.makefile('rb')
+    client_out = connection.makefile('wb')
+
+    def feed_reads():
+        try:
+            for a_line in iter(client_in.readline, b''):
+                if a_line.strip() == b'':
+                    break
+
+                #   A line without its newline means the client went away half-way through a read. Passing it on
+                #   would glue it to the sentinel read.
+                if not a_line.endswith(b"\n"):
+                    break
 
-    index_location = '/mnt/bio_data/index/ensembl_v40'
-
-    bowtieCMD = '/home/hadoop/apps/bowtie2-2.3.4.1-linux-x86_64/bowtie2 \
-                                    --threads 6 \
-                                    --local \
-                                    -D 5 \
-                                    -R 1 \
-                                    -N 0 \
-                                    -L 25 \
-                                    -i \'"S,0,2.75"\' \
-                                    --no-discordant \
-                                    --no-mixed \
-                                    --no-contain \
-                                    --no-overlap \
-                                    --no-sq \
-                                    --no-hd \
-                                    --no-unal \
-                                    -q \
-                                    -x ' + index_location + ' --tab5 -'
-
-    return shlex.split(bowtieCMD)
+                align_subprocess.stdin.write(a_line)
+
+        except (IOError, OSError, socket.error):
+            #   The client went away. We still close the batch, so that Bowtie2's output stays in step.
+            pass
+
+        finally:
+            align_subprocess.stdin.write(padding_block)
+            align_subprocess.stdin.flush()
+
+    feeder = threading.Thread(target=feed_reads)
+    feeder.daemon = True
+    feeder.start()
+
+    client_alive = True
+
+    #   We always read up to the sentinel, even if the client is gone, otherwise the alignments of 'this' batch
+    #   would be handed to the next client.
+    for a_line in iter(align_subprocess.stdout.readline, b''):
+        fields = a_line.split(b"\t", 3)
+
+        #   Padding from the previous batch, or a line we can't use.
+        if len(fields) < 3 or fields[0] == PADDING_READ_NAME.encode():
+            continue
+
+        if fields[0] == SENTINEL_READ_NAME.encode():
+            break
+
+        #   Bowtie2 runs without '--no-unal' here (the sentinel has to come back), so we drop unaligned reads.
+        if int(fields[1]) & 4 or not client_alive:
+            continue
+
+        try:
+            client_out.write(a_line)
+        except (IOError, OSError, socket.error):
+            client_alive = False
+
+    feeder.join()
+
+    #   The empty line tells the client that the batch is complete.
+    if client_alive:
+        client_out.write(b"\n")
+        client_out.flush()
+
+
+def build_padding_block(number_of_padding_reads):
+    """
+    Builds the block of tab5 reads that we send after every batch: one sentinel read followed by padding reads.
+    Args:
+        number_of_padding_reads:    How many padding reads to add after the sentinel.
+
+    Returns:
+        A bytes object with the tab5 lines for the sentinel and padding reads.
+    """
+    sequence = "N" * PADDING_READ_LENGTH
+    quality  = "I" * PADDING_READ_LENGTH
 
+    block = SENTINEL_READ_NAME + "\t" + sequence + "\t" + quality + "\n"
+    block += (PADDING_READ_NAME + "\t" + sequence + "\t" + quality + "\n") * number_of_padding_reads
 
+    return block.encode()
 
 
 def validate_output(stringToValidate):
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# ---------------------------------------------------------------------------------------------------------------------
+#
+#                                       Florida International University
+#
+#   This software is a "Camilo Valdes Work" under the terms of the United States Copyright Act.
+#   Please cite the author(s) in any work or product based on this material.
+#
+#   OBJECTIVE:
+#	    The purpose of this program is to compare the running time of the partition-local abundance engine against
+#       the original reduceByKey/join chain, on a synthetic set of alignments.
+#
+#
+#   NOTES:
+#   Please see the dependencies section below for the required libraries (if any).
+#
+#   The synthetic alignments are generated in the Executors, and cached before timing starts, so that only the
+#   abundance calculation is measured. Each read aligns to between 1 and '--max_hits' assemblies, and the assembly
+#   names follow the format written by 'genome_preprocessing/4-fasta_concatenation/concatenate.py'. The legacy chain
+#   gets the alignments as (QNAME, RNAME) strings, and the partition engine gets the same alignments encoded as
+#   (read ID, strain ID) integers, as the SAM parser in the Executors would hand them over.
+#
+#   DEPENDENCIES:
+#       • Apache-Spark
+#       • Python
+#
+#   You can check the python modules currently installed in your system by running: python -c "help('modules')"
+#
+#   USAGE:
+#       Run the program with the "--help" flag to see usage instructions, e.g.,
+#
+#       spark-submit utilities/benchmark_abundance_engine.py --alignments 10000000 --partitions 64
+#
+#	AUTHOR:
+#           Camilo Valdes (camilo@castflyer.com)
+#			Florida International University (FIU)
+#
+#
+# ---------------------------------------------------------------------------------------------------------------------
+
+#   Spark Modules
+from pyspark import SparkConf, SparkContext
+
+# 	Python Modules
+import os, sys
+import argparse
+import time
+import random
+from datetime import timedelta
+
+#   Flint Modules
+sys.path.append(os.path.join(os.path.dirname(__file__), '../modules'))
+import flint_abundances as abundanceUtils
+import flint_strain_table as strainTable
+
+
+# -------------------------------------------------------- Main -------------------------------------------------------
+#
+#
+def main(args):
+    """
+    Main function of the app.
+    Args:
+        args: command line arguments.
+
+    Returns:
+        Nothing.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--alignments", required=False, type=int, default=10000000,
+                        help="Approximate number of synthetic alignments.")
+    parser.add_argument("--strains", required=False, type=int, default=5000, help="Number of strains.")
+    parser.add_argument("--contigs_per_strain", required=False, type=int, default=4,
+                        help="Number of genomic assemblies (contigs) per strain.")
+    parser.add_argument("--max_hits", required=False, type=int, default=4,
+                        help="Maximum number of alignments per read.")
+    parser.add_argument("--partitions", required=False, type=int, default=64, help="Number of RDD partitions.")
+    parser.add_argument("--repeats", required=False, type=int, default=3, help="Timed runs per engine.")
+    args = parser.parse_args(args)
+
+    conf = (SparkConf().setAppName("Flint_Abundance_Benchmark"))
+    sc = SparkContext(conf=conf)
+    sc.addPyFile(os.path.join(os.path.dirname(__file__), '../modules/flint_strain_table.py'))
+    sc.addPyFile(os.path.join(os.path.dirname(__file__), '../modules/flint_abundances.py'))
+
+    number_of_reads = int(args.alignments / ((1 + args.max_hits) / 2.0))
+
+    strains             = args.strains
+    contigs_per_strain  = args.contigs_per_strain
+    max_hits            = args.max_hits
+
+    def synthetic_alignments(iterator):
+        for read_id in iterator:
+            rng = random.Random(read_id)
+            read_name = "SYNTHETIC_READ_" + str(read_id)
+
+            for hit in range(rng.randint(1, max_hits)):
+                strain = rng.randint(1, strains)
+                contig = rng.randint(1, contigs_per_strain)
+                yield read_name, str(strain) + ".1_CONTIG" + str(contig) + "_1_100000_" + str(strain)
+
+    alignments_RDD = sc.parallelize(range(number_of_reads), args.partitions)\
+                       .mapPartitions(synthetic_alignments)\
+                       .cache()
+
+    number_of_alignments = alignments_RDD.count()
+
+    strain_table = strainTable.StrainTable([strainTable.UNKNOWN_STRAIN_NAME] +
+                                           ["GCA_" + str(strain) for strain in range(1, strains + 1)])
+    broadcast_strain_table = sc.broadcast(strain_table)
+
+    encoded_alignments_RDD = alignments_RDD.map(lambda alignment: (int(alignment[0].rsplit("_", 1)[1]),
+                                                                   broadcast_strain_table.value
+                                                                   .get_strain_id(alignment[1])))\
+                                           .cache()
+    encoded_alignments_RDD.count()
+
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Reads: " +
+          '{:0,.0f}'.format(number_of_reads) + ", Alignments: " + '{:0,.0f}'.format(number_of_alignments))
+
+    legacy_times    = []
+    partition_times = []
+
+    for repeat in range(args.repeats):
+        start_time = time.time()
+        legacy_abundances = dict(abundanceUtils.legacy_strain_abundances(alignments_RDD).collect())
+        legacy_times.append(time.time() - start_time)
+
+        start_time = time.time()
+        partition_abundances, reads_aligned, reads_multimapped = \
+            abundanceUtils.compute_strain_abundances(encoded_alignments_RDD,
+                                                     number_of_partitions=args.partitions,
+                                                     number_of_strains=strain_table.get_number_of_strains())
+        partition_times.append(time.time() - start_time)
+
+    partition_abundances = dict((strain_table.get_strain_name(strain_id), partition_abundances[strain_id])
+                                for strain_id in partition_abundances.nonzero()[0])
+
+    #   Both engines have to agree on every strain.
+    max_difference = 0.0
+    for strain_key in set(legacy_abundances) | set(partition_abundances):
+        difference = abs(legacy_abundances.get(strain_key, 0.0) - partition_abundances.get(strain_key, 0.0))
+        max_difference = max(max_difference, difference)
+
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Legacy Chain:     best " +
+          str(timedelta(seconds=min(legacy_times))) + ", mean " +
+          str(timedelta(seconds=sum(legacy_times) / len(legacy_times))))
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Partition Engine: best " +
+          str(timedelta(seconds=min(partition_times))) + ", mean " +
+          str(timedelta(seconds=sum(partition_times) / len(partition_times))))
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Speedup: " +
+          '{:.2f}'.format(min(legacy_times) / min(partition_times)) + "x")
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Strains: " +
+          str(len(partition_abundances)) + ", Reads Aligned: " + '{:0,.0f}'.format(reads_aligned) +
+          ", Multi-Mapped: " + '{:0,.0f}'.format(reads_multimapped) +
+          ", Max. Abundance Difference: " + '{:.3e}'.format(max_difference))
+
+    sc.stop()
+
+
+
+# ----------------------------------------------------------- Init ----------------------------------------------------
+#
+#   App Initializer.
+#
+if __name__ == "__main__":
+    main(sys.argv[1:])
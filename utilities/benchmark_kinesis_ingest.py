@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# ---------------------------------------------------------------------------------------------------------------------
+#
+#                                       Florida International University
+#
+#   This software is a "Camilo Valdes Work" under the terms of the United States Copyright Act.
+#   Please cite the author(s) in any work or product based on this material.
+#
+#   OBJECTIVE:
+#	    The purpose of this program is to measure how fast Kinesis records are ingested and decoded into tab5 reads,
+#       without AWS, by streaming from an in-process fake Kinesis stream.
+#
+#
+#   NOTES:
+#   Please see the dependencies section below for the required libraries (if any).
+#
+#   Synthetic paired-end reads are packed into records (see 'flint_kinesis.encode_reads()'), and written to a
+#   'FakeKinesisClient' before streaming starts. Every batch, the driver pulls the new records of each shard, and the
+#   Executors decode them, as they would with one Kinesis receiver per shard. Only ingestion and decoding are timed,
+#   the reads are counted but not aligned.
+#
+#   DEPENDENCIES:
+#       • Apache-Spark
+#       • Python
+#
+#   You can check the python modules currently installed in your system by running: python -c "help('modules')"
+#
+#   USAGE:
+#       Run the program with the "--help" flag to see usage instructions, e.g.,
+#
+#       spark-submit utilities/benchmark_kinesis_ingest.py --reads 1000000 --shards 4 --compress
+#
+#	AUTHOR:
+#           Camilo Valdes (camilo@castflyer.com)
+#			Florida International University (FIU)
+#
+#
+# ---------------------------------------------------------------------------------------------------------------------
+
+#   Spark Modules
+from pyspark import SparkConf, SparkContext
+from pyspark.streaming import StreamingContext
+
+# 	Python Modules
+import os, sys
+import argparse
+import time
+import random
+import threading
+from datetime import timedelta
+
+#   Flint Modules
+sys.path.append(os.path.join(os.path.dirname(__file__), '../modules'))
+import flint_kinesis as kinesisUtils
+import spark_jobs as sj
+
+
+STREAM_NAME = "flint_benchmark_stream"
+
+#   Most records in a single 'put_records()' call.
+PUT_RECORDS_LIMIT = 500
+
+
+def synthetic_reads(number_of_reads, read_length):
+    """
+    Generates paired-end tab5 reads with random sequences.
+    """
+    rng = random.Random(number_of_reads)
+    quality = "I" * read_length
+
+    for read_id in range(number_of_reads):
+        sequence_1 = "".join(rng.choice("ACGT") for base in range(read_length))
+        sequence_2 = "".join(rng.choice("ACGT") for base in range(read_length))
+        yield "SYNTHETIC_READ_" + str(read_id) + "\t" + sequence_1 + "\t" + quality + "\t" + sequence_2 + "\t" + quality
+
+
+# -------------------------------------------------------- Main -------------------------------------------------------
+#
+#
+def main(args):
+    """
+    Main function of the app.
+    Args:
+        args: command line arguments.
+
+    Returns:
+        Nothing.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reads", required=False, type=int, default=1000000, help="Number of synthetic reads.")
+    parser.add_argument("--read_length", required=False, type=int, default=150, help="Length of each mate.")
+    parser.add_argument("--reads_per_record", required=False, type=int, default=500,
+                        help="Number of reads packed into each Kinesis record.")
+    parser.add_argument("--shards", required=False, type=int, default=4, help="Number of Kinesis shards.")
+    parser.add_argument("--compress", action="store_true", required=False, help="Compress the records with zlib.")
+    parser.add_argument("--batch_duration", required=False, type=float, default=1.0,
+                        help="Streaming batch duration (in sec).")
+    args = parser.parse_args(args)
+
+    conf = (SparkConf().setAppName("Flint_Kinesis_Ingest_Benchmark"))
+    sc = SparkContext(conf=conf)
+    sc.addPyFile(os.path.join(os.path.dirname(__file__), '../modules/flint_kinesis.py'))
+
+    # ------------------------------------------- Fill the fake stream ------------------------------------------------
+    kinesis_client = kinesisUtils.FakeKinesisClient()
+    kinesis_client.create_stream(StreamName=STREAM_NAME, ShardCount=args.shards)
+
+    reads           = list(synthetic_reads(args.reads, args.read_length))
+    records         = []
+    record_bytes    = 0
+
+    for first_read in range(0, len(reads), args.reads_per_record):
+        data = kinesisUtils.encode_reads(reads[first_read:first_read + args.reads_per_record], args.compress)
+        record_bytes += len(data)
+        records.append({"Data": data, "PartitionKey": str(first_read)})
+
+    for first_record in range(0, len(records), PUT_RECORDS_LIMIT):
+        kinesis_client.put_records(Records=records[first_record:first_record + PUT_RECORDS_LIMIT],
+                                   StreamName=STREAM_NAME)
+
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Reads: " +
+          '{:0,.0f}'.format(len(reads)) + ", Records: " + '{:0,.0f}'.format(len(records)) + ", Shards: " +
+          str(args.shards) + ", Record Data: " + '{:0,.1f}'.format(record_bytes / (1024.0 * 1024.0)) + " MB")
+
+    # ------------------------------------------------- Streaming -----------------------------------------------------
+    ssc = StreamingContext(sc, args.batch_duration)
+
+    reads_dstream = sj.create_kinesis_dstream(ssc, "flint_benchmark", STREAM_NAME, None, "local",
+                                              kinesis_client=kinesis_client)\
+                      .flatMap(kinesisUtils.decode_record)
+
+    ingest_state = {"reads": 0, "batches": 0, "end_time": None}
+    ingest_done = threading.Event()
+
+    def count_batch(rdd):
+        number_of_reads = rdd.count()
+        if number_of_reads == 0:
+            return
+
+        ingest_state["reads"] += number_of_reads
+        ingest_state["batches"] += 1
+
+        if ingest_state["reads"] >= len(reads):
+            ingest_state["end_time"] = time.time()
+            ingest_done.set()
+
+    reads_dstream.foreachRDD(count_batch)
+
+    start_time = time.time()
+    ssc.start()
+    ingest_done.wait()
+    ssc.stop(stopSparkContext=False)
+
+    #   Time from the start of streaming, as the first batch already carries records.
+    ingest_time = ingest_state["end_time"] - start_time
+
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Ingest Time: " +
+          str(timedelta(seconds=ingest_time)) + " (" + str(ingest_state["batches"]) + " Batches)")
+    print("[" + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + "] Throughput: " +
+          '{:0,.0f}'.format(ingest_state["reads"] / ingest_time) + " Reads/sec, " +
+          '{:0,.1f}'.format(record_bytes / (1024.0 * 1024.0) / ingest_time) + " MB/sec")
+
+    sc.stop()
+
+
+
+# ----------------------------------------------------------- Init ----------------------------------------------------
+#
+#   App Initializer.
+#
+if __name__ == "__main__":
+    main(sys.argv[1:])
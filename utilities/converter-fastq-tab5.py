@@ -16,6 +16,15 @@
 #   NOTES:
 #   The tab5 format does away with the "@" prefix for the read name, as well as the "/1" or "/2" suffixes.
 #
+#   Both mates are read in lockstep, as they are normally in the same order, so memory use does not grow with the size
+#   of the sample. Mates that are out of order are held in memory until their pair shows up, and once more than
+#   '--max_pending' are held, they are spilled to disk in hash buckets (by read name) that are joined one at a time at
+#   the end. Input files can be gzipped ('.gz').
+#
+#   The output is written by a pool of writer threads, in chunks, while the mates are being read. With '--shard_reads',
+#   the output is a set of shard files with a fixed number of reads each, that are ready to be copied into a streaming
+#   directory. Shards are written under a hidden name and renamed into place, so Spark never picks up a partial file.
+#
 #   DEPENDENCIES:
 #
 #       • Python & the modules listed below
@@ -34,10 +43,237 @@
 
 # 	Python Modules
 import os, sys
+import io
 import time
 import argparse
-import csv
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
+import gzip
+import zlib
+import shutil
+import tempfile
+import itertools
+from multiprocessing.pool import ThreadPool
+
+try:
+    from itertools import izip_longest as zip_longest
+except ImportError:
+    from itertools import zip_longest
+
+#   Flint Modules
+sys.path.append(os.path.join(os.path.dirname(__file__), '../modules'))
+import flint_fastq as fastqUtils
+
+
+#   Reads per output chunk, when the output is not sharded.
+CHUNK_READS = 100000
+
+#   Number of files the out-of-order mates are spilled into.
+SPILL_BUCKETS = 64
+
+
+# ------------------------------------------------- Input Functions ---------------------------------------------------
+#
+#
+def open_fastq(file_path):
+    """
+    Opens a FASTQ file for reading, decompressing it if it's gzipped.
+    Args:
+        file_path:  Path to the FASTQ file.
+
+    Returns:
+        A file object that iterates over the lines of the file.
+    """
+    if file_path.endswith(".gz"):
+        gzip_file = gzip.open(file_path, "rb")
+        return gzip_file if sys.version_info[0] == 2 else io.TextIOWrapper(gzip_file)
+
+    return open(file_path)
+
+
+def read_fastq(fastq_file):
+    """
+    Parses a FASTQ file into (read name, sequence, quality) tuples. See 'flint_fastq.parse_fastq_records()'.
+    """
+    return fastqUtils.parse_fastq_records(line.rstrip("\r\n") for line in fastq_file)
+
+
+def to_tab5(read_name, mate_1, mate_2):
+    """
+    Formats a pair of mates, each a (sequence, quality) tuple, as a tab5 line.
+    """
+    return read_name + "\t" + mate_1[0] + "\t" + mate_1[1] + "\t" + mate_2[0] + "\t" + mate_2[1] + "\n"
+
+
+# ------------------------------------------------ Out-of-Order Mates -------------------------------------------------
+#
+#
+class MateJoin(object):
+    """
+    Pairs up mates that did not show up in lockstep. Unpaired mates are held in memory, and spilled to disk in hash
+    buckets once there are more than 'max_pending' of them.
+    """
+    def __init__(self, max_pending, spill_dir):
+        self.max_pending    = max_pending
+        self.spill_dir      = spill_dir
+        self.pending        = ({}, {})      # Unpaired mate 1s, and mate 2s, by read name.
+        self.spilled        = 0
+        self.orphans        = 0
+
+    def add(self, mate_index, read_name, sequence, quality):
+        """
+        Adds a mate, and pairs it up with its other mate if that is being held in memory.
+        Args:
+            mate_index:     0 for mate 1, 1 for mate 2.
+            read_name:      The read name.
+            sequence:       The mate's sequence.
+            quality:        The mate's quality string.
+
+        Returns:
+            The tab5 line of the pair, or None.
+        """
+        other_mate = self.pending[1 - mate_index].pop(read_name, None)
+
+        if other_mate is None:
+            self.pending[mate_index][read_name] = (sequence, quality)
+
+            if len(self.pending[0]) + len(self.pending[1]) > self.max_pending:
+                self.spill()
+
+            return None
+
+        if mate_index == 0:
+            return to_tab5(read_name, (sequence, quality), other_mate)
+
+        return to_tab5(read_name, other_mate, (sequence, quality))
+
+    def get_bucket_path(self, mate_index, bucket):
+        return os.path.join(self.spill_dir, "mate_" + str(mate_index + 1) + "-" + str(bucket) + ".txt")
+
+    def spill(self):
+        """
+        Appends the mates held in memory to their hash bucket files.
+        """
+        for mate_index in (0, 1):
+            bucket_files = {}
+            try:
+                for read_name, (sequence, quality) in self.pending[mate_index].items():
+                    bucket = zlib.crc32(read_name.encode("utf-8")) % SPILL_BUCKETS
+
+                    if bucket not in bucket_files:
+                        bucket_files[bucket] = open(self.get_bucket_path(mate_index, bucket), "a")
+
+                    bucket_files[bucket].write(read_name + "\t" + sequence + "\t" + quality + "\n")
+            finally:
+                for bucket_file in bucket_files.values():
+                    bucket_file.close()
+
+            self.spilled += len(self.pending[mate_index])
+            self.pending[mate_index].clear()
+
+    def read_bucket(self, mate_index, bucket):
+        bucket_path = self.get_bucket_path(mate_index, bucket)
+
+        if not os.path.exists(bucket_path):
+            return
+
+        with open(bucket_path) as bucket_file:
+            for line in bucket_file:
+                read_name, sequence, quality = line.rstrip("\n").split("\t")
+                yield read_name, (sequence, quality)
+
+    def finish(self):
+        """
+        Pairs up the mates that are left. Only one bucket is held in memory at a time.
+        Returns:
+            A generator of tab5 lines. The number of mates that never found their pair is in 'self.orphans'.
+        """
+        if self.spilled == 0:
+            #   Everything is still in memory, and a mate in one dictionary would have found its pair in the other.
+            self.orphans = len(self.pending[0]) + len(self.pending[1])
+            return
+
+        self.spill()
+
+        for bucket in range(SPILL_BUCKETS):
+            mates_1 = dict(self.read_bucket(0, bucket))
+
+            for read_name, mate_2 in self.read_bucket(1, bucket):
+                mate_1 = mates_1.pop(read_name, None)
+
+                if mate_1 is None:
+                    self.orphans += 1
+                else:
+                    yield to_tab5(read_name, mate_1, mate_2)
+
+            self.orphans += len(mates_1)
+
+
+def merge_mates(mates_1, mates_2, mate_join):
+    """
+    Walks both mates in lockstep, and hands the mates that are out of order to 'mate_join'.
+    Args:
+        mates_1:    Iterator of mate 1 (read name, sequence, quality) tuples.
+        mates_2:    Iterator of mate 2 (read name, sequence, quality) tuples.
+        mate_join:  A 'MateJoin' object.
+
+    Returns:
+        A generator of tab5 lines.
+    """
+    for mate_1, mate_2 in zip_longest(mates_1, mates_2):
+        if mate_1 is not None and mate_2 is not None and mate_1[0] == mate_2[0]:
+            yield to_tab5(mate_1[0], mate_1[1:], mate_2[1:])
+            continue
+
+        for mate_index, mate in ((0, mate_1), (1, mate_2)):
+            if mate is not None:
+                tab5_line = mate_join.add(mate_index, *mate)
+                if tab5_line is not None:
+                    yield tab5_line
+
+    for tab5_line in mate_join.finish():
+        yield tab5_line
+
+
+# ------------------------------------------------- Output Functions --------------------------------------------------
+#
+#
+def write_chunk(output_path, tab5_lines, rename_into_place):
+    """
+    Writes a chunk of tab5 lines. Runs in a writer thread.
+    Args:
+        output_path:        Path to the output file. Chunks are appended to it, unless 'rename_into_place' is set.
+        tab5_lines:         The tab5 lines.
+        rename_into_place:  Write the chunk to a hidden file, and rename it to 'output_path' once it's complete.
+
+    Returns:
+        The number of reads written.
+    """
+    if rename_into_place:
+        tmp_output_path = os.path.join(os.path.dirname(output_path), "." + os.path.basename(output_path))
+
+        with open(tmp_output_path, "w") as output_file:
+            output_file.writelines(tab5_lines)
+
+        os.rename(tmp_output_path, output_path)
+
+    else:
+        with open(output_path, "a") as output_file:
+            output_file.writelines(tab5_lines)
+
+    return len(tab5_lines)
+
+
+def chunk_lines(tab5_lines, chunk_size):
+    """
+    Groups tab5 lines into lists of 'chunk_size' lines.
+    """
+    tab5_lines = iter(tab5_lines)
+
+    while True:
+        chunk = list(itertools.islice(tab5_lines, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
 
 # -------------------------------------------------------- Main -------------------------------------------------------
 #
@@ -49,10 +285,19 @@ def main(args):
     print("[ " + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + " ] ")
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--mate_1", required=True, type=str, help="Mate 1 of pair, in FASTQ format.")
-    parser.add_argument("--mate_2", required=True, type=str, help="Mate 2 of pair, in FASTQ format.")
+    parser.add_argument("--mate_1", required=True, type=str, help="Mate 1 of pair, in FASTQ format. Can be gzipped.")
+    parser.add_argument("--mate_2", required=True, type=str, help="Mate 2 of pair, in FASTQ format. Can be gzipped.")
     parser.add_argument("--affix", required=False, type=str, help="Affix for Output files.")
     parser.add_argument("--out", required=False, type=str, help="Output Directory.")
+    parser.add_argument("--shard_reads", required=False, type=int,
+                        help="Write the output as shard files of this many reads, ready to be streamed.")
+    parser.add_argument("--writers", required=False, type=int, default=4,
+                        help="Number of threads that write the shard files.")
+    parser.add_argument("--max_pending", required=False, type=int, default=1000000,
+                        help="Number of out-of-order mates to hold in memory before spilling them to disk.")
+    parser.add_argument("--spill_dir", required=False, type=str,
+                        help="Directory for the out-of-order mates that are spilled to disk. Defaults to the output " +
+                             "directory.")
 
     args = parser.parse_args(args)
 
@@ -75,29 +320,71 @@ def main(args):
 
     outputFile = output_directory + "/" + affixForOutputFile + "-tab5.txt"
 
+    if args.shard_reads is None and os.path.exists(outputFile):
+        os.remove(outputFile)
+
+    spill_dir = tempfile.mkdtemp(prefix=".spill-", dir=args.spill_dir or output_directory)
+
     # ----------------------------------------------- TAB5 Conversion -------------------------------------------------
     #
     #   TAB5 format: [name]\t[seq1]\t[qual1]\t[seq2]\t[qual2]\n
     #
-    print("[ " + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + " ] Reading Mate 1...")
+    print("[ " + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + " ] Reading Mates...")
+
+    #   Shards are independent files, and are written in parallel. A single output file is appended to in order, by a
+    #   single writer.
+    if args.shard_reads is not None:
+        number_of_writers   = max(args.writers, 1)
+        chunk_size          = args.shard_reads
+    else:
+        number_of_writers   = 1
+        chunk_size          = CHUNK_READS
+
+    writer_pool = ThreadPool(number_of_writers)
+
+    #   Chunks that are queued or being written. The reader waits for the oldest one, so memory stays bounded.
+    max_queued_chunks = 2 * number_of_writers
+    queued_chunks = []
+
+    number_of_reads = 0
+    mate_join = MateJoin(args.max_pending, spill_dir)
+
+    try:
+        with open_fastq(filePathForMate1) as mate_1_in_handle, open_fastq(filePathForMate2) as mate_2_in_handle:
+
+            tab5_lines = merge_mates(read_fastq(mate_1_in_handle), read_fastq(mate_2_in_handle), mate_join)
+
+            for chunk_number, chunk in enumerate(chunk_lines(tab5_lines, chunk_size)):
+                if args.shard_reads is not None:
+                    chunk_path = output_directory + "/" + affixForOutputFile + "-shard_" + \
+                                 '{:05d}'.format(chunk_number) + "-tab5.txt"
+                else:
+                    chunk_path = outputFile
+
+                queued_chunks.append(writer_pool.apply_async(write_chunk, (chunk_path, chunk,
+                                                                           args.shard_reads is not None)))
+
+                if len(queued_chunks) >= max_queued_chunks:
+                    number_of_reads += queued_chunks.pop(0).get()
 
-    dictionaryWithMate1 = {}
+        for queued_chunk in queued_chunks:
+            number_of_reads += queued_chunk.get()
 
-    with open(filePathForMate1) as mate_1_in_handle:
-        for title, seq, qual in FastqGeneralIterator(mate_1_in_handle):
-            clean_title = title.replace('/1', '')
-            clean_read = [clean_title, seq, qual]
-            dictionaryWithMate1[clean_title] = clean_read
+    finally:
+        writer_pool.close()
+        writer_pool.join()
+        shutil.rmtree(spill_dir, ignore_errors=True)
 
-    print("[ " + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + " ] Reading Mate 2...")
+    print("[ " + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + " ] Pairs Written: " +
+          '{:0,.0f}'.format(number_of_reads))
 
-    writer = csv.writer(open(outputFile, "wb"), delimiter='\t', quoting=csv.QUOTE_NONE, lineterminator="\n")
+    if mate_join.spilled > 0:
+        print("[ " + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + " ] Out-of-Order Mates Spilled: " +
+              '{:0,.0f}'.format(mate_join.spilled))
 
-    with open(filePathForMate2) as mate_2_in_handle:
-        for title, seq, qual in FastqGeneralIterator(mate_2_in_handle):
-            clean_title = title.replace('/2', '')
-            mate_1 = dictionaryWithMate1[clean_title]
-            writer.writerow([mate_1[0], mate_1[1], mate_1[2], seq, qual])
+    if mate_join.orphans > 0:
+        print("[ " + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + " ] [WARNING] Mates Without a Pair: " +
+              '{:0,.0f}'.format(mate_join.orphans))
 
     print("[ " + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + " ] Done.")
     print("[ " + time.strftime('%d-%b-%Y %H:%M:%S', time.localtime()) + " ] ")